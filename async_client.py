@@ -0,0 +1,756 @@
+"""asyncioで動作する、input()/print()を使わないクライアント
+
+ボット・ブリッジ・負荷試験のように、多数のユーザーを1つのプロセスで動かすためのAPI。
+
+    async with AsyncChatClient() as client:
+        session = await client.create_room("bot", "lobby")
+        session.send("hello")
+        async for message in session:
+            print(message)
+
+ハンドシェイクはTCPアドレスごとに1本の接続を使い回し、リクエストを続けて送ってレスポンスを順に受け取る。
+UDPソケットは複数のユーザー(ChatSession)で共有する。中継されたデータグラムには宛先のユーザーが
+含まれないため、1つのソケットには同じ部屋のユーザーを1人までしか置かず、ハンドシェイクで
+protocol.FLAG_ROOM_TAGを送って部屋名付きのフレームで受け取り、部屋名でユーザーに振り分ける。
+同じ部屋のユーザーを増やすとソケットも増えるため、ソケット数は1つの部屋のユーザー数の最大と、
+ユーザー数 / users_per_socket の大きい方になる。
+マルチキャストで受け取るユーザーは、サーバーから通知された部屋のグループに参加した受信用のソケット
+(同じグループのユーザーで共有する)でも受け取り、退出するとグループから抜ける。
+"""
+
+import asyncio
+import collections
+import secrets
+import socket
+import struct
+import time
+
+import multicast
+import protocol
+from compression import Decompressor
+from fragment import Reassembler
+from log import get_logger
+from reliable import ReliableReceiver
+
+logger = get_logger("client")
+
+CREATE_ROOM_NUM = 1
+JOIN_ROOM_NUM = 2
+# ハンドシェイクのレスポンスのstate
+REQUEST_COMPLETION = 2
+ERROR_RESPONSE = 3
+REDIRECT_RESPONSE = 4
+# ユーザー名・部屋名の最大バイト数
+NAME_MAX_BYTE_SIZE = 255
+
+
+class _HandshakeConnection:
+    """ハンドシェイク用の1本のTCP接続
+
+    Note:
+        サーバーは1つの接続のリクエストを届いた順に処理するため、レスポンスを待たずに
+        続けて送り、送った順に並べたFutureにレスポンスを渡す。
+    """
+
+    def __init__(self, reader, writer):
+        self.__reader = reader
+        self.__writer = writer
+        self.__pending = collections.deque()  # レスポンス待ちのFuture(送った順)
+        self.closed = False
+        self.__task = asyncio.create_task(self.__read_responses())
+
+    @classmethod
+    async def open(cls, address):
+        """接続を開く
+
+        Args:
+            address (tuple): サーバーの (ホスト, TCPポート)
+        """
+        reader, writer = await asyncio.open_connection(*address)
+        return cls(reader, writer)
+
+    def request(self, request):
+        """リクエストを送信する
+
+        Args:
+            request (bytes): リクエスト(ヘッダー + ボディ)
+
+        Returns:
+            asyncio.Future: (state, ペイロード) を結果とするFuture
+
+        Raises:
+            ConnectionError: 接続が閉じられている場合
+        """
+        if self.closed:
+            raise ConnectionError("Handshake connection closed.")
+        future = asyncio.get_running_loop().create_future()
+        self.__pending.append(future)
+        self.__writer.write(request)
+        return future
+
+    async def __read_responses(self):
+        """レスポンスを受信し、送った順のFutureに渡す"""
+        error = ConnectionError("Connection closed by server.")
+        try:
+            while True:
+                header = await self.__reader.readexactly(protocol.HANDSHAKE_HEADER_SIZE)
+                _, _, state, payload_size = struct.unpack_from(
+                    protocol.HANDSHAKE_HEADER_FORMAT, header
+                )
+                payload = await self.__reader.readexactly(
+                    int.from_bytes(payload_size, byteorder="big")
+                )
+                if not self.__pending:
+                    raise ConnectionError("Unexpected handshake response.")
+                future = self.__pending.popleft()
+                if not future.done():
+                    future.set_result((state, payload))
+        except asyncio.IncompleteReadError:
+            pass
+        except (ConnectionError, OSError) as e:
+            error = ConnectionError(str(e))
+        finally:
+            self.close()
+            while self.__pending:
+                future = self.__pending.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+    def close(self):
+        """接続を閉じる"""
+        if self.closed:
+            return
+        self.closed = True
+        self.__writer.close()
+        if self.__task is not asyncio.current_task():
+            self.__task.cancel()
+
+
+class _SharedSocket(asyncio.DatagramProtocol):
+    """複数のChatSessionで共有するUDPソケット"""
+
+    def __init__(self):
+        self.transport = None
+        self.address = None
+        self.sessions = {}  # 部屋名:ChatSession(1つの部屋に1人まで)
+        # 振り分け先のユーザーが見つからなかったデータグラムの数
+        self.unrouted = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("sockname")[:2]
+
+    def datagram_received(self, data, addr):
+        if protocol.is_control(data) and data[1] == protocol.FRAME_ROOM:
+            try:
+                room_name, data = protocol.decode_room_frame(data)
+            except (ValueError, UnicodeDecodeError):
+                self.unrouted += 1
+                return
+            session = self.sessions.get(room_name)
+        elif len(self.sessions) == 1:
+            # 部屋名の付かないデータグラムは、ソケットのユーザーが1人なら(専用のソケットか、
+            # サーバーの再起動で部屋名付きの指定が失われた場合)そのユーザー宛て
+            session = next(iter(self.sessions.values()))
+        else:
+            session = None
+        if session is None:
+            self.unrouted += 1
+            return
+        try:
+            session.datagram_received(data)
+        except Exception as e:
+            logger.warning("Client Error:%s", e)
+
+    def error_received(self, exc):
+        logger.warning("Client Error:%s", exc)
+
+    def sendto(self, data, address):
+        self.transport.sendto(data, address)
+
+
+class _MulticastGroup(asyncio.DatagramProtocol):
+    """部屋のマルチキャストグループに参加した受信用のUDPソケット(同じグループのChatSessionで共有する)"""
+
+    def __init__(self):
+        self.transport = None
+        self.sessions = {}  # 部屋名:ChatSessionのリスト
+        self.closed = False
+        # 振り分け先のユーザーが見つからなかったデータグラムの数(グループが重なった別の部屋など)
+        self.unrouted = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if not (protocol.is_control(data) and data[1] == protocol.FRAME_MULTICAST):
+            self.unrouted += 1
+            return
+        try:
+            room_name, excluded, data = protocol.decode_multicast_frame(data)
+        except (ValueError, UnicodeDecodeError, struct.error):
+            self.unrouted += 1
+            return
+        sessions = self.sessions.get(room_name)
+        if not sessions:
+            self.unrouted += 1
+            return
+        # 通知を受け取ったユーザーが退出してリストから外れても残りのユーザーに渡す
+        for session in tuple(sessions):
+            if session.session_id in excluded:
+                continue
+            try:
+                session.datagram_received(data)
+            except Exception as e:
+                logger.warning("Client Error:%s", e)
+
+    def error_received(self, exc):
+        logger.warning("Client Error:%s", exc)
+
+    def add(self, session):
+        """グループで中継を受け取るユーザーを追加する"""
+        self.sessions.setdefault(session.room_name, []).append(session)
+
+    def remove(self, session):
+        """ユーザーを外し、誰もいなくなったらソケットを閉じてグループから抜ける"""
+        sessions = self.sessions.get(session.room_name, [])
+        if session in sessions:
+            sessions.remove(session)
+            if not sessions:
+                del self.sessions[session.room_name]
+        if not self.sessions and not self.closed:
+            self.closed = True
+            self.transport.close()
+
+
+class ChatSession:
+    """AsyncChatClientで作成・参加した部屋のユーザー1人分
+
+    Note:
+        受信したメッセージは「ユーザー名: メッセージ」などの表示する文字列で、
+        async forで順に受け取るか、on_messageに渡したコールバックで受け取る。
+        退出・部屋の終了・タイムアウトの通知を受け取るとclosedになり、async forが終わる。
+    """
+
+    # コールバックを使わない場合に溜めておくメッセージ数(超えた分は古いものから捨てる)
+    MAX_QUEUED = 1024
+
+    def __init__(self, shared_socket, name, room_name, on_message=None):
+        """
+        Args:
+            shared_socket (_SharedSocket): 送受信に使うUDPソケット
+            name (str): ユーザー名
+            room_name (str): 部屋名
+            on_message (callable): メッセージを受け取るたびに (ChatSession, str) で呼ぶ関数
+        """
+        self.__socket = shared_socket
+        self.__on_message = on_message
+        self.__queue = collections.deque()
+        self.__waiter = None
+        self.name = name
+        self.room_name = room_name
+        self.token = ""
+        # 短い形式のチャットメッセージで送るセッションID(空の場合は部屋名とトークンを送る)
+        self.session = b""
+        self.session_id = None
+        # マルチキャストで受け取る場合に参加しているグループ(_MulticastGroup)
+        self.multicast = None
+        # チャットメッセージを送るサーバーのUDPアドレス
+        self.server_address = None
+        self.closed = False
+        # 受信済みの履歴の最後のシーケンス番号
+        self.last_seq = 0
+        # 再送・順序保証付きで受け取る場合の並べ直し用のバッファ(reliable.ReliableReceiver)
+        self.receiver = None
+        # 圧縮して受け取る場合の展開(compression.Decompressor)
+        self.decompressor = None
+        self.reassembler = Reassembler()
+        # 溜めきれずに捨てたメッセージ数
+        self.dropped = 0
+        # 分割して送信するメッセージのID(他のユーザーと重なりにくいように乱数から始める)
+        self.__message_id = secrets.randbits(32)
+
+    @property
+    def address(self):
+        """中継を受け取るUDPアドレス(ソケットを共有するユーザーで同じ)"""
+        return self.__socket.address
+
+    def __generate_request(self, message):
+        if self.session:
+            return protocol.encode_compact_datagram(self.session, message)
+        return protocol.encode_chat_datagram(self.room_name, self.token, message)
+
+    def __send(self, data):
+        if self.closed:
+            raise ConnectionError(f"{self.name} has left {self.room_name}.")
+        self.__socket.sendto(data, self.server_address)
+
+    def send(self, message):
+        """メッセージを送信する(1つのデータグラムに収まらない場合は分割して送信する)
+
+        Args:
+            message (str): メッセージ
+
+        Raises:
+            ValueError: メッセージがprotocol.MAX_MESSAGE_SIZEバイトを超える場合
+            ConnectionError: 退出済みの場合
+        """
+        encoded_message = message.encode("utf-8")
+        if len(encoded_message) > protocol.MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message bytes: {len(encoded_message)} is too large.")
+        if message == "exit":
+            self.leave()
+        elif len(encoded_message) > protocol.FRAGMENT_SIZE:
+            self.send_fragments(encoded_message)
+        else:
+            self.__send(self.__generate_request(message))
+
+    def send_fragments(self, data):
+        """大きなメッセージを断片に分割して送信する
+
+        Args:
+            data (bytes): エンコード済みのメッセージ(MAX_MESSAGE_SIZEバイトまで)
+        """
+        self.__message_id = (self.__message_id + 1) & 0xFFFFFFFF
+        header = self.__generate_request("")
+        for control in protocol.encode_fragment_controls(self.__message_id, data):
+            self.__send(header + control)
+
+    def request_history(self):
+        """参加前のメッセージ(受信済みの最後のシーケンス番号より後)をサーバーに要求する"""
+        self.__send(
+            self.__generate_request("") + protocol.encode_history_control(self.last_seq)
+        )
+
+    def use_unicast(self):
+        """マルチキャストをやめ、中継をユニキャストで受け取るようにサーバーに知らせる"""
+        self.__send(self.__generate_request("") + protocol.encode_unicast_control())
+
+    def leave(self):
+        """部屋から退出する"""
+        if self.closed:
+            return
+        self.__send(self.__generate_request("exit"))
+        self.close()
+
+    def close(self):
+        """サーバーに知らせずに受信をやめる(受信済みのメッセージはasync forで受け取れる)"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.__socket.sessions.get(self.room_name) is self:
+            del self.__socket.sessions[self.room_name]
+        if self.multicast is not None:
+            self.multicast.remove(self)
+            self.multicast = None
+        self.__wake()
+
+    async def receive(self):
+        """次のメッセージを受け取る
+
+        Returns:
+            str: メッセージ(退出済みで溜まっているメッセージもない場合はNone)
+        """
+        while not self.__queue:
+            if self.closed:
+                return None
+            self.__waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.__waiter
+            finally:
+                self.__waiter = None
+        return self.__queue.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def __wake(self):
+        if self.__waiter is not None and not self.__waiter.done():
+            self.__waiter.set_result(None)
+
+    def __deliver(self, message):
+        """受け取ったメッセージをコールバックに渡すか、async for用に溜める"""
+        if self.__on_message is not None:
+            self.__on_message(self, message)
+            return
+        if len(self.__queue) >= self.MAX_QUEUED:
+            self.__queue.popleft()
+            self.dropped += 1
+        self.__queue.append(message)
+        self.__wake()
+
+    def datagram_received(self, data):
+        """サーバーから届いたデータグラム(部屋名付きのフレームの場合は中身)を処理する"""
+        if self.closed:
+            return
+        if (
+            self.receiver is not None
+            and protocol.is_control(data)
+            and data[1] == protocol.FRAME_RELIABLE
+        ):
+            epoch, seq, data = protocol.decode_reliable_frame(data)
+            delivered = self.receiver.receive(seq, data, epoch)
+            # 重複や順番の入れ替わりでも受信済みの番号を知らせ、不要な再送を防ぐ
+            cumulative, ranges = self.receiver.ack()
+            self.__send(
+                self.__generate_request("")
+                + protocol.encode_ack_control(cumulative, ranges, epoch)
+            )
+        else:
+            delivered = [data]
+        for data in delivered:
+            if not self.closed:
+                self.__handle_datagram(data)
+
+    def __handle_datagram(self, data):
+        if protocol.is_control(data):
+            if self.decompressor is not None and data[1] == protocol.FRAME_COMPRESSED:
+                dictionary_id, payload = self.decompressor.decompress(data)
+                if payload is None:
+                    self.__send(
+                        self.__generate_request("")
+                        + protocol.encode_dictionary_control(dictionary_id)
+                    )
+                elif payload:
+                    self.__handle_datagram(payload)
+            elif self.decompressor is not None and data[1] == protocol.FRAME_DICTIONARY:
+                self.decompressor.add_dictionary(data)
+            elif data[1] in (protocol.FRAME_HISTORY, protocol.FRAME_BATCH):
+                for seq, message in protocol.decode_history_frame(data):
+                    if seq > self.last_seq:
+                        self.last_seq = seq
+                        self.__deliver(message.decode("utf-8", "replace"))
+            elif data[1] == protocol.FRAME_FRAGMENT:
+                prefix, message_id, index, count, total, chunk = (
+                    protocol.decode_fragment_frame(data)
+                )
+                message = self.reassembler.add(
+                    (prefix, message_id), index, count, total, chunk, time.monotonic()
+                )
+                if message is not None:
+                    self.__deliver((prefix + message).decode("utf-8", "replace"))
+            return
+        message = data.decode("utf-8", "replace")
+        self.__deliver(message)
+        if self.__is_closing_notice(message):
+            self.close()
+
+    def __is_closing_notice(self, message):
+        """自分の退出・部屋の終了・部屋の移動の通知かどうか"""
+        return (
+            f"ホストが退出したため、チャットルーム:{self.room_name}を終了します。" in message
+            or message == f"{self.name}が{self.room_name}から退出しました。"
+            or (
+                message.startswith(f"チャットルーム:{self.room_name}は")
+                and "のサーバーに移動したため、終了します。" in message
+            )
+        )
+
+
+class AsyncChatClient:
+    """多数のユーザーをまとめて動かすasyncioのクライアント"""
+
+    # クラスター構成でリダイレクトをたどる最大回数
+    MAX_REDIRECTS = 3
+    # 1つのUDPソケットを共有するユーザー数の上限
+    USERS_PER_SOCKET = 1024
+    # 共有するUDPソケットの受信バッファのバイト数
+    RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        tcp_port=9002,
+        udp_port=9003,
+        use_binary=True,
+        users_per_socket=USERS_PER_SOCKET,
+    ):
+        """
+        Args:
+            host (str): サーバーのホスト
+            tcp_port (int): サーバーのTCPポート(クラスターではどのノードでもよい)
+            udp_port (int): サーバーのUDPポート
+            use_binary (bool): ハンドシェイクのペイロードをバイナリ形式で送るかどうか
+            users_per_socket (int): 1つのUDPソケットを共有するユーザー数の上限
+                (1の場合はユーザーごとにソケットを作り、部屋名付きのフレームを使わない)
+        """
+        self.tcp_address = (host, tcp_port)
+        self.udp_address = (host, udp_port)
+        self.use_binary = use_binary
+        self.users_per_socket = max(users_per_socket, 1)
+        self.sockets = []  # _SharedSocket
+        # 同時に参加するユーザーがそれぞれ新しいソケットを作らないように、ソケットの選択を1つずつ行う
+        self.__socket_lock = asyncio.Lock()
+        self.__connections = {}  # TCPアドレス:_HandshakeConnectionを開くTask
+        self.__groups = {}  # (グループのIPアドレス, ポート):_MulticastGroup
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def create_room(self, user_name, room_name, **options):
+        """部屋を作成してホストとして参加する(引数はjoin_roomと同じ)"""
+        return await self.__enter_room(CREATE_ROOM_NUM, user_name, room_name, **options)
+
+    async def join_room(self, user_name, room_name, **options):
+        """既存の部屋に参加する
+
+        Args:
+            user_name (str): ユーザー名
+            room_name (str): 部屋名
+            reliable (bool): 中継を再送・順序保証付きで受け取るかどうか
+            compress (bool): 中継を圧縮して受け取るかどうか(ソケットを共有する場合は圧縮されない)
+            multicast (bool): 中継を部屋のマルチキャストグループで受け取るかどうか
+                (サーバーが対応していない場合とグループに参加できない場合はユニキャストで受け取る)
+            history (bool): 参加前のメッセージを要求するかどうか
+            on_message (callable): メッセージを受け取るたびに (ChatSession, str) で呼ぶ関数
+
+        Returns:
+            ChatSession: 参加したユーザー
+
+        Raises:
+            ValueError: ユーザー名・部屋名が長すぎる場合・制御フレームと区別できない場合
+            RuntimeError: 部屋の作成・参加が拒否された場合(メッセージはサーバーの応答)
+            ConnectionError: サーバーに接続できなかった場合
+        """
+        return await self.__enter_room(JOIN_ROOM_NUM, user_name, room_name, **options)
+
+    async def list_rooms(self, prefix="", cursor="", limit=0):
+        """部屋名がprefixで始まる部屋を辞書順に1ページ分取得する
+
+        Note:
+            クラスター構成では、tcp_portのノードが担当する部屋だけを返す。
+
+        Args:
+            prefix (str): 部屋名の先頭(空文字なら全部屋)
+            cursor (str): 前回の戻り値の続きのカーソル(空文字なら最初から)
+            limit (int): 取得する部屋数(0ならサーバーの上限)
+
+        Returns:
+            tuple: ((部屋名, 人数) のリスト, 続きのカーソル(最後のページなら空文字))
+
+        Raises:
+            ValueError: prefixが長すぎる場合
+            RuntimeError: リクエストが拒否された場合(メッセージはサーバーの応答)
+            ConnectionError: サーバーに接続できなかった場合
+        """
+        size = len(prefix.encode("utf-8"))
+        if size > NAME_MAX_BYTE_SIZE:
+            raise ValueError(f"Room name prefix bytes: {size} is invalid.")
+        while True:
+            use_binary = self.use_binary
+            payload = protocol.encode_list_request(cursor, limit, use_binary)
+            request = protocol.encode_handshake_request(
+                prefix, protocol.LIST_ROOMS_NUM, 0, payload
+            )
+            state, payload = await self.__request(self.tcp_address, request)
+            if use_binary and state == ERROR_RESPONSE and not protocol.is_binary(payload):
+                self.use_binary = False
+                continue
+            response = protocol.decode_list_response(payload)
+            if state != REQUEST_COMPLETION:
+                raise RuntimeError(response["message"])
+            return response["rooms"], response["cursor"]
+
+    async def __enter_room(
+        self,
+        operation,
+        user_name,
+        room_name,
+        reliable=False,
+        compress=False,
+        history=True,
+        on_message=None,
+        multicast=False,
+    ):
+        for label, name in (("User name", user_name), ("Room name", room_name)):
+            size = len(name.encode("utf-8"))
+            if not name or size > NAME_MAX_BYTE_SIZE:
+                raise ValueError(f"{label} bytes: {size} is invalid.")
+            protocol.check_name(name)
+
+        async with self.__socket_lock:
+            shared_socket = await self.__socket_for(room_name)
+            session = ChatSession(shared_socket, user_name, room_name, on_message)
+            # ハンドシェイク中に同じ部屋のユーザーが同じソケットを選ばないように先に登録する
+            shared_socket.sessions[room_name] = session
+        try:
+            state, response, udp_address = await self.__handshake(
+                operation, session, reliable, compress, multicast
+            )
+        except BaseException:
+            session.close()
+            raise
+        # トークンのない完了(満員の部屋に古いサーバーが返すもの)も参加できなかったものとして扱う
+        if state != REQUEST_COMPLETION or not response.get("token"):
+            session.close()
+            raise RuntimeError(response["message"])
+
+        session.token = response["token"]
+        # セッションIDを受け取った場合は部屋名を含まない短い形式で送信する
+        if response.get("session_id") is not None:
+            session.session_id = response["session_id"]
+            session.session = protocol.encode_session_id(session.session_id)
+        session.server_address = udp_address
+        if reliable:
+            session.receiver = ReliableReceiver()
+        if compress:
+            session.decompressor = Decompressor()
+        if response.get("multicast") is not None:
+            await self.__join_group(session, tuple(response["multicast"]))
+        if history:
+            session.request_history()
+        return session
+
+    async def __join_group(self, session, group):
+        """マルチキャストグループに参加する(参加できない場合はユニキャストの中継に戻す)
+
+        Args:
+            session (ChatSession): 参加したユーザー
+            group (tuple): サーバーから通知された (グループのIPアドレス, ポート)
+        """
+        async with self.__socket_lock:
+            group_socket = self.__groups.get(group)
+            if group_socket is None or group_socket.closed:
+                try:
+                    # 中継を受け取るUDPソケットと同じインターフェースで参加する
+                    sock = multicast.open_receiver(group, session.address[0])
+                    _, group_socket = (
+                        await asyncio.get_running_loop().create_datagram_endpoint(
+                            _MulticastGroup, sock=sock
+                        )
+                    )
+                except OSError as e:
+                    logger.warning("Client Error:%s", e)
+                    session.use_unicast()
+                    return
+                self.__groups[group] = group_socket
+            group_socket.add(session)
+            session.multicast = group_socket
+
+    async def __handshake(self, operation, session, reliable, compress, multicast):
+        """作成・参加リクエストを送り、リダイレクトをたどってレスポンスを受け取る
+
+        Note:
+            バイナリ形式に対応していないサーバーはJSON形式でエラーを返すため、
+            その場合はJSON形式に切り替えて再送する。
+
+        Returns:
+            tuple: (state, レスポンスの辞書, チャットメッセージを送るUDPアドレス)
+        """
+        flags = protocol.FLAG_COMPACT
+        if reliable:
+            flags |= protocol.FLAG_RELIABLE
+        if compress:
+            flags |= protocol.FLAG_COMPRESS
+        if self.users_per_socket > 1:
+            flags |= protocol.FLAG_ROOM_TAG
+        if multicast:
+            flags |= protocol.FLAG_MULTICAST
+        tcp_address, udp_address = self.tcp_address, self.udp_address
+        redirects = 0
+        while True:
+            use_binary = self.use_binary
+            payload = protocol.encode_join_request(
+                session.name, session.address, use_binary, flags
+            )
+            request = protocol.encode_handshake_request(
+                session.room_name, operation, 0, payload
+            )
+            state, payload = await self.__request(tcp_address, request)
+            response = protocol.decode_join_response(
+                payload, operation, session.room_name
+            )
+            if use_binary and state == ERROR_RESPONSE and not protocol.is_binary(payload):
+                self.use_binary = False
+                continue
+            if state != REDIRECT_RESPONSE or redirects >= self.MAX_REDIRECTS:
+                return state, response, udp_address
+            redirects += 1
+            host, tcp_port, udp_port = response["redirect"]
+            tcp_address, udp_address = (host, tcp_port), (host, udp_port)
+
+    async def __request(self, tcp_address, request):
+        """ハンドシェイク用の接続を使い回してリクエストを送る
+
+        Note:
+            サーバーは一定時間リクエストのない接続を閉じるため、使い回した接続が
+            閉じられていた場合は1回だけ接続し直して送り直す。
+        """
+        for retry in (True, False):
+            task = self.__connections.get(tcp_address)
+            reused = task is not None
+            if task is not None and task.done():
+                if task.exception() is not None or task.result().closed:
+                    task, reused = None, False
+            if task is None:
+                task = asyncio.ensure_future(_HandshakeConnection.open(tcp_address))
+                self.__connections[tcp_address] = task
+            connection = await task
+            try:
+                return await connection.request(request)
+            except ConnectionError:
+                if not (retry and reused):
+                    raise
+
+    async def __socket_for(self, room_name):
+        """部屋のユーザーがまだいない、空きのあるUDPソケットを返す(なければ作る)"""
+        candidates = [
+            s
+            for s in self.sockets
+            if room_name not in s.sessions and len(s.sessions) < self.users_per_socket
+        ]
+        if candidates:
+            return min(candidates, key=lambda s: len(s.sessions))
+        # サーバーに届くローカルのIPアドレスにバインドする(参加時にサーバーに登録するアドレス)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect(self.udp_address)
+            local_host = probe.getsockname()[0]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE
+            )
+        except OSError:
+            pass
+        sock.bind((local_host, 0))
+        _, shared_socket = await asyncio.get_running_loop().create_datagram_endpoint(
+            _SharedSocket, sock=sock
+        )
+        self.sockets.append(shared_socket)
+        return shared_socket
+
+    @property
+    def sessions(self):
+        """参加中のユーザー(ChatSession)の一覧"""
+        return [s for shared in self.sockets for s in shared.sessions.values()]
+
+    async def close(self):
+        """参加中の全ユーザーを退出させ、ソケットと接続を閉じる"""
+        for session in self.sessions:
+            try:
+                session.leave()
+            except OSError as e:
+                logger.warning("Client Error:%s", e)
+        for shared_socket in self.sockets:
+            shared_socket.transport.close()
+        self.sockets = []
+        for group_socket in self.__groups.values():
+            if not group_socket.closed:
+                group_socket.closed = True
+                group_socket.transport.close()
+        self.__groups = {}
+        for task in self.__connections.values():
+            if not task.done():
+                task.cancel()
+            elif task.exception() is None:
+                task.result().close()
+        self.__connections = {}
@@ -0,0 +1,123 @@
+"""1つのプロセスで多数のユーザーを動かすクライアント(async_client.py)のベンチマーク
+
+--users 人のユーザーを --rooms 個の部屋に分けて参加させ、全員が --messages 件ずつ送信したときの
+参加にかかった時間、使ったUDPソケット数、受信したメッセージ数と、プロセスの最大メモリ使用量を計測する。
+
+python3 bench_async_client.py --users 2000 --rooms 100 --messages 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from async_client import AsyncChatClient
+
+BATCH = 50
+
+
+async def run(args):
+    received = 0
+
+    def on_message(session, message):
+        nonlocal received
+        received += 1
+
+    async with AsyncChatClient(
+        args.host, args.tcp_port, args.udp_port, users_per_socket=args.users_per_socket
+    ) as client:
+        per_room = args.users // args.rooms
+        start = time.perf_counter()
+        sessions = await asyncio.gather(
+            *(
+                client.create_room(
+                    f"user{r}-0", f"bench-async-{r}", history=False, on_message=on_message
+                )
+                for r in range(args.rooms)
+            )
+        )
+        sessions += await asyncio.gather(
+            *(
+                client.join_room(
+                    f"user{r}-{i}",
+                    f"bench-async-{r}",
+                    history=False,
+                    on_message=on_message,
+                )
+                for r in range(args.rooms)
+                for i in range(1, per_room)
+            )
+        )
+        join_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # 全員が同時に送らないように、BATCH人ずつ間隔を空けて送る
+        batches = [sessions[i : i + BATCH] for i in range(0, len(sessions), BATCH)]
+        interval = 1 / args.rate / len(batches)
+        for n in range(args.messages):
+            for batch in batches:
+                for session in batch:
+                    session.send(f"message {n}")
+                await asyncio.sleep(interval)
+        expected = args.messages * len(sessions) * (per_room - 1)
+        deadline = time.monotonic() + args.drain
+        while received < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        send_seconds = time.perf_counter() - start
+        return {
+            "config": vars(args),
+            "users": len(sessions),
+            "udp_sockets": len(client.sockets),
+            "join_seconds": join_seconds,
+            "joins_per_second": len(sessions) / join_seconds,
+            "messages_expected": expected,
+            "messages_received": received,
+            "delivery_ratio": received / expected if expected else 1.0,
+            "received_per_second": received / send_seconds,
+            "unrouted_datagrams": sum(s.unrouted for s in client.sockets),
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Async client benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9003)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=5, help="1人あたりの送信数")
+    parser.add_argument("--rate", type=float, default=2, help="1人あたりのmessages/s")
+    parser.add_argument("--drain", type=float, default=3, help="送信後に受信を待つ秒数")
+    parser.add_argument(
+        "--users-per-socket", type=int, default=AsyncChatClient.USERS_PER_SOCKET
+    )
+    parser.add_argument(
+        "--server-args", default="", help="サーバーを起動する場合のserver.pyの引数"
+    )
+    parser.add_argument("--no-server", action="store_true", help="起動済みのサーバーを使う")
+    args = parser.parse_args()
+
+    server_process = None
+    if not args.no_server:
+        server_process = subprocess.Popen(
+            [sys.executable, "server.py", *args.server_args.split()],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        time.sleep(1)
+    try:
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""クラスター構成(cluster.py)のベンチマーク
+
+1台のマシンでループバックの別ポートに複数のノードを起動し、1つ目のノードにだけ接続して
+多数の部屋を作成する(担当でないノードからはリダイレクトをたどる)。その後ノード一覧のファイルに
+ノードを1つ追加し、担当が移って閉じられた部屋の割合を、部屋名のハッシュをノード数で割った余りで
+担当を決めた場合に移動する割合と比較する。
+
+python3 bench_cluster.py --nodes 3 --rooms 300
+"""
+
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import protocol
+from bench_load import CREATE_ROOM_NUM, JOIN_ROOM_NUM, REQUEST_COMPLETION
+from bench_load import SimulatedUser, recv_exactly
+from cluster import format_node
+
+REDIRECT_RESPONSE = 4
+BASE_PORT = 9102
+
+
+def node_address(index):
+    return ("127.0.0.1", BASE_PORT + index * 10, BASE_PORT + index * 10 + 1)
+
+
+def start_node(index, nodes_file, server_args=""):
+    _, tcp_port, udp_port = node_address(index)
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "server.py",
+            "--tcp-port",
+            str(tcp_port),
+            "--udp-port",
+            str(udp_port),
+            "--cluster-file",
+            nodes_file,
+            "--log-level",
+            "WARNING",
+            *server_args.split(),
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def write_nodes(path, count):
+    with open(path, "w", encoding="utf-8") as f:
+        for index in range(count):
+            f.write(format_node(node_address(index)) + "\n")
+
+
+def handshake(tcp_address, room_name, operation, user):
+    """1回のハンドシェイクを行い、(state, レスポンスの辞書)を返す"""
+    with socket.create_connection(tcp_address) as sock:
+        payload = protocol.encode_join_request(user.name, user.address)
+        sock.sendall(
+            protocol.encode_handshake_request(room_name, operation, 0, payload)
+        )
+        header = recv_exactly(sock, protocol.HANDSHAKE_HEADER_SIZE)
+        _, _, state, payload_size = struct.unpack_from(
+            protocol.HANDSHAKE_HEADER_FORMAT, header
+        )
+        payload = recv_exactly(sock, int.from_bytes(payload_size, "big"))
+        return state, protocol.decode_join_response(payload, operation, room_name)
+
+
+def join_via(tcp_address, room_name, operation, user):
+    """リダイレクトをたどって部屋を作成・参加し、(担当ノード, リダイレクト回数)を返す"""
+    redirects = 0
+    node = (*tcp_address, None)
+    while True:
+        state, response = handshake(tcp_address, room_name, operation, user)
+        if state != REDIRECT_RESPONSE:
+            break
+        redirects += 1
+        node = response["redirect"]
+        tcp_address = node[:2]
+    if state != REQUEST_COMPLETION:
+        raise RuntimeError(f"{room_name}: {response['message']}")
+    user.token = response["token"]
+    return tuple(node), redirects
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster benchmark")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--rooms", type=int, default=300)
+    parser.add_argument("--settle", type=float, default=2.5, help="ノード追加後に待つ秒数")
+    parser.add_argument("--server-args", default="", help="server.pyに渡すその他の引数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="chat-cluster-") as workdir:
+        nodes_file = os.path.join(workdir, "nodes.txt")
+        write_nodes(nodes_file, args.nodes)
+        processes = [
+            start_node(i, nodes_file, args.server_args) for i in range(args.nodes)
+        ]
+        time.sleep(1)
+        try:
+            entry = node_address(0)[:2]
+            hosts = {}
+            owners = {}
+            redirects = 0
+            start = time.perf_counter()
+            for i in range(args.rooms):
+                room_name = f"cluster-room-{i}"
+                user = SimulatedUser(i, room_name)
+                owner, hops = join_via(entry, room_name, CREATE_ROOM_NUM, user)
+                redirects += hops
+                hosts[room_name] = user
+                owners[room_name] = owner if hops else node_address(0)
+            handshake_seconds = time.perf_counter() - start
+
+            # 担当ノードのUDPポートで中継されることを確認する
+            room_name = "cluster-room-0"
+            guest = SimulatedUser(args.rooms, room_name)
+            join_via(entry, room_name, JOIN_ROOM_NUM, guest)
+            host = hosts[room_name]
+            host.sock.sendto(
+                protocol.encode_chat_datagram(room_name, host.token, "hello"),
+                owners[room_name][::2],
+            )
+            guest.sock.settimeout(1)
+            relayed = guest.sock.recv(4096).decode("utf-8")
+            guest.sock.close()
+
+            # ノードを1つ追加して、担当が移った部屋のホストに届く通知を数える
+            processes.append(start_node(args.nodes, nodes_file, args.server_args))
+            time.sleep(1)
+            write_nodes(nodes_file, args.nodes + 1)
+            time.sleep(args.settle)
+            moved = 0
+            for room_name, user in hosts.items():
+                while True:
+                    try:
+                        data = user.sock.recv(4096)
+                    except BlockingIOError:
+                        break
+                    if "のサーバーに移動したため" in data.decode("utf-8", "replace"):
+                        moved += 1
+                user.sock.close()
+
+            # 剰余で担当を決めた場合に移動する部屋の数
+            modulo_moved = sum(
+                zlib.crc32(name.encode("utf-8")) % args.nodes
+                != zlib.crc32(name.encode("utf-8")) % (args.nodes + 1)
+                for name in hosts
+            )
+            counts = {}
+            for owner in owners.values():
+                counts[format_node(owner)] = counts.get(format_node(owner), 0) + 1
+            result = {
+                "nodes": args.nodes,
+                "rooms": args.rooms,
+                "rooms_per_node": counts,
+                "redirects": redirects,
+                "handshake_seconds": handshake_seconds,
+                "relayed_on_owner": relayed,
+                "rooms_moved_on_join": moved,
+                "moved_fraction": moved / args.rooms,
+                "expected_fraction": 1 / (args.nodes + 1),
+                "modulo_moved_fraction": modulo_moved / args.rooms,
+            }
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""中継の圧縮(compression.py)のCPU時間と削減できるバイト数のベンチマーク
+
+短いチャットメッセージと、貼り付けたコード(このリポジトリの.pyファイルの一部)が混ざった
+メッセージを部屋の中継と同じ順に圧縮し、圧縮の設定ごとに1メッセージあたりのCPU時間(サーバーの圧縮と
+クライアントの展開)と、送信するバイト数の削減率を比較する。サーバーは1メッセージを1回だけ圧縮して
+全員に同じバイト列を送るため、CPU時間は送信先の数に関わらず一定で、削減できるバイト数は送信先の数に比例する。
+
+python3 bench_compression.py [--messages 20000] [--paste-ratio 0.1] [--recipients 50]
+"""
+
+import argparse
+import glob
+import os
+import random
+import time
+
+import compression
+import protocol
+
+WORDS = (
+    "おはよう こんにちは ありがとう 了解です 今日 明日 会議 資料 確認 します "
+    "lgtm ok thanks deploy review merge branch test server client room message"
+).split()
+
+
+def generate_messages(num_messages, paste_ratio, seed=1):
+    """部屋に中継される「ユーザー名: メッセージ」を生成する"""
+    rng = random.Random(seed)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    sources = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.py"))):
+        with open(path, encoding="utf-8") as f:
+            sources.append(f.read().splitlines())
+    names = [f"user{i}" for i in range(8)]
+    messages = []
+    for _ in range(num_messages):
+        prefix = f"{rng.choice(names)}: "
+        if rng.random() < paste_ratio:
+            lines = rng.choice(sources)
+            start = rng.randrange(max(len(lines) - 40, 1))
+            text = "\n".join(lines[start : start + rng.randint(5, 40)])
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+        messages.append((prefix + text).encode("utf-8")[: protocol.FRAGMENT_SIZE])
+    return messages
+
+
+def run(messages, min_size, level, use_dictionary):
+    """1つの設定で全メッセージを圧縮・展開する"""
+    compressor = compression.RoomCompressor(min_size=min_size, level=level)
+    decompressor = compression.Decompressor()
+    raw_bytes = 0
+    sent_bytes = 0
+    compressed_count = 0
+    compress_seconds = 0.0
+    decompress_seconds = 0.0
+    for payload in messages:
+        if use_dictionary and compressor.observe(payload):
+            decompressor.add_dictionary(compressor.dictionary_frame())
+        start = time.perf_counter()
+        frame = compressor.compress(payload)
+        compress_seconds += time.perf_counter() - start
+        raw_bytes += len(payload)
+        sent_bytes += len(frame)
+        if frame is not payload:
+            compressed_count += 1
+            start = time.perf_counter()
+            _, restored = decompressor.decompress(frame)
+            decompress_seconds += time.perf_counter() - start
+            assert restored == payload
+    return {
+        "min_size": min_size,
+        "level": level,
+        "dictionary": use_dictionary,
+        "compressed_messages": compressed_count,
+        "bytes_saved_ratio": 1 - sent_bytes / raw_bytes,
+        "compress_us_per_message": compress_seconds / len(messages) * 1e6,
+        "decompress_us_per_compressed": (
+            decompress_seconds / compressed_count * 1e6 if compressed_count else 0.0
+        ),
+        "raw_bytes": raw_bytes,
+        "sent_bytes": sent_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay compression benchmark")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument(
+        "--paste-ratio", type=float, default=0.1, help="貼り付けたコードの割合"
+    )
+    parser.add_argument(
+        "--recipients", type=int, default=50, help="1メッセージあたりの送信先の数"
+    )
+    args = parser.parse_args()
+
+    messages = generate_messages(args.messages, args.paste_ratio)
+    print(
+        f"{'min':>5} {'level':>5} {'dict':>5} {'saved':>7} "
+        f"{'comp us':>8} {'decomp us':>9} {'KB saved/CPU ms':>16}"
+    )
+    for min_size, level, use_dictionary in [
+        (0, 6, False),
+        (0, 6, True),
+        (256, 1, True),
+        (256, 6, False),
+        (256, 6, True),
+        (256, 9, True),
+        (1024, 6, True),
+    ]:
+        result = run(messages, min_size, level, use_dictionary)
+        # 送信先の数だけ削減できるバイト数を、サーバーで1回だけ圧縮するCPU時間で割る
+        saved = (result["raw_bytes"] - result["sent_bytes"]) * args.recipients
+        cpu_ms = result["compress_us_per_message"] * len(messages) / 1000
+        print(
+            f"{min_size:>5} {level:>5} {str(use_dictionary):>5} "
+            f"{result['bytes_saved_ratio']:>6.1%} "
+            f"{result['compress_us_per_message']:>8.2f} "
+            f"{result['decompress_us_per_compressed']:>9.2f} "
+            f"{saved / 1024 / max(cpu_ms, 1e-9):>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
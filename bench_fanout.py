@@ -0,0 +1,90 @@
+"""1000人の部屋への中継性能と、送信先一覧への入退室の時間を計測するベンチマーク
+
+入退室は --churn 人を送信先一覧に追加してから半数を削除し、1人あたりの時間を表示する。
+
+python3 bench_fanout.py [--members 1000] [--messages 200] [--churn 100000]
+"""
+
+import argparse
+import socket
+import time
+
+from fanout import FanOut, RecipientList
+from member import Member
+
+
+def naive_fanout(sock, message, tokens_to_addrs, sender_token):
+    """従来の中継処理(送信先ごとにエンコードしてsendto)"""
+    for token_key, user_address in tokens_to_addrs.items():
+        if sender_token != token_key:
+            sock.sendto(message.encode("utf-8"), tuple(user_address))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--churn", type=int, default=100000)
+    args = parser.parse_args()
+
+    receivers = []
+    tokens_to_addrs = {}
+    recipients = RecipientList()
+    members = []
+    for i in range(args.members):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receivers.append(receiver)
+        address = receiver.getsockname()
+        tokens_to_addrs[f"token{i}"] = list(address)
+        members.append(Member(f"token{i}", f"user{i}", address, None))
+        recipients.add(members[-1])
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    message = "alice: " + "hello " * 10
+    total = args.messages * (args.members - 1)
+
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        naive_fanout(sender, message, tokens_to_addrs, "token0")
+    naive = total / (time.perf_counter() - start)
+    print(f"naive sendto loop : {naive:12.0f} recipients/s")
+
+    fallback = FanOut(sender)
+    fallback.use_sendmmsg = False
+    for _ in range(args.messages):
+        fallback.send(message.encode("utf-8"), recipients, members[0])
+    print(f"encode-once sendto: {fallback.recipients_per_second():12.0f} recipients/s")
+
+    fanout = FanOut(sender)
+    if fanout.use_sendmmsg:
+        for _ in range(args.messages):
+            fanout.send(message.encode("utf-8"), recipients, members[0])
+        print(f"sendmmsg batches  : {fanout.recipients_per_second():12.0f} recipients/s")
+    else:
+        print("sendmmsg is not available on this platform")
+
+    for receiver in receivers:
+        receiver.close()
+    sender.close()
+
+    # 入退室(参加が集中したときの送信先一覧の更新)
+    churn = RecipientList()
+    members = [
+        Member(f"token{i}", f"user{i}", ("127.0.0.1", 10000 + i % 50000), None)
+        for i in range(args.churn)
+    ]
+    start = time.perf_counter()
+    for member in members:
+        churn.add(member)
+    add_us = (time.perf_counter() - start) / args.churn * 1e6
+    start = time.perf_counter()
+    for member in members[::2]:
+        churn.remove(member)
+    remove_us = (time.perf_counter() - start) / len(members[::2]) * 1e6
+    print(f"recipient add     : {add_us:12.2f} us/member")
+    print(f"recipient remove  : {remove_us:12.2f} us/member")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""大きなメッセージの分割送信(fragment.py)のベンチマーク
+
+1人の送信者が数KB〜数十KBのメッセージを分割して送信し、同じ部屋の受信者が断片を組み立てて
+揃ったメッセージ数、送信から組み立て完了までのレイテンシ(p50/p99)とスループットを計測する。
+--loss を指定すると受信側で断片を捨て、揃わなかったメッセージがtimeoutで破棄されることを確認できる。
+
+python3 bench_fragment.py --size 16384 --messages 500 --receivers 5
+"""
+
+import argparse
+import json
+import os
+import random
+import selectors
+import subprocess
+import sys
+import time
+
+import protocol
+from bench_load import SimulatedUser, percentile
+from bench_reliable import join_room
+from fragment import Reassembler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fragmented message benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9003)
+    parser.add_argument("--receivers", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--size", type=int, default=16384, help="メッセージのバイト数")
+    parser.add_argument("--rate", type=float, default=200, help="messages/s")
+    parser.add_argument("--loss", type=float, default=0.0, help="受信側で捨てる断片の割合")
+    parser.add_argument("--drain", type=float, default=2, help="送信後に受信を待つ秒数")
+    parser.add_argument(
+        "--server-args", default="", help="サーバーを起動する場合のserver.pyの引数"
+    )
+    parser.add_argument("--no-server", action="store_true", help="起動済みのサーバーを使う")
+    args = parser.parse_args()
+
+    server_process = None
+    if not args.no_server:
+        server_process = subprocess.Popen(
+            [sys.executable, "server.py", *args.server_args.split()],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+        )
+        time.sleep(1)
+    try:
+        rng = random.Random(1)
+        room_name = "bench-fragment"
+        udp_address = (args.host, args.udp_port)
+        users = [SimulatedUser(i, room_name) for i in range(args.receivers + 1)]
+        join_room((args.host, args.tcp_port), room_name, users, 0)
+        sender, receivers = users[0], users[1:]
+        header = protocol.encode_chat_datagram(room_name, sender.token, "")
+
+        selector = selectors.DefaultSelector()
+        reassemblers = {}
+        for user in receivers:
+            selector.register(user.sock, selectors.EVENT_READ, user)
+            reassemblers[user.name] = Reassembler(timeout=1.0)
+
+        filler = b"x" * args.size
+        sent_at = {}
+        latencies = []
+        fragments = 0
+        complete = 0
+        interval = 1 / args.rate
+        start = time.monotonic()
+        sent = 0
+        while True:
+            now = time.monotonic()
+            if sent >= args.messages and now > start + sent * interval + args.drain:
+                break
+            if complete == args.messages * len(receivers):
+                break
+            while sent < args.messages and start + sent * interval <= now:
+                sent_at[sent] = time.monotonic()
+                for control in protocol.encode_fragment_controls(sent, filler):
+                    sender.sock.sendto(header + control, udp_address)
+                sent += 1
+            for key, _ in selector.select(timeout=0.01):
+                user = key.data
+                while True:
+                    try:
+                        data = user.sock.recv(65536)
+                    except BlockingIOError:
+                        break
+                    if not (
+                        protocol.is_control(data) and data[1] == protocol.FRAME_FRAGMENT
+                    ):
+                        continue
+                    fragments += 1
+                    if rng.random() < args.loss:
+                        continue
+                    prefix, message_id, index, count, total, chunk = (
+                        protocol.decode_fragment_frame(data)
+                    )
+                    message = reassemblers[user.name].add(
+                        (prefix, message_id),
+                        index,
+                        count,
+                        total,
+                        chunk,
+                        time.monotonic(),
+                    )
+                    if message is not None:
+                        complete += 1
+                        latencies.append(time.monotonic() - sent_at[message_id])
+        elapsed = time.monotonic() - start
+        for reassembler in reassemblers.values():
+            reassembler.expire(float("inf"))
+        latencies.sort()
+        result = {
+            "config": {
+                "size": args.size,
+                "messages": args.messages,
+                "receivers": args.receivers,
+                "rate": args.rate,
+                "loss": args.loss,
+                "server_args": args.server_args,
+            },
+            "fragments_per_message": -(-args.size // protocol.FRAGMENT_SIZE),
+            "fragments_received": fragments,
+            "messages_expected": args.messages * len(receivers),
+            "messages_complete": complete,
+            "messages_dropped": sum(r.dropped for r in reassemblers.values()),
+            "goodput_mb_per_second": complete * args.size / elapsed / 1e6,
+            "latency_ms": {
+                "p50": (percentile(latencies, 0.50) or 0) * 1000,
+                "p99": (percentile(latencies, 0.99) or 0) * 1000,
+            },
+        }
+        print(json.dumps(result, indent=2))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""ホットリスタート(handover.py)で新しいプロセスに引き継ぐ時間と、その間に失われる中継を計測するベンチマーク
+
+--handover を指定したサーバーを起動し、--members 人のユーザーを --rooms 個の部屋に参加させる。
+1つの部屋で --interval 秒ごとにメッセージを送りながら --takeover で新しいプロセスを起動し、
+両方のプロセスが表示する引き継ぎの時間と、受信側で見た中継の途切れた時間・届かなかったメッセージ数を表示する。
+
+python3 bench_handover.py [--members 100000] [--rooms 1000] [--server-args "--coalesce-ms 5"]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from async_client import AsyncChatClient
+
+BATCH = 1000
+
+
+def start_server(args, *extra):
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "server.py",
+            "--tcp-port",
+            str(args.tcp_port),
+            "--udp-port",
+            str(args.udp_port),
+            "--handover",
+            args.path,
+            "--log-level",
+            "OFF",
+            *args.server_args.split(),
+            *extra,
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        # 新しいプロセスはterminateで止めるため、表示をバッファに溜めない
+        env=dict(os.environ, PYTHONUNBUFFERED="1"),
+    )
+
+
+def output_lines(process):
+    """サーバーが表示した行(空行を除く)"""
+    return [line for line in process.stdout.read().splitlines() if line.strip()]
+
+
+async def run(args):
+    received = {}
+
+    def on_message(session, message):
+        # 計測用の部屋のメッセージは「probe: 番号」
+        name, _, body = message.partition(": ")
+        if name == "probe":
+            received.setdefault(session.name, []).append((int(body), time.perf_counter()))
+
+    async with AsyncChatClient(
+        tcp_port=args.tcp_port, udp_port=args.udp_port
+    ) as client:
+        per_room = args.members // args.rooms
+        start = time.perf_counter()
+        probe = await client.create_room("probe", "bench-handover-0", history=False)
+        await asyncio.gather(
+            *(
+                client.create_room(f"user{r}-0", f"bench-handover-{r}", history=False)
+                for r in range(1, args.rooms)
+            )
+        )
+        names = [
+            (f"user{r}-{i}", f"bench-handover-{r}")
+            for r in range(args.rooms)
+            for i in range(1, per_room)
+        ]
+        for i in range(0, len(names), BATCH):
+            await asyncio.gather(
+                *(
+                    client.join_room(
+                        name,
+                        room_name,
+                        history=False,
+                        on_message=on_message if room_name == "bench-handover-0" else None,
+                    )
+                    for name, room_name in names[i : i + BATCH]
+                )
+            )
+        join_seconds = time.perf_counter() - start
+
+        sent = 0
+        new_server = None
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            sent += 1
+            probe.send(str(sent))
+            if new_server is None and time.perf_counter() - start > args.duration / 3:
+                new_server = start_server(args, "--takeover")
+            await asyncio.sleep(args.interval)
+        await asyncio.sleep(1)
+
+        gaps = []
+        lost = 0
+        for messages in received.values():
+            numbers = {n for n, _ in messages}
+            lost += sent - len(numbers)
+            times = [t for _, t in messages]
+            gaps.append(max(b - a for a, b in zip(times, times[1:])))
+        result = {
+            "config": vars(args),
+            "members": per_room * args.rooms,
+            "join_seconds": join_seconds,
+            "probe_receivers": len(received),
+            "probe_messages": sent,
+            "lost_deliveries": lost + sent * (per_room - 1 - len(received)),
+            "max_receive_gap_ms": max(gaps) * 1000 if gaps else None,
+        }
+        return new_server, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot restart handover benchmark")
+    parser.add_argument("--tcp-port", type=int, default=9212)
+    parser.add_argument("--udp-port", type=int, default=9213)
+    parser.add_argument("--path", default="/tmp/bench-handover.sock")
+    parser.add_argument("--members", type=int, default=100000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=6, help="計測用の部屋で送信する秒数")
+    parser.add_argument("--interval", type=float, default=0.002, help="計測用の送信間隔(秒)")
+    parser.add_argument("--server-args", default="", help="server.pyに追加する引数")
+    args = parser.parse_args()
+
+    old_server = start_server(args)
+    new_server = None
+    time.sleep(1)
+    try:
+        new_server, result = asyncio.run(run(args))
+        old_server.wait(timeout=10)
+        result["old_process"] = output_lines(old_server)
+    finally:
+        for process in (old_server, new_server):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+    result["new_process"] = output_lines(new_server)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""ハンドシェイクのペイロード(JSON形式とバイナリ形式)のエンコード・デコード性能とサイズを比較する
+
+python3 bench_handshake_codec.py [--iterations 100000]
+"""
+
+import argparse
+import secrets
+import timeit
+
+import protocol
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    user_name = "alice"
+    user_address = ("127.0.0.1", 54321)
+    token = secrets.token_hex(32)
+    room_name = "room"
+
+    print(f"{'':24}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for binary in (False, True):
+        label = "binary" if binary else "json"
+
+        request = protocol.encode_join_request(user_name, user_address, binary)
+        encode = timeit.timeit(
+            lambda: protocol.encode_join_request(user_name, user_address, binary),
+            number=args.iterations,
+        )
+        decode = timeit.timeit(
+            lambda: protocol.decode_join_request(request), number=args.iterations
+        )
+        print(
+            f"{label + ' request':24}{len(request):8}"
+            f"{encode / args.iterations * 1e6:12.2f}"
+            f"{decode / args.iterations * 1e6:12.2f}"
+        )
+
+        response = protocol.encode_join_response(
+            protocol.STATUS_COMPLETED, token, 1, room_name, binary
+        )
+        encode = timeit.timeit(
+            lambda: protocol.encode_join_response(
+                protocol.STATUS_COMPLETED, token, 1, room_name, binary
+            ),
+            number=args.iterations,
+        )
+        decode = timeit.timeit(
+            lambda: protocol.decode_join_response(response, 1, room_name),
+            number=args.iterations,
+        )
+        print(
+            f"{label + ' response':24}{len(response):8}"
+            f"{encode / args.iterations * 1e6:12.2f}"
+            f"{decode / args.iterations * 1e6:12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""負荷生成・レイテンシ計測のベンチマーク
+
+実際のプロトコル(protocol.py)でハンドシェイクとメッセージ送信を行う多数の模擬ユーザーを生成し、
+中継スループット、送信から受信までのレイテンシ(p50/p99/p999)、パケットロス、
+サーバーのCPU時間・RSSを計測して結果をJSONで出力する。
+
+python3 bench_load.py --users 2000 --rooms 20 --rate 2000 --duration 10 --output result.json
+python3 bench_load.py --server-pid 1234   # 起動済みのサーバーを計測する場合
+"""
+
+import argparse
+import json
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import protocol
+
+CREATE_ROOM_NUM = 1
+JOIN_ROOM_NUM = 2
+REQUEST_COMPLETION = 2
+# 計測用メッセージの先頭
+BENCH_PREFIX = "bench"
+
+
+class SimulatedUser:
+    """input()を使わずに動作する模擬ユーザー"""
+
+    def __init__(self, index, room_name):
+        self.name = f"user{index}"
+        self.room_name = room_name
+        self.token = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by server.")
+        data += chunk
+    return bytes(data)
+
+
+def join_rooms(tcp_address, users_by_room):
+    """Clientと同じハンドシェイクで全ユーザーを部屋に参加させる
+
+    Args:
+        tcp_address (tuple): サーバーのTCPアドレス
+        users_by_room (dict): 部屋名:SimulatedUserのリスト
+    """
+    for room_name, users in users_by_room.items():
+        with socket.create_connection(tcp_address) as sock:
+            for i, user in enumerate(users):
+                operation = CREATE_ROOM_NUM if i == 0 else JOIN_ROOM_NUM
+                payload = protocol.encode_join_request(user.name, user.address)
+                sock.sendall(
+                    protocol.encode_handshake_request(room_name, operation, 0, payload)
+                )
+            # 1つの接続でまとめて送ったリクエストのレスポンスを順に受け取る
+            for user in users:
+                header = recv_exactly(sock, protocol.HANDSHAKE_HEADER_SIZE)
+                _, _, state, payload_size = struct.unpack_from(
+                    protocol.HANDSHAKE_HEADER_FORMAT, header
+                )
+                payload = recv_exactly(sock, int.from_bytes(payload_size, "big"))
+                response = protocol.decode_join_response(payload, 0, room_name)
+                if state != REQUEST_COMPLETION:
+                    raise RuntimeError(f"{user.name}: {response['message']}")
+                user.token = response["token"]
+
+
+def read_process_usage(pid):
+    """プロセス(と子プロセス)のCPU時間[秒]とRSS[バイト]を/procから読む"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    cpu = 0.0
+    rss = 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    for target in pids:
+        try:
+            with open(f"/proc/{target}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{target}/statm") as f:
+                rss += int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+        # utime, stime は ")" 以降の12, 13番目
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, rss
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p))
+    return sorted_values[index]
+
+
+def send_messages(users, rate, duration, udp_address, counters):
+    """全ユーザーから順番に、指定したレートでメッセージを送信する"""
+    interval = 1 / rate
+    start = time.monotonic()
+    seq = 0
+    while time.monotonic() - start < duration:
+        user = users[seq % len(users)]
+        message = f"{BENCH_PREFIX} {time.monotonic_ns()} {seq}"
+        datagram = protocol.encode_chat_datagram(user.room_name, user.token, message)
+        # 送信元はユーザーのソケット(サーバーはトークンで送信者を識別する)
+        try:
+            user.sock.sendto(datagram, udp_address)
+            counters["sent"] += 1
+            counters["expected"] += counters["room_sizes"][user.room_name] - 1
+        except BlockingIOError:
+            counters["send_errors"] += 1
+        seq += 1
+        # 指定したレートになるように待つ
+        delay = start + seq * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online Chat Messenger load benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9003)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1000, help="messages/s")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--drain", type=float, default=2, help="送信後に受信を待つ秒数")
+    parser.add_argument("--server-pid", type=int, help="起動済みのサーバーのPID")
+    parser.add_argument(
+        "--server-args", default="", help="サーバーを起動する場合のserver.pyの引数"
+    )
+    parser.add_argument("--output", help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    server_process = None
+    server_pid = args.server_pid
+    if server_pid is None:
+        server_process = subprocess.Popen(
+            [sys.executable, "server.py", *args.server_args.split()],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+        )
+        server_pid = server_process.pid
+        time.sleep(1)
+
+    try:
+        users_by_room = {f"bench-room-{i}": [] for i in range(args.rooms)}
+        room_names = list(users_by_room)
+        users = []
+        for i in range(args.users):
+            user = SimulatedUser(i, room_names[i % args.rooms])
+            users_by_room[user.room_name].append(user)
+            users.append(user)
+
+        handshake_start = time.perf_counter()
+        join_rooms((args.host, args.tcp_port), users_by_room)
+        handshake_seconds = time.perf_counter() - handshake_start
+
+        selector = selectors.DefaultSelector()
+        for user in users:
+            selector.register(user.sock, selectors.EVENT_READ)
+
+        counters = {
+            "sent": 0,
+            "expected": 0,
+            "send_errors": 0,
+            "room_sizes": {name: len(members) for name, members in users_by_room.items()},
+        }
+        cpu_before, _ = read_process_usage(server_pid)
+        sender = threading.Thread(
+            target=send_messages,
+            args=(users, args.rate, args.duration, (args.host, args.udp_port), counters),
+        )
+        start = time.monotonic()
+        sender.start()
+
+        latencies = []
+        received = 0
+        datagrams = 0
+        last_received = start
+        while sender.is_alive() or time.monotonic() - start < args.duration + args.drain:
+            for key, _ in selector.select(timeout=0.1):
+                while True:
+                    try:
+                        data = key.fileobj.recv(65536)
+                    except BlockingIOError:
+                        break
+                    now = time.monotonic_ns()
+                    datagrams += 1
+                    # まとめ送りのフレームは1件ずつに分ける
+                    if protocol.is_control(data) and data[1] == protocol.FRAME_BATCH:
+                        messages = [m for _, m in protocol.decode_history_frame(data)]
+                    else:
+                        messages = [data]
+                    for message in messages:
+                        text = message.decode("utf-8", errors="replace")
+                        # 中継メッセージは "ユーザー名: メッセージ"
+                        _, _, body = text.partition(": ")
+                        fields = body.split()
+                        if len(fields) == 3 and fields[0] == BENCH_PREFIX:
+                            received += 1
+                            latencies.append(now - int(fields[1]))
+                            last_received = time.monotonic()
+        elapsed = max(last_received - start, 1e-9)
+        sender.join()
+        cpu_after, rss = read_process_usage(server_pid)
+
+        latencies.sort()
+        expected = counters["expected"]
+        result = {
+            "config": {
+                "users": args.users,
+                "rooms": args.rooms,
+                "rate": args.rate,
+                "duration": args.duration,
+                "server_args": args.server_args,
+            },
+            "handshake_seconds": handshake_seconds,
+            "messages_sent": counters["sent"],
+            "send_errors": counters["send_errors"],
+            "relays_expected": expected,
+            "relays_received": received,
+            "datagrams_received": datagrams,
+            "relay_throughput_per_second": received / elapsed,
+            "packet_loss": 1 - received / expected if expected else 0.0,
+            "latency_ms": {
+                "p50": (percentile(latencies, 0.50) or 0) / 1e6,
+                "p99": (percentile(latencies, 0.99) or 0) / 1e6,
+                "p999": (percentile(latencies, 0.999) or 0) / 1e6,
+                "max": (latencies[-1] if latencies else 0) / 1e6,
+            },
+            "server_cpu_seconds": cpu_after - cpu_before,
+            "server_rss_bytes": rss,
+        }
+        print(json.dumps(result, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == "__main__":
+    main()
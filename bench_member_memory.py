@@ -0,0 +1,139 @@
+"""部屋のユーザー管理に使うメモリ量(1ユーザーあたりのバイト数)を計測するベンチマーク
+
+python3 bench_member_memory.py [--rooms 10000] [--members 1000] [--sample-rooms 100]
+
+変更前のレイアウト(トークンをキーにした複数の辞書、中継用の送信先一覧のトークン・アドレスの
+リストと位置の辞書、サーバーのインデックスの値と無操作タイムアウトのキーの(部屋, トークン)の
+タプル)と、Memberを使う現在のChatRoomを比較する。現在のレイアウトではインデックスと
+タイミングホイールはMemberをそのまま参照する。
+ハンドシェイクのたびに作られるトークン・ユーザー名・アドレスも、部屋が保持し続ける分として計測に含める。
+全ユーザー分を作るとメモリが足りない環境でも計測できるよう、sample-rooms個の部屋だけを作り、
+rooms x members の規模に換算して表示する。
+"""
+
+import argparse
+import gc
+import secrets
+import socket
+import tracemalloc
+
+from chat_room import ChatRoom
+from message_history import MessageHistory
+
+
+class ParallelDictRoom:
+    """変更前のChatRoomのユーザー管理(トークンをキーにした複数の辞書)"""
+
+    def __init__(self, room_name):
+        self.name = room_name
+        self.users = {}
+        self.tokens_to_addrs = {}
+        self.token_to_user_name = {}
+        self.token_to_session_id = {}
+        # 中継用の送信先一覧
+        self.recipient_tokens = []
+        self.recipient_addrs = []
+        self.recipient_index = {}
+        # サーバーのインデックスの値と無操作タイムアウトのキー
+        self.index_values = []
+        self.idle_keys = []
+        self.messages = MessageHistory(
+            ChatRoom.HISTORY_CAPACITY, ChatRoom.HISTORY_MAX_BYTES
+        )
+
+    def add_client(self, token, user_address, user_name, session_id=None):
+        # 変更前はトークンを16進数文字列のまま保持していた
+        token = token.hex()
+        self.tokens_to_addrs[token] = user_address
+        self.token_to_user_name[token] = user_name
+        if session_id is not None:
+            self.token_to_session_id[token] = session_id
+        self.recipient_index[token] = len(self.recipient_addrs)
+        self.recipient_tokens.append(token)
+        self.recipient_addrs.append(user_address)
+        self.index_values.append((self, token))
+        self.idle_keys.append((self.name, token))
+
+
+class MemberRoom(ChatRoom):
+    """現在のChatRoomに、サーバーのインデックスと無操作タイムアウトからの参照を加えたもの"""
+
+    def __init__(self, room_name):
+        super().__init__(room_name)
+        self.index_values = []
+        self.idle_keys = []
+
+    def add_client(self, token, user_address, user_name, session_id=None):
+        member = super().add_client(token, user_address, user_name, session_id)
+        self.index_values.append(member)
+        self.idle_keys.append(member)
+        return member
+
+
+def generate_inputs(num_rooms, num_members):
+    """ハンドシェイクで受け取るユーザー名・アドレス(エンコード済み)を生成する"""
+    inputs = []
+    for i in range(num_rooms):
+        members = []
+        for j in range(num_members):
+            user_name = f"user{i}-{j}".encode("utf-8")
+            host = socket.inet_aton(f"10.{i % 256}.{j // 256}.{j % 256}")
+            members.append((user_name, host, 10000 + j))
+        inputs.append((f"room-{i}", members))
+    return inputs
+
+
+def measure(room_class, inputs):
+    """ハンドシェイクと同じようにデコードしながら部屋を作成し、増えたメモリ量を返す"""
+    gc.collect()
+    tracemalloc.start()
+    rooms = []
+    session_id = 0
+    for room_name, members in inputs:
+        room = room_class(room_name)
+        for user_name, host, port in members:
+            session_id += 1
+            address = (socket.inet_ntoa(host), port)
+            room.add_client(
+                secrets.token_bytes(32), address, user_name.decode("utf-8"), session_id
+            )
+        rooms.append(room)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rooms
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=10000)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument(
+        "--sample-rooms", type=int, default=100, help="実際に作成する部屋数"
+    )
+    args = parser.parse_args()
+
+    # 部屋の最大人数を超える場合は計測できないようにする
+    if args.members > ChatRoom(" ").max_users:
+        parser.error(f"--members must be <= {ChatRoom(' ').max_users}")
+    sample_rooms = min(args.sample_rooms, args.rooms)
+    inputs = generate_inputs(sample_rooms, args.members)
+    sample_members = sample_rooms * args.members
+    total_members = args.rooms * args.members
+
+    for label, room_class in (
+        ("parallel dicts", ParallelDictRoom),
+        ("Member records", MemberRoom),
+    ):
+        size = measure(room_class, inputs)
+        per_member = size / sample_members
+        print(
+            f"{label}: {per_member:7.1f} bytes/member, "
+            f"{per_member * total_members / 2**30:6.2f} GiB "
+            f"for {args.rooms} rooms x {args.members} members"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""部屋への中継を、ユニキャスト(FanOut)とマルチキャストグループ(multicast.py)で比較するベンチマーク
+
+部屋の人数ごとに、受信用のソケットを作って1通ずつ中継し、送信側の1メッセージあたりの時間とCPU時間、
+受信できたデータグラムの割合を表示する。マルチキャストはループバック(127.0.0.1)で送受信する。
+
+python3 bench_multicast.py [--members 10 100 1000] [--messages 100]
+"""
+
+import argparse
+import select
+import socket
+import time
+
+import multicast
+import protocol
+from fanout import FanOut, RecipientList
+from member import Member
+
+GROUP_NETWORK = "239.255.42.0/24"
+GROUP_PORT = 9504
+
+
+def drain(receivers):
+    """受信用のソケットに届いているデータグラムを読み捨てて数える"""
+    received = 0
+    for receiver in receivers:
+        while True:
+            try:
+                receiver.recv(2048)
+            except BlockingIOError:
+                break
+            received += 1
+    return received
+
+
+def measure(send, receivers, messages, batch):
+    """batch通ずつ送信しては受信側を空にし、送信にかかった時間を計測する
+
+    Returns:
+        tuple: (1メッセージあたりの経過時間[us], CPU時間[us], 受信できたデータグラム数)
+    """
+    wall = cpu = 0.0
+    received = 0
+    for start in range(0, messages, batch):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(min(batch, messages - start)):
+            send()
+        wall += time.perf_counter() - wall_start
+        cpu += time.process_time() - cpu_start
+        # ループバックの受信処理が終わるのを待つ
+        select.select(receivers[:1], [], [], 0.05)
+        time.sleep(0.01)
+        received += drain(receivers)
+    return wall / messages * 1e6, cpu / messages * 1e6, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multicast relay benchmark")
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=20, help="受信側を空にするまでに送る数")
+    args = parser.parse_args()
+
+    groups = multicast.MulticastGroups(GROUP_NETWORK, GROUP_PORT)
+    group = groups.group_of("bench-multicast")
+    message = ("alice: " + "hello " * 10).encode("utf-8")
+    frame = protocol.encode_multicast_frame(b"bench-multicast", [1], message)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    fanout = FanOut(sender)
+
+    print(f"{'members':>8} {'mode':>10} {'us/msg':>9} {'cpu us/msg':>11} {'delivered':>10}")
+    for count in args.members:
+        unicast_receivers = []
+        recipients = RecipientList()
+        members = []
+        for i in range(count):
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver.bind(("127.0.0.1", 0))
+            receiver.setblocking(False)
+            unicast_receivers.append(receiver)
+            members.append(Member(f"token{i}", f"user{i}", receiver.getsockname(), None))
+            recipients.add(members[-1])
+        multicast_receivers = [
+            multicast.open_receiver(group, "127.0.0.1") for _ in range(count)
+        ]
+        expected = args.messages * count
+        results = (
+            (
+                "unicast",
+                lambda: fanout.send(message, recipients, members[0]),
+                unicast_receivers,
+                expected - args.messages,
+            ),
+            (
+                "multicast",
+                lambda: groups.send(frame, group),
+                multicast_receivers,
+                expected,
+            ),
+        )
+        for mode, send, receivers, total in results:
+            wall, cpu, received = measure(send, receivers, args.messages, args.batch)
+            print(
+                f"{count:>8} {mode:>10} {wall:>9.1f} {cpu:>11.1f} "
+                f"{received / total:>10.1%}"
+            )
+        for receiver in unicast_receivers + multicast_receivers:
+            receiver.close()
+    sender.close()
+    groups.close()
+
+
+if __name__ == "__main__":
+    main()
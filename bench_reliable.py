@@ -0,0 +1,210 @@
+"""再送・順序保証付きの中継(reliable.py)のベンチマーク
+
+1人の送信者と複数の受信者で部屋を作り、受信者側で受信したデータグラムと送信する確認応答を
+指定した確率で捨てて(パケットロスを模擬して)、これまでどおりの中継と再送・順序保証付きの中継の
+グッドプット(順番どおりに表示できたメッセージ数/秒)と到達率を比較する。
+
+python3 bench_reliable.py --receivers 10 --messages 2000 --rate 500 --loss 0.01 0.05
+"""
+
+import argparse
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import protocol
+from bench_load import CREATE_ROOM_NUM, JOIN_ROOM_NUM, REQUEST_COMPLETION
+from bench_load import SimulatedUser, recv_exactly
+from reliable import ReliableReceiver
+
+BENCH_PREFIX = "reliable"
+
+
+def join_room(tcp_address, room_name, users, flags):
+    """1つの接続で部屋を作成し、残りのユーザーを参加させる"""
+    with socket.create_connection(tcp_address) as sock:
+        for i, user in enumerate(users):
+            operation = CREATE_ROOM_NUM if i == 0 else JOIN_ROOM_NUM
+            payload = protocol.encode_join_request(user.name, user.address, True, flags)
+            sock.sendall(
+                protocol.encode_handshake_request(room_name, operation, 0, payload)
+            )
+        for user in users:
+            header = recv_exactly(sock, protocol.HANDSHAKE_HEADER_SIZE)
+            _, _, state, payload_size = struct.unpack_from(
+                protocol.HANDSHAKE_HEADER_FORMAT, header
+            )
+            payload = recv_exactly(sock, int.from_bytes(payload_size, "big"))
+            response = protocol.decode_join_response(payload, 0, room_name)
+            if state != REQUEST_COMPLETION:
+                raise RuntimeError(f"{user.name}: {response['message']}")
+            user.token = response["token"]
+
+
+def run(args, loss, reliable):
+    """1つの条件で計測する
+
+    Args:
+        loss (float): 受信者側で捨てるデータグラム(確認応答を含む)の割合
+        reliable (bool): 再送・順序保証付きで受け取るかどうか
+
+    Returns:
+        dict: 計測結果
+    """
+    rng = random.Random(args.seed)
+    mode = "reliable" if reliable else "best_effort"
+    room_name = f"bench-reliable-{mode}-{loss}"
+    udp_address = (args.host, args.udp_port)
+    users = [SimulatedUser(i, room_name) for i in range(args.receivers + 1)]
+    flags = protocol.FLAG_RELIABLE if reliable else 0
+    join_room((args.host, args.tcp_port), room_name, users, flags)
+    sender, receivers = users[0], users[1:]
+
+    selector = selectors.DefaultSelector()
+    state = {}
+    for user in receivers:
+        selector.register(user.sock, selectors.EVENT_READ, user)
+        state[user.name] = {
+            "receiver": ReliableReceiver() if reliable else None,
+            "delivered": 0,
+            "next": 0,
+            "out_of_order": 0,
+        }
+
+    def acknowledge(user, receiver):
+        if rng.random() < loss:
+            return
+        cumulative, ranges = receiver.ack()
+        datagram = protocol.encode_chat_datagram(
+            user.room_name, user.token, ""
+        ) + protocol.encode_ack_control(cumulative, ranges, receiver.epoch)
+        user.sock.sendto(datagram, udp_address)
+
+    def deliver(user, data):
+        # まとめ送りのフレームは1件ずつに分ける
+        if protocol.is_control(data) and data[1] == protocol.FRAME_BATCH:
+            messages = [m for _, m in protocol.decode_history_frame(data)]
+        else:
+            messages = [data]
+        entry = state[user.name]
+        for message in messages:
+            text = message.decode("utf-8", errors="replace")
+            _, _, body = text.partition(": ")
+            fields = body.split()
+            if len(fields) != 2 or fields[0] != BENCH_PREFIX:
+                continue
+            index = int(fields[1])
+            entry["delivered"] += 1
+            if index < entry["next"]:
+                entry["out_of_order"] += 1
+            entry["next"] = max(entry["next"], index + 1)
+
+    interval = 1 / args.rate
+    total = args.messages * len(receivers)
+    start = time.monotonic()
+    last_delivery = start
+    sent = 0
+    deadline = start + args.messages / args.rate + args.drain
+    delivered = 0
+    while time.monotonic() < deadline and delivered < total:
+        now = time.monotonic()
+        while sent < args.messages and start + sent * interval <= now:
+            message = f"{BENCH_PREFIX} {sent}"
+            sender.sock.sendto(
+                protocol.encode_chat_datagram(room_name, sender.token, message),
+                udp_address,
+            )
+            sent += 1
+        timeout = 0.05
+        if sent < args.messages:
+            timeout = max(start + sent * interval - time.monotonic(), 0)
+        for key, _ in selector.select(timeout=timeout):
+            user = key.data
+            entry = state[user.name]
+            while True:
+                try:
+                    data = user.sock.recv(65536)
+                except BlockingIOError:
+                    break
+                if rng.random() < loss:
+                    continue
+                before = entry["delivered"]
+                if (
+                    reliable
+                    and protocol.is_control(data)
+                    and data[1] == protocol.FRAME_RELIABLE
+                ):
+                    epoch, seq, inner = protocol.decode_reliable_frame(data)
+                    for payload in entry["receiver"].receive(seq, inner, epoch):
+                        deliver(user, payload)
+                    acknowledge(user, entry["receiver"])
+                else:
+                    deliver(user, data)
+                if entry["delivered"] != before:
+                    delivered += entry["delivered"] - before
+                    last_delivery = time.monotonic()
+
+    # 部屋を閉じる(ホストの退出)
+    sender.sock.sendto(
+        protocol.encode_chat_datagram(room_name, sender.token, "exit"), udp_address
+    )
+    elapsed = max(last_delivery - start, 1e-9)
+    for user in users:
+        user.sock.close()
+    return {
+        "mode": mode,
+        "loss": loss,
+        "messages_expected": total,
+        "messages_delivered": delivered,
+        "delivery_ratio": delivered / total,
+        "out_of_order": sum(entry["out_of_order"] for entry in state.values()),
+        "seconds": elapsed,
+        "goodput_per_second": delivered / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reliable relay benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9003)
+    parser.add_argument("--receivers", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="messages/s")
+    parser.add_argument("--loss", type=float, nargs="+", default=[0.01, 0.05])
+    parser.add_argument("--drain", type=float, default=5, help="送信後に受信を待つ最大秒数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-server", action="store_true", help="起動済みのサーバーを使う")
+    parser.add_argument(
+        "--server-args", default="", help="サーバーを起動する場合のserver.pyの引数"
+    )
+    args = parser.parse_args()
+
+    server_process = None
+    if not args.no_server:
+        server_process = subprocess.Popen(
+            [sys.executable, "server.py", *args.server_args.split()],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+        )
+        time.sleep(1)
+    try:
+        results = []
+        for loss in args.loss:
+            for reliable in (False, True):
+                results.append(run(args, loss, reliable))
+        print(json.dumps(results, indent=2))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == "__main__":
+    main()
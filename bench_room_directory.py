@@ -0,0 +1,69 @@
+"""部屋名の索引(room_directory.py)と、部屋の辞書を毎回走査する一覧のベンチマーク
+
+部屋数ごとに、索引への部屋の追加・削除と、前方一致で1ページ(MAX_PAGE件)を返す一覧の1回あたりの時間を、
+辞書を走査して並べ替えてから1ページを切り出す方法と比較する。
+
+python3 bench_room_directory.py [--rooms 1000 10000 100000] [--count 2000]
+"""
+
+import argparse
+import random
+import time
+
+from chat_room import ChatRoom
+from room_directory import RoomDirectory
+
+
+def measure(fn, count):
+    """fnをcount回呼んだときの1回あたりのマイクロ秒"""
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def scan_page(rooms, prefix, cursor, limit):
+    """索引を使わない一覧(部屋の辞書を走査して並べ替える)"""
+    names = sorted(name for name in rooms if name.startswith(prefix) and name > cursor)
+    return [(name, len(rooms[name].members)) for name in names[:limit]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Room directory benchmark")
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args()
+
+    limit = RoomDirectory.MAX_PAGE
+    print(
+        f"{'rooms':>8} {'add us':>8} {'remove us':>10} "
+        f"{'page us':>8} {'prefix us':>10} {'scan page us':>13} {'scan prefix us':>15}"
+    )
+    for count in args.rooms:
+        # 部屋名は「カテゴリ-番号」で、前方一致はカテゴリ(全体の1/16)で検索する
+        rooms = {}
+        for i in random.sample(range(count * 10), count):
+            name = f"{'abcdefghijklmnop'[i % 16]}-room-{i}"
+            rooms[name] = ChatRoom(name)
+        directory = RoomDirectory(rooms)
+        extra = [ChatRoom(f"x-room-{i}") for i in range(args.count)]
+        add = iter(extra)
+        remove = iter(extra)
+        add_us = measure(lambda: directory.add(next(add)), args.count)
+        remove_us = measure(lambda: directory.remove(next(remove).name), args.count)
+        cursor = directory.page("", "", limit)[1]
+        prefix_cursor = directory.page("c-", "", limit)[1]
+        assert directory.page("c-", prefix_cursor, limit)[0] == scan_page(
+            rooms, "c-", prefix_cursor, limit
+        )
+        print(
+            f"{count:>8} {add_us:>8.2f} {remove_us:>10.2f} "
+            f"{measure(lambda: directory.page('', cursor, limit), args.count):>8.1f} "
+            f"{measure(lambda: directory.page('c-', prefix_cursor, limit), args.count):>10.1f} "
+            f"{measure(lambda: scan_page(rooms, '', cursor, limit), 20):>13.1f} "
+            f"{measure(lambda: scan_page(rooms, 'c-', prefix_cursor, limit), 20):>15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""署名したトークン(signed_token.py)の発行・検証と、受信処理で偽造トークンを捨てるコストのベンチマーク
+
+TokenSignerの発行・検証にかかる時間と、Server.handle_datagramに偽造したトークン・正しいトークンの
+データグラムを渡したときの1件あたりの処理時間を、ランダムなトークンと署名したトークンで比較する。
+サーバーはソケットを開くだけで起動せず、中継先のいない部屋で受信処理だけを計測する。
+
+python3 bench_tokens.py [--count 100000]
+"""
+
+import argparse
+import secrets
+import time
+
+import protocol
+import signed_token
+from log import configure_logging
+from server import Server
+
+
+def measure(fn, count):
+    """fnをcount回呼んだときの1回あたりのマイクロ秒"""
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def bench_receive(signer, count, port):
+    """1つの設定でhandle_datagramの1件あたりの時間を計測する"""
+    server = Server(tcp_port=port, udp_port=port + 1)
+    server.tokens = signer
+    try:
+        header = protocol.HANDSHAKE_HEADER_SIZE
+        room_name = "bench-tokens"
+        payload = protocol.encode_join_request("user0", ("127.0.0.1", 9))
+        request = protocol.encode_handshake_request(room_name, 1, 0, payload)
+        response = server.process_handshake(request[:header], request[header:])
+        token = protocol.decode_join_response(response[header:], 1, room_name)["token"]
+        valid = protocol.encode_chat_datagram(room_name, token, "hello")
+        forged = [
+            protocol.encode_chat_datagram(room_name, secrets.token_hex(32), "hello")
+            for _ in range(1000)
+        ]
+        index = iter(range(count * 2))
+        return {
+            "valid_us": measure(lambda: server.handle_datagram(valid), count),
+            "forged_us": measure(
+                lambda: server.handle_datagram(forged[next(index) % 1000]), count
+            ),
+            "rejected": server.tokens_rejected.value if signer else 0,
+        }
+    finally:
+        server.tcp_socket.close()
+        server.udp_socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signed token benchmark")
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--port", type=int, default=9202, help="計測用サーバーのTCPポート")
+    args = parser.parse_args()
+    configure_logging("OFF")
+
+    signer = signed_token.TokenSigner([(1, secrets.token_bytes(32))])
+    token = signer.issue("bench-tokens")
+    forged = bytes([1]) + secrets.token_bytes(protocol.RAW_TOKEN_SIZE - 1)
+    members = {secrets.token_bytes(32): None for _ in range(100000)}
+    random_token = next(iter(members))
+    print(f"issue:          {measure(lambda: signer.issue('bench-tokens'), args.count):6.2f} us")
+    print(f"verify valid:   {measure(lambda: signer.verify(token), args.count):6.2f} us")
+    print(f"verify forged:  {measure(lambda: signer.verify(forged), args.count):6.2f} us")
+    print(f"dict lookup:    {measure(lambda: members.get(random_token), args.count):6.2f} us")
+    print()
+    print(f"{'tokens':>8} {'valid us':>9} {'forged us':>10} {'rejected':>9}")
+    for name, tokens in (("random", None), ("signed", signer)):
+        result = bench_receive(tokens, args.count, args.port)
+        print(
+            f"{name:>8} {result['valid_us']:>9.2f} {result['forged_us']:>10.2f} "
+            f"{result['rejected']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""WALのリプレイ(再起動時の復元)にかかる時間を計測するベンチマーク
+
+1. --records 件のレコードをスナップショットなしで並べたログをリプレイする時間
+2. 同じ操作を部屋(ChatRoom)に適用しながらサーバーと同じようにログに追記し、
+   snapshot_every件ごとにスナップショットを作成した場合の、再起動時のリプレイの時間と、
+   snapshot()が呼び出したスレッド(サーバーではイベントループ)を止める時間
+
+python3 bench_wal.py [--records 1000000] [--rooms 1000] [--snapshot-every 100000]
+"""
+
+import argparse
+import os
+import secrets
+import tempfile
+import time
+
+import wal
+from chat_room import ChatRoom
+
+ADDRESS = ("127.0.0.1", 40000)
+
+
+def generate_operations(num_records, num_rooms):
+    """部屋の作成・参加・退出・メッセージが混ざった操作を生成する"""
+    operations = []
+    room_names = [f"room-{i}" for i in range(num_rooms)]
+    members = {room_name: [] for room_name in room_names}
+    for room_name in room_names:
+        operations.append(("create", room_name))
+    i = 0
+    seq = 0
+    while len(operations) < num_records:
+        room_name = room_names[i % num_rooms]
+        kind = (i // num_rooms) % 10
+        if kind < 6 or not members[room_name]:
+            token = secrets.token_bytes(32)
+            members[room_name].append(token)
+            operations.append(("join", room_name, token, f"user{i}"))
+        elif kind < 9:
+            operations.append(("leave", room_name, members[room_name].pop()))
+        else:
+            seq += 1
+            operations.append(("message", room_name, seq, f"user{i}: hello".encode()))
+        i += 1
+    return operations
+
+
+def encode_operation(operation):
+    """操作をWALのレコードにする"""
+    kind, room_name = operation[:2]
+    if kind == "create":
+        return wal.encode_room_create(room_name)
+    if kind == "join":
+        return wal.encode_member_join(room_name, operation[2], operation[3], ADDRESS)
+    if kind == "leave":
+        return wal.encode_member_leave(room_name, operation[2])
+    return wal.encode_message(room_name, operation[2], operation[3])
+
+
+def apply_operation(rooms, operation):
+    """操作を部屋に適用する(サーバーがログに追記する前に行う変更)"""
+    kind, room_name = operation[:2]
+    if kind == "create":
+        rooms[room_name] = ChatRoom(room_name)
+    elif kind == "join":
+        rooms[room_name].add_client(operation[2], ADDRESS, operation[3])
+    elif kind == "leave":
+        rooms[room_name].remove_client(operation[2])
+    else:
+        rooms[room_name].messages.next_seq = operation[2]
+        rooms[room_name].messages.append(operation[3])
+
+
+def measure_log_replay(records, batch):
+    """スナップショットなしのログのリプレイ"""
+    with tempfile.TemporaryDirectory() as directory:
+        log = wal.WriteAheadLog(directory)
+        with open(log.log_path, "wb") as f:
+            for i in range(0, len(records), batch):
+                f.write(wal.encode_batch(records[i : i + batch]))
+        size = os.path.getsize(log.log_path)
+
+        start = time.perf_counter()
+        rooms = log.replay()
+        replay_seconds = time.perf_counter() - start
+        members = sum(len(room.members) for room in rooms.values())
+        print(
+            f"log replay: {len(records)} records ({size / 1e6:.1f} MB) "
+            f"in {replay_seconds:.3f} s -> {len(rooms)} rooms, {members} members"
+        )
+
+
+def measure_restart(operations, snapshot_every):
+    """snapshot_every件ごとにスナップショットを作成しながら追記したログのリプレイ"""
+    with tempfile.TemporaryDirectory() as directory:
+        log = wal.WriteAheadLog(
+            directory, log_messages=True, flush_interval=0, snapshot_every=snapshot_every
+        )
+        log.open()
+        rooms = {}
+        snapshots = 0
+        snapshot_seconds = 0.0
+        for operation in operations:
+            apply_operation(rooms, operation)
+            log.append(encode_operation(operation))
+            if log.needs_snapshot():
+                # サーバーと同じく書き込みを待たない(変換は書き込みスレッドで行う)
+                start = time.perf_counter()
+                log.snapshot(rooms)
+                snapshot_seconds += time.perf_counter() - start
+                snapshots += 1
+        tail = log.records_since_snapshot
+        log.close()
+
+        start = time.perf_counter()
+        restored = log.replay()
+        replay_seconds = time.perf_counter() - start
+        members = sum(len(room.members) for room in restored.values())
+        print(
+            f"restart after {len(operations)} records with snapshot_every={snapshot_every}: "
+            f"{snapshots} snapshots (caller blocked "
+            f"{snapshot_seconds / max(snapshots, 1) * 1e6:.0f} µs each), "
+            f"snapshot {os.path.getsize(log.snapshot_path) / 1e6:.1f} MB + {tail} log records "
+            f"replayed in {replay_seconds:.3f} s -> {len(restored)} rooms, {members} members"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=1000, help="1バッチあたりのレコード数")
+    parser.add_argument("--snapshot-every", type=int, default=100000)
+    args = parser.parse_args()
+
+    operations = generate_operations(args.records, args.rooms)
+    measure_log_replay([encode_operation(operation) for operation in operations], args.batch)
+    measure_restart(operations, args.snapshot_every)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import queue
+
+
+class BufferPool:
+    """受信に使うbytearrayを使い回すためのプール
+
+    Note:
+        recvfrom_intoで受信したバッファは、部屋の担当スレッドでメッセージを処理し終えるまで
+        使われるため、処理が終わったらreleaseで返却する。プールが空の場合は新しく確保し、
+        返却されたバッファはmax_buffers個まで保持する。
+    """
+
+    def __init__(self, buffer_size, max_buffers=1024):
+        """
+        Args:
+            buffer_size (int): 1つのバッファのバイト数
+            max_buffers (int): 保持するバッファの最大数
+        """
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.__free = queue.SimpleQueue()
+
+    def __len__(self):
+        return self.__free.qsize()
+
+    def acquire(self):
+        """バッファを1つ取り出す"""
+        try:
+            return self.__free.get_nowait()
+        except queue.Empty:
+            return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        """使い終わったバッファを返却する"""
+        if self.__free.qsize() < self.max_buffers:
+            self.__free.put(buffer)
@@ -1,65 +1,168 @@
 import secrets
+from operator import attrgetter
+
+import protocol
+from coalesce import PendingBatch
+from fanout import RecipientList
+from member import Member
+from message_history import MessageHistory
+from reliable import ReliableSender
 
 
 class ChatRoom:
     TIMEOUT = 300
+    # 部屋ごとに保持する履歴の件数とバイト数の上限
+    HISTORY_CAPACITY = 256
+    HISTORY_MAX_BYTES = 64 * 1024
 
     def __init__(self, room_name):
         self.name = room_name
         self.max_users = 1000
-        self.host_token = ""
-        self.users = {}  # クライアント名:クライアントオブジェクトの辞書
-        self.tokens_to_addrs = {}  # トークンの辞書:ユーザーIPアドレスの辞書
-        self.token_to_user_name = {}  # トークン:ユーザー名
-        self.messages = []  # チャットメッセージの履歴
+        self.host_token = b""
+        self.members = {}  # トークン(bytes):Member
+        self.recipients = RecipientList()  # 中継用の送信先一覧(入退室時に更新)
+        # 再送・順序保証付きで受け取るユーザー(recipientsには含めず、1人ずつ送信する)
+        self.reliable_members = set()
+        # 圧縮して受け取るユーザーの送信先一覧(recipientsと同じく、同じバイト列をまとめて送る)
+        self.compressed_recipients = RecipientList()
+        # 圧縮の辞書(compression.RoomCompressor、圧縮して受け取るユーザーが初めて参加したときに作成する)
+        self.compressor = None
+        # 部屋名付きで受け取るユーザーの送信先一覧と、そのフレームの先頭部分(protocol.FRAME_ROOM)
+        self.tagged_recipients = RecipientList()
+        self.tag = protocol.encode_room_tag(room_name)
+        # マルチキャストで受け取るユーザー(送信先一覧には含めず、グループに1回だけ送る)と、
+        # 部屋のグループの (IPアドレス, ポート)(最初のユーザーが参加したときに決める)
+        self.multicast_members = set()
+        self.multicast_group = None
+        # チャットメッセージの履歴(シーケンス番号付きのリングバッファ)
+        self.messages = MessageHistory(self.HISTORY_CAPACITY, self.HISTORY_MAX_BYTES)
+        # まとめ送りの送信待ちのメッセージ(サーバーでまとめ送りを有効にした場合のみ使う)
+        self.pending = PendingBatch()
+        # 中継するバイト数(メッセージのバイト数 x 送信先数)の流量制限(rate_limit.TokenBucket)
+        self.relay_bucket = None
 
     # トークンをrandomで生成する関数
     def generate_token(self):
         token = secrets.token_hex(16)
         return token
 
-    def add_client(self, token, user_address, user_name):
-        if len(self.tokens_to_addrs) < self.max_users:
-            self.tokens_to_addrs[token] = user_address
-            self.token_to_user_name[token] = user_name
-            # self.clients[client.name] = client
-            return True
+    def add_client(
+        self,
+        token,
+        user_address,
+        user_name,
+        session_id=None,
+        reliable=False,
+        compress=False,
+        tagged=False,
+        multicast=False,
+    ):
+        """ユーザーを部屋に追加する
+
+        Note:
+            部屋名付き・マルチキャストで受け取るユーザーには圧縮せずに送る。
+            再送・順序保証付きで受け取るユーザーはマルチキャストを使わない。
+
+        Args:
+            reliable (bool): 中継を再送・順序保証付きで受け取るかどうか
+            compress (bool): 中継を圧縮して受け取るかどうか
+            tagged (bool): 中継を部屋名付きのフレームで受け取るかどうか
+            multicast (bool): 中継をマルチキャストで受け取るかどうか
+
+        Returns:
+            member.Member: 追加したユーザー(満員の場合はNone)
+        """
+        if len(self.members) < self.max_users:
+            member = Member(token, user_name, user_address, self, session_id)
+            self.members[token] = member
+            member.tagged = tagged
+            member.compress = compress and not tagged and not multicast
+            if reliable:
+                member.reliable = ReliableSender()
+                self.reliable_members.add(member)
+            elif multicast:
+                member.multicast = True
+                self.multicast_members.add(member)
+            else:
+                self.__add_recipient(member)
+            return member
         else:
             print("部屋 {} は満員です。".format(self.name))
-            return False
+            return None
+
+    def add_members(self, members):
+        """作成済みのユーザーを、受け取り方の指定なしでまとめて部屋に追加する
+
+        Note:
+            追記型ログの復元で使う。満員かどうかは確かめない(参加した時点で確かめている)。
+
+        Args:
+            members (list): member.Memberのリスト
+        """
+        self.members.update(zip(map(attrgetter("token"), members), members))
+        self.recipients.extend(members)
+
+    def __add_recipient(self, member):
+        """ユーザーを受け取り方に応じた送信先一覧に追加する"""
+        if member.tagged:
+            self.tagged_recipients.add(member)
+        elif member.compress:
+            self.compressed_recipients.add(member)
+        else:
+            self.recipients.add(member)
+
+    def use_unicast(self, member):
+        """マルチキャストで受け取るユーザーをユニキャストの中継に切り替える"""
+        if member.multicast:
+            member.multicast = False
+            self.multicast_members.discard(member)
+            self.__add_recipient(member)
 
     def remove_client(self, token):
-        if token in self.tokens_to_addrs:
-            del self.tokens_to_addrs[token]
-            del self.token_to_user_name[token]
-            return True
+        """ユーザーを部屋から削除する
+
+        Returns:
+            member.Member: 削除したユーザー(存在しない場合はNone)
+        """
+        member = self.members.pop(token, None)
+        if member is not None:
+            if member.reliable is not None:
+                self.reliable_members.discard(member)
+            elif member.multicast:
+                self.multicast_members.discard(member)
+            elif member.tagged:
+                self.tagged_recipients.remove(member)
+            elif member.compress:
+                self.compressed_recipients.remove(member)
+            else:
+                self.recipients.remove(member)
+        return member
 
     def remove_all_users(self):
-        # tokens_to_addrsのコピーを作成
-        # tokens_to_addrsをforループ中に変更すると、forループが正常に動作しないため
-        tokens_to_remove = self.tokens_to_addrs.copy()
-        for token in tokens_to_remove:
-            if self.remove_client(token):
-                self.users = {}
-                self.tokens_to_addrs = {}
-                self.messages = []
+        self.members = {}
+        self.recipients = RecipientList()
+        self.reliable_members = set()
+        self.compressed_recipients = RecipientList()
+        self.tagged_recipients = RecipientList()
+        self.multicast_members = set()
+        self.messages.clear()
 
     def add_message(self, client, message):
-        if client in self.users:
-            self.messages.append(f"{client.name}: {message}")
+        if client.token in self.members:
+            self.messages.append(f"{client.name}: {message}".encode("utf-8"))
         else:
             print("トークンを所持していないため、メッセージを送信できません。")
 
     def send_message(self, client, message):
-        if client.token in self.tokens_to_addrs:
+        if client.token in self.members:
             client.send_message(message)
         else:
             print("トークンを所持していないため、メッセージを送信できません。")
 
     # 部屋内のクライアント全員に送信メッセージを中継する関数
     def relay_message(self, client, message):
-        if client.token in self.tokens_to_addrs:
-            for token in self.tokens_to_addrs:
+        if client.token in self.members:
+            for token in self.members:
                 if token != client.token:
                     client.send_message(client.name + ": " + message)
         else:
@@ -1,63 +1,108 @@
-import socket
-import json
-import struct
-import threading
+import argparse
+import asyncio
 
+import protocol
+from async_client import AsyncChatClient
 from user import User
 
 
 class Client:
-    def __init__(self):
-        self.__tcp_address = ("127.0.0.1", 9002)
-        self.__tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(
+        self,
+        use_binary=True,
+        reliable=False,
+        tcp_port=9002,
+        udp_port=9003,
+        compress=False,
+        multicast=False,
+    ):
+        """
+        Args:
+            use_binary (bool): ハンドシェイクのペイロードをバイナリ形式で送るかどうか
+            reliable (bool): 中継を再送・順序保証付きで受け取るかどうか
+            tcp_port (int): 接続するサーバーのTCPポート(クラスターではどのノードでもよい)
+            udp_port (int): 接続するサーバーのUDPポート
+            compress (bool): 中継を圧縮して受け取るかどうか
+            multicast (bool): 中継を部屋のマルチキャストグループで受け取るかどうか
+        """
+        self.__tcp_port = tcp_port
+        self.__udp_port = udp_port
+        self.__use_binary = use_binary
+        self.__reliable = reliable
+        self.__compress = compress
+        self.__multicast = multicast
         # クライアントが入力したアクション番号
         self.__CREATE_ROOM_NUM = 1
         self.__JOIN_ROOM_NUM = 2
-        # state
-        self.__SERVER_INIT = 0
-        self.__RESPONSE_OF_REQUEST = 1
-        self.__REQUEST_COMPLETION = 2
-        self.__ERROR_RESPONSE = 3
+        self.__LIST_ROOMS_NUM = protocol.LIST_ROOMS_NUM
 
     def start(self):
         """クライアントを起動する関数"""
+        asyncio.run(self.__start())
+
+    async def __start(self):
+        """ターミナルの入力でasync_client.AsyncChatClientを操作する
+
+        Note:
+            ハンドシェイク(リダイレクトとJSON形式への切り替えを含む)と中継の受信は
+            AsyncChatClientが行い、ここではユーザーの入力と表示だけを扱う。
+            ユーザーは1人なので、UDPソケットを共有せずに部屋名付きのフレームを使わない。
+        """
         # ユーザー名入力
         user_name = self.__input_user_name()
         user = User(user_name)
-
-        user.token = None
-        while user.token is None:
-            operation = user.input_action_number()
-            # TCP接続するかどうか
-            tcp_connected = self.__check_tcp_connection(int(operation))
-            if not tcp_connected:
-                print("Closing connection...")
-                self.__tcp_socket.close()
-                print("Connection closed.")
-                exit()
-
-            # 部屋名を入力
-            room_name = user.input_room_name()
-            # 入室リクエストを送信
-            self.__request_to_join_room(operation, user, room_name)
-            # 入室リクエストのレスポンスを受け取る
-            token = self.__receive_response_to_join_room()
-
-            if token is not None:
-                user.token = token
-                # 参加した部屋名をセット
-                user.room_name = room_name
-                break
-
-        # TCP接続を閉じる
-        self.__tcp_socket.close()
-
-        # 部屋に参加してからタイマースタート
-        user.start_timer()
-        # 他クライアントからのメッセージを別スレッドで受信
-        threading.Thread(target=user.receive_message).start()
-        # メッセージを送信
-        threading.Thread(target=user.send_message).start()
+        async with AsyncChatClient(
+            tcp_port=self.__tcp_port,
+            udp_port=self.__udp_port,
+            use_binary=self.__use_binary,
+            users_per_socket=1,
+        ) as client:
+            session = None
+            while session is None:
+                operation = int(user.input_action_number())
+                if operation == self.__LIST_ROOMS_NUM:
+                    await self.__list_rooms(client, user)
+                    continue
+                if operation not in (self.__CREATE_ROOM_NUM, self.__JOIN_ROOM_NUM):
+                    print("Closing connection...")
+                    return
+                # 部屋名を入力
+                room_name = user.input_room_name()
+                if operation == self.__CREATE_ROOM_NUM:
+                    enter_room = client.create_room
+                else:
+                    enter_room = client.join_room
+                try:
+                    session = await enter_room(
+                        user_name,
+                        room_name,
+                        reliable=self.__reliable,
+                        compress=self.__compress,
+                        multicast=self.__multicast,
+                    )
+                except (RuntimeError, ValueError, ConnectionError) as e:
+                    # 同じ接続で再度リクエストを送れるようにする
+                    print(e)
+            print(
+                protocol.describe_status(
+                    protocol.STATUS_COMPLETED, operation, room_name
+                )
+            )
+            # 無操作のタイムアウトはサーバー側で判定する(退出メッセージを受信すると終了)
+            await user.chat(session)
+
+    async def __list_rooms(self, client, user):
+        """部屋名の先頭で検索した部屋の一覧を、1ページずつ表示する"""
+        prefix = user.input_room_prefix()
+        cursor = ""
+        while True:
+            try:
+                rooms, cursor = await client.list_rooms(prefix, cursor)
+            except (RuntimeError, ConnectionError) as e:
+                print(e)
+                return
+            if not user.show_rooms(rooms, cursor != ""):
+                return
 
     def __input_user_name(self):
         """ユーザー名入力
@@ -79,78 +124,31 @@ class Client:
                 continue
             return user_name
 
-    def __check_tcp_connection(self, operation):
-        """TCP接続の確認
-
-        Args:
-            operation (int): クライアントが入力したアクション番号(1:部屋作成, 2:参加, 3:終了)
-
-        Returns:
-            (bool): TCP接続できたかどうか
-        """
-        tcp_connected = False
-        if operation == self.__CREATE_ROOM_NUM or operation == self.__JOIN_ROOM_NUM:
-            self.__tcp_socket.connect(self.__tcp_address)
-            tcp_connected = True
-
-        return tcp_connected
-
-    def __request_to_join_room(self, operation, user, room_name):
-        """部屋入室リクエストの関数（部屋作成・部屋参加共通）
-
-        Args:
-            operation (str): クライアントが入力したアクション番号(1:部屋作成, 2:参加)
-            user (user.User): ユーザー
-            room_name (str): 部屋名
-        """
-
-        encoded_room_name = room_name.encode("utf-8")
-        payload = {
-            "user_name": user.name,
-            "user_address": user.address,
-        }
-        payload_data = json.dumps(payload).encode("utf-8")
-        # ヘッダーを作成
-        header = struct.pack(
-            "!B B B 29s",
-            len(encoded_room_name),
-            int(operation),
-            self.__SERVER_INIT,
-            len(payload_data).to_bytes(29, byteorder="big"),
-        )
-        # ボディを作成
-        # Todo OperationPayloadSizeの最大バイト数を超えた場合の例外処理
-        body = encoded_room_name + payload_data
-
-        # ヘッダーとボディをサーバーに送信
-        req = header + body
-        self.__tcp_socket.sendall(req)
-
-    def __receive_response_to_join_room(self):
-        """部屋入室リクエストのレスポンスを受け取る
-
-        Returns:
-            (str): トークン
-        """
-        header = self.__tcp_socket.recv(32)
-        _, _, state, payload_size = struct.unpack_from("!B B B 29s", header)
-        operation_payload_size = int.from_bytes(payload_size, byteorder="big")
-        payload = self.__tcp_socket.recv(operation_payload_size)
-
-        if state == self.__SERVER_INIT:
-            print(json.loads(payload.decode("utf-8"))["message"])
-            self.__tcp_socket.close()
-            self.__init__()
-            return None
-        elif state == self.__REQUEST_COMPLETION:
-            # トークンを取得
-            token = json.loads(payload.decode("utf-8"))["token"]
-            message = json.loads(payload.decode("utf-8"))["message"]
-            print(message)
-            return token
-
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--reliable",
+        action="store_true",
+        help="receive relayed messages with retransmission and in-order delivery",
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="receive relayed messages compressed"
+    )
+    parser.add_argument(
+        "--multicast",
+        action="store_true",
+        help="receive relayed messages through the room's multicast group",
+    )
+    parser.add_argument("--tcp-port", type=int, default=9002, help="サーバーのTCPポート")
+    parser.add_argument("--udp-port", type=int, default=9003, help="サーバーのUDPポート")
+    args = parser.parse_args()
     print("---WELCOME TO THE CHAT MESSENGER PROGRAM!---")
-    client = Client()
+    client = Client(
+        reliable=args.reliable,
+        tcp_port=args.tcp_port,
+        udp_port=args.udp_port,
+        compress=args.compress,
+        multicast=args.multicast,
+    )
     client.start()
@@ -0,0 +1,179 @@
+"""複数のサーバーノードで部屋を分担するクラスター構成
+
+python3 server.py --tcp-port 9002 --udp-port 9003 --cluster-file nodes.txt
+python3 server.py --tcp-port 9012 --udp-port 9013 --cluster-file nodes.txt
+
+各ノードは同じノード一覧("ホスト:TCPポート:UDPポート")から同じコンシステントハッシュの
+リングを作り、部屋名のハッシュで部屋を担当するノードを決める。担当でない部屋の作成・参加
+リクエストには、担当ノードのアドレスを返してクライアントに接続し直してもらう(リダイレクト)。
+ノード一覧をファイルで指定した場合は変更を検知してリングを作り直し、担当が変わった部屋だけを
+閉じて、その部屋のユーザーに移動先を通知する(ノードの追加・削除で移動する部屋は約1/ノード数)。
+"""
+
+import bisect
+import hashlib
+import os
+
+from log import get_logger
+
+logger = get_logger("server")
+
+
+def parse_node(spec):
+    """ノードの指定を(ホスト, TCPポート, UDPポート)に変換する
+
+    Args:
+        spec (str): "ホスト:TCPポート:UDPポート" 形式の文字列
+
+    Returns:
+        tuple: (ホスト, TCPポート, UDPポート)
+    """
+    host, tcp_port, udp_port = spec.strip().rsplit(":", 2)
+    return host, int(tcp_port), int(udp_port)
+
+
+def format_node(node):
+    """ノードを "ホスト:TCPポート:UDPポート" 形式の文字列にする"""
+    return "{}:{}:{}".format(*node)
+
+
+def read_nodes(path):
+    """ノード一覧のファイル(1行に1ノード、#以降はコメント)を読み込む"""
+    nodes = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                nodes.append(parse_node(line))
+    return nodes
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """コンシステントハッシュのリング
+
+    Note:
+        ノードごとにVNODES個の仮想ノードをリングに置き、キーのハッシュから時計回りに
+        最初に見つかった仮想ノードのノードを担当とする。ノードを追加・削除しても、
+        担当が変わるのはそのノードの仮想ノードの直前の区間のキーだけになる。
+    """
+
+    VNODES = 64
+
+    def __init__(self, nodes=(), vnodes=VNODES):
+        """
+        Args:
+            nodes (list): (ホスト, TCPポート, UDPポート) のリスト
+            vnodes (int): 1ノードあたりの仮想ノード数
+        """
+        self.vnodes = vnodes
+        self.nodes = set()
+        self.__points = []  # 仮想ノードのハッシュ(昇順)
+        self.__owners = []  # __pointsと同じ位置の仮想ノードのノード
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        """ノードを追加する"""
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        label = format_node(node).encode("utf-8")
+        for i in range(self.vnodes):
+            point = _hash(label + b"#" + str(i).encode("ascii"))
+            index = bisect.bisect(self.__points, point)
+            self.__points.insert(index, point)
+            self.__owners.insert(index, node)
+
+    def remove(self, node):
+        """ノードを削除する"""
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [(p, o) for p, o in zip(self.__points, self.__owners) if o != node]
+        self.__points = [p for p, _ in kept]
+        self.__owners = [o for _, o in kept]
+
+    def owner(self, key):
+        """キーを担当するノード
+
+        Args:
+            key (bytes): UTF-8エンコード済みの部屋名
+
+        Returns:
+            tuple: (ホスト, TCPポート, UDPポート)、ノードがない場合はNone
+        """
+        if not self.__points:
+            return None
+        index = bisect.bisect(self.__points, _hash(key))
+        if index == len(self.__points):
+            index = 0
+        return self.__owners[index]
+
+
+class ClusterMembership:
+    """このノードとクラスターのノード一覧"""
+
+    def __init__(self, node, nodes=(), nodes_file=None):
+        """
+        Args:
+            node (tuple): このノードの (ホスト, TCPポート, UDPポート)
+            nodes (list): 固定のノード一覧(nodes_fileを指定した場合は使わない)
+            nodes_file (str): ノード一覧のファイル(変更されたら読み込み直す)
+        """
+        self.node = node
+        self.nodes_file = nodes_file
+        self.__mtime = None
+        if nodes_file is not None:
+            self.__mtime = os.stat(nodes_file).st_mtime_ns
+            nodes = read_nodes(nodes_file)
+        # 差し替えるだけで更新し、他のスレッドからはロックなしで参照する
+        self.ring = HashRing(nodes)
+        if node not in self.ring.nodes:
+            logger.warning(
+                "Cluster Warning:%s is not in the node list", format_node(node)
+            )
+
+    def owner(self, room_name):
+        """部屋を担当するノード
+
+        Args:
+            room_name (bytes): UTF-8エンコード済みの部屋名
+        """
+        return self.ring.owner(room_name)
+
+    def owns(self, room_name):
+        """このノードが部屋を担当しているかどうか"""
+        return self.ring.owner(room_name) == self.node
+
+    def refresh(self):
+        """ノード一覧のファイルが変更されていたら読み込み直す
+
+        Returns:
+            bool: ノード一覧が変わった場合はTrue
+        """
+        if self.nodes_file is None:
+            return False
+        try:
+            mtime = os.stat(self.nodes_file).st_mtime_ns
+            if mtime == self.__mtime:
+                return False
+            self.__mtime = mtime
+            nodes = set(read_nodes(self.nodes_file))
+        except (OSError, ValueError) as e:
+            logger.warning("Cluster Error:%s", e)
+            return False
+        if nodes == self.ring.nodes:
+            return False
+        # 仮想ノードの位置はノード一覧だけで決まるので、作り直しても残ったノードの区間は変わらない
+        self.ring = HashRing(nodes, self.ring.vnodes)
+        logger.info(
+            "Cluster nodes changed: %s", ", ".join(sorted(map(format_node, nodes)))
+        )
+        return True
@@ -0,0 +1,94 @@
+"""メッセージの多い部屋の中継をまとめて送るための、部屋ごとの送信待ちバッファとタイマー
+
+直前の送信からflush windowが経っていない間に届いたメッセージは部屋のPendingBatchに溜め、
+windowの終わり(または溜まったバイト数が上限に達した時点)で1つのフレームにまとめて送る。
+静かな部屋のメッセージはこれまでどおりすぐに送るので、遅延が増えるのは混んでいる部屋だけで、
+その遅延もwindow以下に収まる。
+"""
+
+import heapq
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger("server")
+
+
+class PendingBatch:
+    """部屋ごとの送信待ちのメッセージ"""
+
+    __slots__ = ("entries", "size", "scheduled", "last_flush")
+
+    def __init__(self):
+        # (シーケンス番号, エンコード済みのメッセージ, 送信者のMember, 受信時刻) のリスト
+        self.entries = []
+        self.size = 0
+        # フラッシュのタイマーを登録済みかどうか
+        self.scheduled = False
+        # 最後に送信した時刻(time.monotonic)
+        self.last_flush = float("-inf")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def should_hold(self, window, now):
+        """メッセージを送信待ちにするかどうか(直前の送信からwindow秒以内か、既に送信待ちがある)"""
+        return bool(self.entries) or now - self.last_flush < window
+
+    def add(self, seq, payload, sender, received):
+        """送信待ちにメッセージを追加し、溜まったバイト数を返す"""
+        self.entries.append((seq, payload, sender, received))
+        self.size += len(payload)
+        return self.size
+
+    def take(self, now):
+        """送信待ちのメッセージをすべて取り出す"""
+        entries = self.entries
+        self.entries = []
+        self.size = 0
+        self.scheduled = False
+        self.last_flush = now
+        return entries
+
+
+class FlushTimer:
+    """スレッド方式で、指定した時刻に関数を呼び出すタイマー(1つのスレッドで全部屋分を扱う)"""
+
+    def __init__(self):
+        self.__heap = []  # (時刻, 連番, 関数, 引数)
+        self.__seq = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(
+            target=self.__run, name="flush-timer", daemon=True
+        )
+        self.__thread.start()
+
+    def call_later(self, delay, fn, *args):
+        """delay秒後にfn(*args)を呼び出す"""
+        with self.__condition:
+            self.__seq += 1
+            heapq.heappush(
+                self.__heap, (time.monotonic() + delay, self.__seq, fn, args)
+            )
+            # 先頭が変わった場合は待ち時間を計算し直す
+            if self.__heap[0][1] == self.__seq:
+                self.__condition.notify()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while True:
+                    now = time.monotonic()
+                    if self.__heap and self.__heap[0][0] <= now:
+                        _, _, fn, args = heapq.heappop(self.__heap)
+                        break
+                    timeout = self.__heap[0][0] - now if self.__heap else None
+                    self.__condition.wait(timeout)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.warning("Server Error:%s", e)
@@ -0,0 +1,166 @@
+"""中継するデータグラムの圧縮(ハンドシェイクでFLAG_COMPRESSを指定したユーザーのみ)
+
+サーバーは部屋ごとにRoomCompressorを持ち、部屋の最近のチャットメッセージから
+zlibのプリセット辞書を作る(最初はFIRST_TRAINING件、その後はRETRAIN_INTERVAL件ごとに作り直す)。
+min_sizeバイト以上のデータグラムは1回だけ圧縮し、同じバイト列を圧縮に対応した全員に送る。
+それより短いものと、圧縮しても小さくならないものはそのまま送る。
+辞書は作り直すたびに辞書ID付きのフレーム(protocol.FRAME_DICTIONARY)で送り、
+知らない辞書IDのデータを受け取ったクライアントは辞書を要求する(protocol.OP_DICTIONARY)。
+"""
+
+import collections
+import zlib
+
+import protocol
+
+# ヘッダーとチェックサムを付けないraw deflate
+WBITS = -15
+
+
+class RoomCompressor:
+    """部屋ごとの圧縮の辞書と、辞書を読み込み済みの圧縮オブジェクト"""
+
+    MIN_SIZE = 256
+    LEVEL = 6
+    DICTIONARY_SIZE = 1024
+    FIRST_TRAINING = 32
+    RETRAIN_INTERVAL = 256
+
+    def __init__(
+        self, min_size=MIN_SIZE, level=LEVEL, dictionary_size=DICTIONARY_SIZE
+    ):
+        """
+        Args:
+            min_size (int): 圧縮するデータグラムの最小バイト数
+            level (int): zlibの圧縮レベル
+            dictionary_size (int): プリセット辞書のバイト数(1つのデータグラムに収まるサイズ)
+        """
+        self.min_size = min_size
+        self.level = level
+        self.dictionary_size = dictionary_size
+        self.dictionary_id = 0
+        self.dictionary = b""
+        # 辞書を読み込み済みの圧縮オブジェクト(メッセージごとにcopyして使い、辞書の読み込みを省く)
+        self.__base = zlib.compressobj(level, zlib.DEFLATED, WBITS)
+        # 辞書を作るための最近のメッセージ(古い順)
+        self.__samples = collections.deque()
+        self.__sample_bytes = 0
+        self.__observed = 0
+
+    def observe(self, payload):
+        """チャットメッセージを辞書の材料に加える
+
+        Args:
+            payload (bytes): 中継するメッセージ(「ユーザー名: 」付き)
+
+        Returns:
+            bool: 辞書を作り直した場合はTrue(新しい辞書を圧縮に対応したユーザーに送る)
+        """
+        self.__samples.append(payload)
+        self.__sample_bytes += len(payload)
+        while self.__sample_bytes - len(self.__samples[0]) >= self.dictionary_size:
+            self.__sample_bytes -= len(self.__samples.popleft())
+        self.__observed += 1
+        threshold = self.RETRAIN_INTERVAL if self.dictionary_id else self.FIRST_TRAINING
+        if self.__observed < threshold:
+            return False
+        self.__observed = 0
+        self.train()
+        return True
+
+    def train(self):
+        """最近のメッセージから辞書を作り直す
+
+        Note:
+            zlibは辞書の末尾に近い文字列ほど短い距離で参照できるため、新しいメッセージを末尾に置く。
+        """
+        self.load(
+            self.dictionary_id % 0xFFFFFFFF + 1,
+            b"".join(self.__samples)[-self.dictionary_size :],
+        )
+
+    def load(self, dictionary_id, dictionary):
+        """辞書IDと辞書を設定する(引き継いだ部屋で、クライアントが持っている辞書を使い続ける)"""
+        self.dictionary_id = dictionary_id
+        self.dictionary = dictionary
+        if dictionary_id:
+            self.__base = zlib.compressobj(
+                self.level, zlib.DEFLATED, WBITS, zdict=dictionary
+            )
+
+    def compress(self, data):
+        """データグラムを圧縮したフレームにする
+
+        Args:
+            data (bytes): 中継するデータグラム
+
+        Returns:
+            bytes: 圧縮したフレーム(min_size未満か、圧縮しても小さくならない場合はdataのまま)
+        """
+        if len(data) < self.min_size:
+            return data
+        compressor = self.__base.copy()
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) + protocol.DICTIONARY_HEADER_SIZE >= len(data):
+            return data
+        return protocol.encode_dictionary_frame(
+            protocol.FRAME_COMPRESSED, self.dictionary_id, compressed
+        )
+
+    def dictionary_frame(self):
+        """現在の辞書のフレーム(まだ辞書を作っていない場合はNone)"""
+        if not self.dictionary_id:
+            return None
+        return protocol.encode_dictionary_frame(
+            protocol.FRAME_DICTIONARY, self.dictionary_id, self.dictionary
+        )
+
+
+class Decompressor:
+    """クライアント側の、受け取った辞書と圧縮したフレームの展開"""
+
+    # 作り直された直後に古い辞書で圧縮されたフレームも展開できるように、最近の辞書を残す
+    MAX_DICTIONARIES = 4
+    # 展開後のバイト数の上限(UDPのデータグラムの最大サイズ)
+    MAX_SIZE = 65535
+
+    def __init__(self):
+        self.dictionaries = collections.OrderedDict()  # 辞書ID:辞書
+        # 展開できなかったフレームの数
+        self.errors = 0
+
+    def add_dictionary(self, frame):
+        """辞書のフレームを受け取る"""
+        dictionary_id, dictionary = protocol.decode_dictionary_frame(frame)
+        self.dictionaries[dictionary_id] = bytes(dictionary)
+        self.dictionaries.move_to_end(dictionary_id)
+        while len(self.dictionaries) > self.MAX_DICTIONARIES:
+            self.dictionaries.popitem(last=False)
+
+    def decompress(self, frame):
+        """圧縮したフレームを展開する
+
+        Args:
+            frame (bytes): 圧縮したフレーム
+
+        Returns:
+            tuple: (辞書ID, 展開したデータグラム)。辞書を受け取っていない場合はデータグラムがNone、
+                展開できなかった場合は空のバイト列
+        """
+        dictionary_id, data = protocol.decode_dictionary_frame(frame)
+        if dictionary_id:
+            dictionary = self.dictionaries.get(dictionary_id)
+            if dictionary is None:
+                return dictionary_id, None
+            decompressor = zlib.decompressobj(WBITS, zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj(WBITS)
+        try:
+            payload = decompressor.decompress(data, self.MAX_SIZE)
+        except zlib.error:
+            self.errors += 1
+            return dictionary_id, b""
+        if decompressor.unconsumed_tail:
+            self.errors += 1
+            return dictionary_id, b""
+        return dictionary_id, payload
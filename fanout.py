@@ -0,0 +1,295 @@
+import ctypes
+import ctypes.util
+import socket
+import struct
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger("server")
+
+# sockaddr_in6が収まるサイズ(sockaddr_inもこの領域に格納する)
+SOCKADDR_SIZE = 28
+# sendmmsgで1回に渡せるメッセージ数の上限(UIO_MAXIOV)
+BATCH_SIZE = 1024
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.c_void_p),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """libcのsendmmsgを取得する(使えない環境ではNone)"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def pack_sockaddr(address):
+    """(IPアドレス, ポート番号)をsockaddr_in/sockaddr_in6のバイト列に変換する
+
+    Args:
+        address (tuple): (IPアドレス, ポート番号)
+
+    Returns:
+        bytes: sockaddr構造体
+    """
+    host, port = address[0], address[1]
+    try:
+        return (
+            struct.pack("=H", socket.AF_INET)
+            + struct.pack("!H", port)
+            + socket.inet_pton(socket.AF_INET, host)
+            + bytes(8)
+        )
+    except OSError:
+        return (
+            struct.pack("=H", socket.AF_INET6)
+            + struct.pack("!H I", port, 0)
+            + socket.inet_pton(socket.AF_INET6, host)
+            + struct.pack("=I", 0)
+        )
+
+
+class RecipientList:
+    """部屋ごとの送信先(Member)の一覧
+
+    Note:
+        入室・退室のたびにsendmmsg用のmmsghdr配列の変わった位置をO(1)で記録し、
+        次の送信前にその位置だけを書き込む。中継時にはPython側で送信先ごとの処理をせずに済む。
+        配列内の位置はMember.slotに持たせ、mmsghdr配列は最初の送信時に確保する。
+    """
+
+    def __init__(self):
+        self.members = []
+        self.lock = threading.Lock()
+        self.__dirty = set()  # mmsghdrの書き込みが必要な位置
+        self.__iov = _IoVec()
+        self.__capacity = 0
+        self.__names = None
+        self.__msgs = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def __allocate(self, capacity):
+        """mmsghdr配列を確保する(登録済みのアドレスは送信前に書き込む)"""
+        self.__capacity = capacity
+        self.__names = (ctypes.c_char * (SOCKADDR_SIZE * capacity))()
+        self.__msgs = (_MMsgHdr * capacity)()
+        self.__dirty.update(range(len(self.members)))
+
+    def __write(self, i, address):
+        """i番目のmmsghdrに送信先アドレスを設定する"""
+        name = pack_sockaddr(address)
+        name_address = ctypes.addressof(self.__names) + i * SOCKADDR_SIZE
+        ctypes.memmove(name_address, name, len(name))
+        header = self.__msgs[i].msg_hdr
+        header.msg_name = name_address
+        header.msg_namelen = len(name)
+        header.msg_iov = ctypes.addressof(self.__iov)
+        header.msg_iovlen = 1
+
+    def __write_dirty(self):
+        """入退室で変わった位置のmmsghdrをまとめて書き込む"""
+        if self.__capacity < len(self.members):
+            capacity = max(self.__capacity, 16)
+            while capacity < len(self.members):
+                capacity *= 2
+            self.__allocate(capacity)
+        for i in self.__dirty:
+            if i < len(self.members):
+                self.__write(i, self.members[i].address)
+        self.__dirty.clear()
+
+    def add(self, member):
+        """送信先を追加する
+
+        Args:
+            member (member.Member): 追加するユーザー
+        """
+        with self.lock:
+            if member.slot is not None:
+                self.__remove(member)
+            member.slot = len(self.members)
+            self.members.append(member)
+            self.__dirty.add(member.slot)
+
+    def extend(self, members):
+        """まだどの一覧にも登録されていない送信先をまとめて追加する(復元用)
+
+        Args:
+            members (list): 追加するユーザー(member.Member)のリスト
+        """
+        with self.lock:
+            start = len(self.members)
+            for slot, member in enumerate(members, start):
+                member.slot = slot
+            self.members.extend(members)
+            # 確保済みの配列に収まらない場合は、次の送信前に確保し直して全体を書き込む
+            if len(self.members) <= self.__capacity:
+                self.__dirty.update(range(start, len(self.members)))
+
+    def remove(self, member):
+        """送信先を削除する(末尾の要素と入れ替えるのでO(1))
+
+        Args:
+            member (member.Member): 削除するユーザー
+        """
+        with self.lock:
+            if member.slot is not None:
+                self.__remove(member)
+
+    def __remove(self, member):
+        i = member.slot
+        last = self.members.pop()
+        if last is not member:
+            self.members[i] = last
+            last.slot = i
+            self.__dirty.add(i)
+        member.slot = None
+
+    def sendmmsg(self, fd, payload, begin, end):
+        """begin番目からend番目の手前までにpayloadをsendmmsgで送信する
+
+        Args:
+            fd (int): UDPソケットのファイルディスクリプタ
+            payload (bytes): 送信データ
+            begin (int): 開始位置
+            end (int): 終了位置
+
+        Returns:
+            int: 送信できた件数
+
+        Raises:
+            OSError: 1件も送信できなかった場合
+        """
+        if self.__dirty:
+            self.__write_dirty()
+        buffer = ctypes.c_char_p(payload)
+        self.__iov.iov_base = ctypes.cast(buffer, ctypes.c_void_p).value
+        self.__iov.iov_len = len(payload)
+        count = min(end - begin, BATCH_SIZE)
+        first = ctypes.addressof(self.__msgs) + begin * ctypes.sizeof(_MMsgHdr)
+        sent = _sendmmsg(fd, first, count, 0)
+        if sent < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "sendmmsg failed")
+        # 0件のまま返した場合も失敗として扱い、呼び出し側が同じ位置で送り直し続けないようにする
+        if sent == 0:
+            raise OSError("sendmmsg sent no messages")
+        return sent
+
+
+class FanOut:
+    """同じペイロードを部屋内の全員に一括送信する
+
+    Note:
+        ペイロードは呼び出し側で1度だけエンコードし、sendmmsgが使える環境では
+        BATCH_SIZE件ずつまとめて送信する。使えない環境ではsendtoで1件ずつ送信する。
+    """
+
+    def __init__(self, sock, fallback_send=None):
+        """
+        Args:
+            sock (socket.socket): 送信に使うUDPソケット
+            fallback_send (callable): sendmmsgが使えないときの送信関数(省略時はsock.sendto)
+        """
+        self.sock = sock
+        self.fallback_send = fallback_send or sock.sendto
+        self.use_sendmmsg = _sendmmsg is not None
+        # 統計情報
+        self.recipients_sent = 0
+        self.elapsed = 0.0
+
+    def send(self, payload, recipients, exclude=None):
+        """exclude以外の送信先全員にpayloadを送信する
+
+        Args:
+            payload (bytes): エンコード済みの送信データ
+            recipients (RecipientList): 送信先一覧
+            exclude (member.Member | set): 送信しないユーザー(送信者)、またはその集合
+
+        Returns:
+            int: 送信した件数
+        """
+        start = time.perf_counter()
+        sent = 0
+        if exclude is None:
+            excluded = ()
+        elif isinstance(exclude, (set, frozenset, list, tuple)):
+            excluded = exclude
+        else:
+            excluded = (exclude,)
+        with recipients.lock:
+            # 送信しない位置の間を1つずつ送信範囲にする
+            # (slotは所属する一覧での位置なので、この一覧にいないユーザーは飛ばさない)
+            members = recipients.members
+            skips = sorted(
+                member.slot
+                for member in excluded
+                if member.slot is not None
+                and member.slot < len(members)
+                and members[member.slot] is member
+            )
+            begin = 0
+            for skip in skips:
+                sent += self.__send_range(payload, recipients, begin, skip)
+                begin = skip + 1
+            sent += self.__send_range(payload, recipients, begin, len(recipients))
+        self.recipients_sent += sent
+        self.elapsed += time.perf_counter() - start
+        return sent
+
+    def __send_range(self, payload, recipients, begin, end):
+        """begin番目からend番目の手前までに送信する"""
+        sent = 0
+        i = begin
+        while i < end:
+            if self.use_sendmmsg:
+                try:
+                    count = recipients.sendmmsg(self.sock.fileno(), payload, i, end)
+                    sent += count
+                    i += count
+                    continue
+                except OSError:
+                    # 送信バッファが一杯などの場合はこの1件だけsendtoに任せる
+                    pass
+            try:
+                self.fallback_send(payload, recipients.members[i].address)
+                sent += 1
+            except OSError as e:
+                logger.warning("Server Error:%s", e)
+            i += 1
+        return sent
+
+    def recipients_per_second(self):
+        """これまでの中継で1秒あたりに送信できた件数"""
+        if self.elapsed == 0:
+            return 0.0
+        return self.recipients_sent / self.elapsed
@@ -0,0 +1,104 @@
+"""大きなメッセージの分割送信と受信側での組み立て
+
+1つのデータグラムに収まらないメッセージは、クライアントがprotocol.FRAGMENT_SIZEバイトごとの断片
+(protocol.OP_FRAGMENT)に分割して送信する。サーバーは断片を溜めずに、届いたものから順に
+送信者の「ユーザー名: 」を付けたフレーム(protocol.FRAME_FRAGMENT)にして中継する。
+流量制限は最初の断片で判定し、2つ目以降の断片は最初の断片を中継したメッセージの分だけ中継するため、
+クライアントは最初の断片から順に送信する。
+受信側(Reassembler)はメッセージ全体のバイト数のbytearrayを最初の断片が届いた時点で確保して
+断片を位置どおりに書き込み、すべて揃ったら1つのメッセージとして表示する。揃わないまま
+timeout秒経ったメッセージと、確保したバイト数の合計がmax_pending_bytesを超えた分の古いメッセージは破棄する。
+"""
+
+import collections
+
+import protocol
+
+
+class PartialMessage:
+    """組み立て中のメッセージ"""
+
+    __slots__ = ("buffer", "received", "remaining", "deadline")
+
+    def __init__(self, total, count, deadline):
+        self.buffer = bytearray(total)
+        # 断片ごとの受信済みフラグ(重複して届いた断片を数えないため)
+        self.received = bytearray(count)
+        self.remaining = count
+        self.deadline = deadline
+
+
+class Reassembler:
+    """受信した断片をメッセージに組み立てる"""
+
+    TIMEOUT = 5.0
+    MAX_PENDING_BYTES = 1024 * 1024
+
+    def __init__(self, timeout=TIMEOUT, max_pending_bytes=MAX_PENDING_BYTES):
+        """
+        Args:
+            timeout (float): 最初の断片から全部揃うまで待つ秒数
+            max_pending_bytes (int): 組み立て中のメッセージに確保するバイト数の合計の上限
+        """
+        self.timeout = timeout
+        self.max_pending_bytes = max_pending_bytes
+        # (送信者, メッセージID):PartialMessage(最初の断片が届いた順)
+        self.partials = collections.OrderedDict()
+        self.pending_bytes = 0
+        # 揃わずに破棄したメッセージ数
+        self.dropped = 0
+
+    def add(self, key, index, count, total, chunk, now):
+        """断片を書き込み、メッセージが揃ったらそれを返す
+
+        Args:
+            key (tuple): 送信者とメッセージIDの組
+            index (int): 断片の番号
+            count (int): 断片の数
+            total (int): メッセージ全体のバイト数
+            chunk (bytes): 断片のデータ
+            now (float): 現在時刻(time.monotonic)
+
+        Returns:
+            bytes: 揃ったメッセージ(まだ揃っていない場合はNone)
+        """
+        self.expire(now)
+        if count == 1:
+            return bytes(chunk)
+        partial = self.partials.get(key)
+        if partial is None:
+            if total > self.max_pending_bytes:
+                self.dropped += 1
+                return None
+            # 上限を超える場合は古いメッセージから破棄して空ける
+            while self.partials and self.pending_bytes + total > self.max_pending_bytes:
+                self.__discard(next(iter(self.partials)))
+            partial = PartialMessage(total, count, now + self.timeout)
+            self.partials[key] = partial
+            self.pending_bytes += total
+        elif len(partial.received) != count or len(partial.buffer) != total:
+            return None
+        if partial.received[index]:
+            return None
+        offset = index * protocol.FRAGMENT_SIZE
+        partial.buffer[offset : offset + len(chunk)] = chunk
+        partial.received[index] = 1
+        partial.remaining -= 1
+        if partial.remaining:
+            return None
+        del self.partials[key]
+        self.pending_bytes -= total
+        return bytes(partial.buffer)
+
+    def expire(self, now):
+        """timeout秒以内に揃わなかったメッセージを破棄する"""
+        while self.partials:
+            key, partial = next(iter(self.partials.items()))
+            if partial.deadline > now:
+                return
+            self.__discard(key)
+
+    def __discard(self, key):
+        partial = self.partials.pop(key)
+        self.pending_bytes -= len(partial.buffer)
+        self.dropped += 1
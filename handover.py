@@ -0,0 +1,453 @@
+"""動作中のサーバーから新しいプロセスへの引き継ぎ(ホットリスタート)
+
+python3 server.py --handover /tmp/chat-handover.sock             # 動作中のサーバー
+python3 server.py --handover /tmp/chat-handover.sock --takeover  # 新しいプロセス
+
+--handover を指定したサーバーはUnixドメインソケットで引き継ぎの要求を待つ。--takeover で起動した
+新しいプロセスが接続すると、古いプロセスはイベントループを止めたまま(その間に届いたデータグラムは
+カーネルの受信バッファに溜まる)、バインド済みのTCP・UDP(と計測値)のソケットをSCM_RIGHTSで渡し、
+続けて部屋の状態を送る。新しいプロセスは状態を組み立てて同じソケットで受信を始めてからREADYを返し、
+古いプロセスはそれを受け取ると終了する。READYが届かなければ古いプロセスがそのまま処理を続ける。
+
+部屋の状態は、追記型ログ(wal.py)のスナップショットと同じレコード(部屋・ユーザーと受け取り方・
+ホストのトークン・履歴)と、ログには残さない中継の状態のレコード(再送・順序保証の未確認のフレーム、
+まとめ送り・流量制限で遅らせている中継、履歴の次のシーケンス番号、圧縮の辞書、ユーザーごと・部屋ごとの
+流量制限のトークンバケット、途中まで中継した分割メッセージの残りの断片数)の2つのバッチで送る。
+"""
+
+import os
+import socket
+import struct
+import time
+import zlib
+
+import protocol
+import wal
+from compression import RoomCompressor
+from member import Member
+from rate_limit import TokenBucket
+
+# 引き継ぎの最初のメッセージ: magic, 次に発行するセッションID,
+# 部屋のレコードのバイト数, 中継の状態のレコードのバイト数
+HEADER = struct.Struct("!4s I I I")
+MAGIC = b"CHO1"
+READY = b"READY"
+# 新しいプロセスが受信を始めるまで待つ秒数(超えたら古いプロセスが処理を続ける)
+TIMEOUT = 30.0
+
+# 中継の状態のレコードの種別(1は受け取り方に使っていたもので、今はwal.pyの参加のレコードに含める)
+ROOM_STATE = 2
+RELIABLE = 3
+PENDING = 4
+DELAYED = 5
+MEMBER_STATE = 6
+ROOM_BUCKET = 7
+
+# 部屋: 種別, 部屋名のバイト数, 圧縮の有無, 履歴の次のシーケンス番号, 辞書ID, 辞書のバイト数
+ROOM_STATE_HEADER = struct.Struct("!B B B Q I H")
+# 再送・順序保証: 種別, 部屋名・トークンのバイト数, 世代, 次のシーケンス番号,
+# 再送タイムアウト(マイクロ秒), 未確認のフレームの数, 送信待ちのデータの数
+# + 部屋名, トークン, (バイト数(!H) + データ)の並び
+RELIABLE_HEADER = struct.Struct("!B B B H I I H H")
+CHUNK_HEADER = struct.Struct("!H")
+# まとめ送りの送信待ち: 種別, 部屋名・送信者のトークンのバイト数, シーケンス番号, 中継するメッセージのバイト数
+PENDING_HEADER = struct.Struct("!B B B Q H")
+# 流量制限で遅らせている中継: 種別, 部屋名・送信者のトークンのバイト数, 残りの待ち時間(マイクロ秒),
+# メッセージのバイト数
+DELAYED_HEADER = struct.Struct("!B B B I H")
+# ユーザーの流量制限と分割メッセージ: 種別, 部屋名・トークンのバイト数, トークンバケットの有無,
+# 途中まで中継した分割メッセージの数, 制限したことを最後に通知してからの時間(マイクロ秒)
+# + 部屋名, トークン, (トークンバケット), (メッセージID, 残りの断片数)(FRAGMENT)の並び
+MEMBER_STATE_HEADER = struct.Struct("!B B B B H I")
+FRAGMENT = struct.Struct("!I H")
+# 部屋の中継バイト数の流量制限: 種別, 部屋名のバイト数 + 部屋名, トークンバケット
+ROOM_BUCKET_HEADER = struct.Struct("!B B")
+# トークンバケット: 1秒あたりの補充数, 最大数, 残りのトークン数, 最後に補充してからの時間(マイクロ秒)
+BUCKET = struct.Struct("!d d d I")
+# 経過時間(マイクロ秒)の上限
+MAX_AGE = 0xFFFFFFFF
+
+
+def _chunks(items):
+    return b"".join(CHUNK_HEADER.pack(len(item)) + item for item in items)
+
+
+def _age(since, now):
+    """sinceからnowまでの時間(マイクロ秒、MAX_AGEで打ち切る)"""
+    return min(int(max(now - since, 0) * 1e6), MAX_AGE)
+
+
+def _encode_bucket(bucket, now):
+    return BUCKET.pack(
+        bucket.rate, bucket.burst, bucket.tokens, _age(bucket.updated, now)
+    )
+
+
+def _decode_bucket(data, offset, now):
+    """トークンバケットを読む(補充した時刻は新しいプロセスの現在時刻からの経過時間で戻す)
+
+    Returns:
+        tuple: (rate_limit.TokenBucket, 続きの位置)
+    """
+    rate, burst, tokens, age = BUCKET.unpack_from(data, offset)
+    bucket = TokenBucket(rate, burst, now - age / 1e6)
+    bucket.tokens = tokens
+    return bucket, offset + BUCKET.size
+
+
+def encode_state(rooms, delayed, now=None):
+    """部屋の状態を引き継ぎ用のバイト列に変換する
+
+    Args:
+        rooms (dict): 部屋名:ChatRoomの辞書
+        delayed (iterable): 流量制限で遅らせている中継の (時刻(time.monotonic), 部屋, 送信者, メッセージ)
+        now (float): 現在時刻(time.monotonic、省略時は現在)
+
+    Returns:
+        tuple: (部屋のレコードのバッチ, 中継の状態のレコードのバッチ)
+    """
+    if now is None:
+        now = time.monotonic()
+    records = []
+    for room_name, room in rooms.items():
+        encoded_room_name = room_name.encode("utf-8")
+        compressor = room.compressor
+        dictionary = compressor.dictionary if compressor is not None else b""
+        records.append(
+            ROOM_STATE_HEADER.pack(
+                ROOM_STATE,
+                len(encoded_room_name),
+                compressor is not None,
+                room.messages.next_seq,
+                compressor.dictionary_id if compressor is not None else 0,
+                len(dictionary),
+            )
+            + encoded_room_name
+            + dictionary
+        )
+        if room.relay_bucket is not None:
+            records.append(
+                ROOM_BUCKET_HEADER.pack(ROOM_BUCKET, len(encoded_room_name))
+                + encoded_room_name
+                + _encode_bucket(room.relay_bucket, now)
+            )
+        for member in room.members.values():
+            if member.bucket is not None or member.fragments or member.notified:
+                fragments = member.fragments or {}
+                records.append(
+                    MEMBER_STATE_HEADER.pack(
+                        MEMBER_STATE,
+                        len(encoded_room_name),
+                        len(member.token),
+                        member.bucket is not None,
+                        len(fragments),
+                        _age(member.notified, now),
+                    )
+                    + encoded_room_name
+                    + member.token
+                    + (
+                        _encode_bucket(member.bucket, now)
+                        if member.bucket is not None
+                        else b""
+                    )
+                    + b"".join(
+                        FRAGMENT.pack(message_id, remaining)
+                        for message_id, remaining in fragments.items()
+                    )
+                )
+            sender = member.reliable
+            if sender is not None and (sender.unacked or sender.next_seq > 1):
+                frames = [entry[0] for entry in sender.unacked.values()]
+                records.append(
+                    RELIABLE_HEADER.pack(
+                        RELIABLE,
+                        len(encoded_room_name),
+                        len(member.token),
+                        sender.epoch,
+                        sender.next_seq,
+                        int(sender.rto * 1e6),
+                        len(frames),
+                        len(sender.backlog),
+                    )
+                    + encoded_room_name
+                    + member.token
+                    + _chunks(frames)
+                    + _chunks(sender.backlog)
+                )
+        for seq, payload, sender, _ in room.pending.entries:
+            records.append(
+                PENDING_HEADER.pack(
+                    PENDING, len(encoded_room_name), len(sender.token), seq, len(payload)
+                )
+                + encoded_room_name
+                + sender.token
+                + payload
+            )
+    for deadline, room, sender, message in delayed:
+        encoded_room_name = room.name.encode("utf-8")
+        records.append(
+            DELAYED_HEADER.pack(
+                DELAYED,
+                len(encoded_room_name),
+                len(sender.token),
+                int(max(deadline - now, 0) * 1e6),
+                len(message),
+            )
+            + encoded_room_name
+            + sender.token
+            + message
+        )
+    return wal.encode_batch(wal.encode_rooms(rooms)), wal.encode_batch(records)
+
+
+class RestoredState:
+    """引き継いだ部屋と、新しいプロセスのイベントループで再開する中継"""
+
+    def __init__(self, rooms, next_session_id):
+        self.rooms = rooms
+        self.next_session_id = next_session_id
+        # まとめ送りの送信待ちがある部屋
+        self.pending_rooms = []
+        # 未確認のフレームがある (部屋, ユーザー)
+        self.reliable_members = []
+        # 流量制限で遅らせている (残りの秒数, 部屋, 送信者, メッセージ)
+        self.delayed = []
+
+
+def decode_state(next_session_id, rooms_data, state_data, now=None):
+    """引き継ぎ用のバイト列から部屋を組み立てる
+
+    Args:
+        next_session_id (int): 次に発行するセッションID
+        rooms_data (bytes): 部屋のレコードのバッチ
+        state_data (bytes): 中継の状態のレコードのバッチ
+        now (float): 現在時刻(time.monotonic、省略時は現在)
+
+    Returns:
+        RestoredState: 引き継いだ状態
+
+    Raises:
+        ValueError: データが途切れているか、形式が不正な場合
+    """
+    if now is None:
+        now = time.monotonic()
+    restored = RestoredState(wal.decode_rooms(rooms_data), next_session_id)
+    length, crc = wal.BATCH_HEADER.unpack_from(state_data)
+    data = state_data[wal.BATCH_HEADER.size :]
+    if len(data) != length or zlib.crc32(data) != crc:
+        raise ValueError("Corrupted relay state.")
+
+    rooms = restored.rooms
+    pending_rooms = {}
+    offset = 0
+    while offset < len(data):
+        kind = data[offset]
+        if kind == ROOM_STATE:
+            _, room_size, compressed, next_seq, dictionary_id, dictionary_size = (
+                ROOM_STATE_HEADER.unpack_from(data, offset)
+            )
+            start = offset + ROOM_STATE_HEADER.size
+            dictionary_start = start + room_size
+            offset = dictionary_start + dictionary_size
+            room = rooms[data[start:dictionary_start].decode("utf-8")]
+            room.messages.next_seq = next_seq
+            if compressed:
+                room.compressor = RoomCompressor()
+                room.compressor.load(dictionary_id, data[dictionary_start:offset])
+        elif kind == RELIABLE:
+            _, room_size, token_size, epoch, next_seq, rto, unacked, backlog = (
+                RELIABLE_HEADER.unpack_from(data, offset)
+            )
+            room, token, offset = _room_and_token(
+                rooms, data, offset + RELIABLE_HEADER.size, room_size, token_size
+            )
+            member = room.members[token]
+            sender = member.reliable
+            sender.epoch = epoch
+            sender.next_seq = next_seq
+            sender.rto = rto / 1e6
+            for i in range(unacked + backlog):
+                (size,) = CHUNK_HEADER.unpack_from(data, offset)
+                start = offset + CHUNK_HEADER.size
+                offset = start + size
+                chunk = data[start:offset]
+                if i < unacked:
+                    _, seq, _ = protocol.decode_reliable_frame(chunk)
+                    # 引き継いだ時点から再送タイムアウトを数え、往復時間の計測には使わない
+                    sender.unacked[seq] = [chunk, now, True]
+                else:
+                    sender.backlog.append(chunk)
+            if sender.unacked:
+                restored.reliable_members.append((room, member))
+        elif kind == MEMBER_STATE:
+            _, room_size, token_size, has_bucket, fragments, notified = (
+                MEMBER_STATE_HEADER.unpack_from(data, offset)
+            )
+            room, token, offset = _room_and_token(
+                rooms, data, offset + MEMBER_STATE_HEADER.size, room_size, token_size
+            )
+            member = room.members[token]
+            member.notified = now - notified / 1e6
+            if has_bucket:
+                member.bucket, offset = _decode_bucket(data, offset, now)
+            if fragments:
+                member.fragments = {}
+                for _ in range(fragments):
+                    message_id, remaining = FRAGMENT.unpack_from(data, offset)
+                    member.fragments[message_id] = remaining
+                    offset += FRAGMENT.size
+        elif kind == ROOM_BUCKET:
+            _, room_size = ROOM_BUCKET_HEADER.unpack_from(data, offset)
+            start = offset + ROOM_BUCKET_HEADER.size
+            room = rooms[data[start : start + room_size].decode("utf-8")]
+            room.relay_bucket, offset = _decode_bucket(data, start + room_size, now)
+        elif kind == PENDING:
+            _, room_size, token_size, seq, payload_size = PENDING_HEADER.unpack_from(
+                data, offset
+            )
+            room, token, start = _room_and_token(
+                rooms, data, offset + PENDING_HEADER.size, room_size, token_size
+            )
+            offset = start + payload_size
+            room.pending.add(seq, data[start:offset], _sender(room, token), None)
+            pending_rooms[room.name] = room
+        elif kind == DELAYED:
+            _, room_size, token_size, delay, message_size = DELAYED_HEADER.unpack_from(
+                data, offset
+            )
+            room, token, start = _room_and_token(
+                rooms, data, offset + DELAYED_HEADER.size, room_size, token_size
+            )
+            offset = start + message_size
+            sender = room.members.get(token)
+            if sender is not None:
+                restored.delayed.append((delay / 1e6, room, sender, data[start:offset]))
+        else:
+            raise ValueError(f"Unknown relay state record {kind}.")
+    restored.pending_rooms = list(pending_rooms.values())
+    return restored
+
+
+def _room_and_token(rooms, data, start, room_size, token_size):
+    """レコードの部屋名とトークンを読む
+
+    Returns:
+        tuple: (ChatRoom, トークン, 続きの位置)
+    """
+    token_start = start + room_size
+    end = token_start + token_size
+    return rooms[data[start:token_start].decode("utf-8")], data[token_start:end], end
+
+
+def _sender(room, token):
+    """まとめ送りの送信者(退出済みの場合は、除外の判定だけに使う部屋に属さないMember)"""
+    member = room.members.get(token)
+    if member is None:
+        member = Member(token, "", ("0.0.0.0", 0), room)
+    return member
+
+
+def send_state(conn, sockets, next_session_id, rooms_data, state_data):
+    """ソケットと部屋の状態を新しいプロセスに送る
+
+    Args:
+        conn (socket.socket): 新しいプロセスとのUnixドメインソケットの接続
+        sockets (list): 渡すソケット(TCP, UDP, 計測値の順、計測値は省略できる)
+        next_session_id (int): 次に発行するセッションID
+        rooms_data (bytes): 部屋のレコードのバッチ
+        state_data (bytes): 中継の状態のレコードのバッチ
+    """
+    header = HEADER.pack(MAGIC, next_session_id, len(rooms_data), len(state_data))
+    socket.send_fds(conn, [header], [sock.fileno() for sock in sockets])
+    conn.sendall(rooms_data)
+    conn.sendall(state_data)
+
+
+def wait_ready(conn, timeout=TIMEOUT):
+    """新しいプロセスが受信を始めたことを確認する
+
+    Raises:
+        ConnectionError: READYが届く前に接続が閉じられた場合
+        TimeoutError: timeout秒以内にREADYが届かなかった場合
+    """
+    conn.settimeout(timeout)
+    reply = b""
+    while len(reply) < len(READY):
+        chunk = conn.recv(len(READY) - len(reply))
+        if not chunk:
+            raise ConnectionError("Handover aborted by the new process.")
+        reply += chunk
+    if reply != READY:
+        raise ConnectionError(f"Unexpected handover reply {reply!r}.")
+
+
+def take_over(path):
+    """動作中のサーバーに接続して、ソケットと部屋の状態を受け取る
+
+    Args:
+        path (str): 動作中のサーバーが引き継ぎを待つUnixドメインソケットのパス
+
+    Returns:
+        tuple: (接続, 受け取ったソケットのリスト, 次に発行するセッションID,
+            部屋のレコードのバッチ, 中継の状態のレコードのバッチ)
+            接続には受信を始めてからconfirmでREADYを返す
+
+    Raises:
+        ConnectionError: 応答が不正な場合
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        header, fds, _, _ = socket.recv_fds(conn, HEADER.size, 3)
+        # 計測値のソケットを渡さない場合は2つ
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        while len(header) < HEADER.size:
+            chunk = conn.recv(HEADER.size - len(header))
+            if not chunk:
+                raise ConnectionError("Handover closed before the header.")
+            header += chunk
+        magic, next_session_id, rooms_size, state_size = HEADER.unpack(header)
+        if magic != MAGIC or len(sockets) < 2:
+            raise ConnectionError("Invalid handover header.")
+        data = _read_exactly(conn, rooms_size + state_size)
+    except BaseException:
+        conn.close()
+        raise
+    return conn, sockets, next_session_id, data[:rooms_size], data[rooms_size:]
+
+
+def _read_exactly(conn, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = conn.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Handover closed before the room state.")
+        received += n
+    return bytes(buffer)
+
+
+def confirm(conn):
+    """受信を始めたことを古いプロセスに知らせて接続を閉じる"""
+    try:
+        conn.sendall(READY)
+    finally:
+        conn.close()
+
+
+def listen(path):
+    """引き継ぎの要求を待つUnixドメインソケットを作成する(古いプロセスのソケットファイルは置き換える)"""
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        listener.bind(path)
+        listener.listen(1)
+        listener.setblocking(False)
+    except OSError:
+        listener.close()
+        raise
+    return listener
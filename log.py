@@ -0,0 +1,77 @@
+"""サーバーのログ出力(レベルと1秒あたりの件数の上限を設定できる)
+
+メッセージの中継や入退室のたびのログはDEBUG・INFOレベルで出力する。
+本番環境では --log-level WARNING などで無効にでき、有効な場合も1秒あたりの件数を
+超えた分は捨てて、捨てた件数だけを次の出力時に知らせる。
+"""
+
+import logging
+import threading
+import time
+
+LOGGER_NAME = "chat"
+
+
+class RateLimitFilter(logging.Filter):
+    """1秒あたりのログの件数を制限するフィルター"""
+
+    def __init__(self, rate):
+        """
+        Args:
+            rate (int): 1秒あたりに出力する最大件数(0以下なら制限しない)
+        """
+        super().__init__()
+        self.rate = rate
+        self.__lock = threading.Lock()
+        self.__window = 0
+        self.__count = 0
+        self.__suppressed = 0
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        window = int(time.monotonic())
+        with self.__lock:
+            if window != self.__window:
+                self.__window = window
+                self.__count = 0
+            self.__count += 1
+            if self.__count > self.rate:
+                self.__suppressed += 1
+                return False
+            suppressed, self.__suppressed = self.__suppressed, 0
+        if suppressed:
+            record.msg = f"({suppressed} log records suppressed) {record.msg}"
+        return True
+
+
+def get_logger(name=None):
+    """サーバーのロガーを返す
+
+    Args:
+        name (str): 子ロガーの名前(例: "server")
+    """
+    if name is None:
+        return logging.getLogger(LOGGER_NAME)
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def configure_logging(level="INFO", rate=100):
+    """ログのレベルと1秒あたりの件数の上限を設定する
+
+    Args:
+        level (str): DEBUG, INFO, WARNING, ERROR, OFF のいずれか
+        rate (int): 1秒あたりに出力する最大件数(0以下なら制限しない)
+    """
+    logger = get_logger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.propagate = False
+    if level.upper() == "OFF":
+        logger.setLevel(logging.CRITICAL + 1)
+        return
+    logger.setLevel(level.upper())
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    handler.addFilter(RateLimitFilter(rate))
+    logger.addHandler(handler)
@@ -0,0 +1,89 @@
+import time
+
+import protocol
+
+
+class Member:
+    """部屋に参加しているユーザー1人分の情報
+
+    Note:
+        __slots__で属性を固定し、ユーザーごとに辞書を持たないようにする。
+        部屋(ChatRoom.members)、中継用の送信先一覧(RecipientList)、サーバーのインデックスと
+        タイミングホイールは同じインスタンスを共有するため、ユーザーごとの情報は1か所にだけ持ち、
+        (部屋, トークン)のようなタプルも作らない。
+    """
+
+    __slots__ = (
+        "token",
+        "prefix",
+        "address",
+        "room",
+        "session_id",
+        "last_seen",
+        "slot",
+        "bucket",
+        "notified",
+        "reliable",
+        "compress",
+        "tagged",
+        "multicast",
+        "fragments",
+    )
+
+    def __init__(self, token, name, address, room, session_id=None, prefix=None):
+        """
+        Args:
+            token (bytes): トークン(16進数文字列にする前のバイト列)
+            name (str): ユーザー名
+            address (tuple): (IPアドレス, ポート番号)
+            room (chat_room.ChatRoom): 参加している部屋
+            session_id (int): 短い形式のチャットメッセージで使うセッションID
+            prefix (bytes): エンコード済みの「ユーザー名: 」(追記型ログからの復元で使う。
+                指定した場合はnameを使わない)
+        """
+        self.token = token
+        # 中継するメッセージの先頭に付ける「ユーザー名: 」(エンコード済み)
+        # ユーザー名の文字列は別に持たず、必要なときにここから復元する
+        if prefix is None:
+            prefix = f"{name}: ".encode("utf-8")
+        self.prefix = prefix
+        self.address = tuple(address)
+        self.room = room
+        self.session_id = session_id
+        # 最後にメッセージを送信した時刻(time.monotonic)
+        self.last_seen = time.monotonic()
+        # RecipientList内の位置(登録されていなければNone)
+        self.slot = None
+        # 送信の流量制限(rate_limit.TokenBucket、制限しない場合はNone)と、
+        # 制限したことを最後に通知した時刻
+        self.bucket = None
+        self.notified = 0.0
+        # 再送・順序保証付きで中継する場合の送信状態(reliable.ReliableSender、使わない場合はNone)
+        self.reliable = None
+        # 中継を圧縮して受け取るかどうか(compression.py)
+        self.compress = False
+        # 中継を部屋名付きのフレーム(protocol.FRAME_ROOM)で受け取るかどうか
+        self.tagged = False
+        # 中継を部屋のマルチキャストグループで受け取るかどうか(multicast.py)
+        self.multicast = False
+        # 最初の断片を中継した分割メッセージの {メッセージID: 残りの断片数}(なければNone)
+        self.fragments = None
+
+    @property
+    def name(self):
+        """ユーザー名"""
+        return self.prefix[:-2].decode("utf-8")
+
+    @property
+    def flags(self):
+        """中継の受け取り方をハンドシェイクのフラグ(protocol.FLAG_*)で表したもの"""
+        flags = 0
+        if self.reliable is not None:
+            flags |= protocol.FLAG_RELIABLE
+        if self.compress:
+            flags |= protocol.FLAG_COMPRESS
+        if self.tagged:
+            flags |= protocol.FLAG_ROOM_TAG
+        if self.multicast:
+            flags |= protocol.FLAG_MULTICAST
+        return flags
@@ -0,0 +1,125 @@
+import bisect
+import threading
+
+
+class MessageHistory:
+    """部屋ごとの直近のメッセージを保持する固定長のリングバッファ
+
+    Note:
+        各メッセージには単調増加するシーケンス番号を付ける。件数(capacity)と
+        合計バイト数(max_bytes)の上限を超えた分は古い順に捨てるため、
+        1部屋あたりのメモリ使用量は上限で抑えられる。追加はO(1)。
+        部屋を担当するスレッド以外(追記型ログの書き込みスレッドがスナップショットを作成する)
+        からも読むため、変更と読み出しはロックの中で行う。
+    """
+
+    def __init__(self, capacity=256, max_bytes=64 * 1024):
+        """
+        Args:
+            capacity (int): 保持するメッセージの最大件数
+            max_bytes (int): 保持するメッセージの合計バイト数の上限
+        """
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.__seqs = [0] * capacity
+        self.__entries = [None] * capacity
+        self.__head = 0  # 最も古いメッセージの位置
+        self.__count = 0
+        self.__bytes = 0
+        self.next_seq = 1
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def size_bytes(self):
+        """保持しているメッセージの合計バイト数"""
+        return self.__bytes
+
+    def append(self, data):
+        """メッセージを追加する
+
+        Args:
+            data (bytes): エンコード済みのメッセージ
+
+        Returns:
+            int: 付与したシーケンス番号
+        """
+        with self.__lock:
+            seq = self.next_seq
+            self.__add(seq, data)
+            return seq
+
+    def extend(self, entries):
+        """シーケンス番号付きのメッセージを古い順にまとめて追加する(復元用)
+
+        Args:
+            entries (iterable): (シーケンス番号, メッセージ) の並び
+        """
+        with self.__lock:
+            for seq, data in entries:
+                self.__add(seq, data)
+
+    def __add(self, seq, data):
+        self.next_seq = seq + 1
+        # 上限より大きいメッセージは番号だけ進めて保持しない
+        if len(data) > self.max_bytes:
+            return
+        while self.__count and (
+            self.__count == self.capacity or self.__bytes + len(data) > self.max_bytes
+        ):
+            self.__evict()
+        index = (self.__head + self.__count) % self.capacity
+        self.__seqs[index] = seq
+        self.__entries[index] = data
+        self.__count += 1
+        self.__bytes += len(data)
+
+    def __evict(self):
+        """最も古いメッセージを捨てる"""
+        self.__bytes -= len(self.__entries[self.__head])
+        self.__entries[self.__head] = None
+        self.__head = (self.__head + 1) % self.capacity
+        self.__count -= 1
+
+    def since(self, seq):
+        """シーケンス番号がseqより大きいメッセージを古い順に返す
+
+        Args:
+            seq (int): 受信済みの最後のシーケンス番号
+
+        Returns:
+            list: (シーケンス番号, メッセージ) のリスト
+        """
+        with self.__lock:
+            # リングバッファ内はシーケンス番号の昇順なので二分探索で開始位置を求める
+            start = bisect.bisect_right(_RingView(self), seq)
+            result = []
+            for i in range(start, self.__count):
+                index = (self.__head + i) % self.capacity
+                result.append((self.__seqs[index], self.__entries[index]))
+            return result
+
+    def seq_at(self, i):
+        """古い方からi番目のメッセージのシーケンス番号"""
+        return self.__seqs[(self.__head + i) % self.capacity]
+
+    def clear(self):
+        """全てのメッセージを捨てる(シーケンス番号はそのまま)"""
+        with self.__lock:
+            while self.__count:
+                self.__evict()
+
+
+class _RingView:
+    """bisectで探索するためにシーケンス番号を古い順に並べて見せるビュー"""
+
+    def __init__(self, history):
+        self.history = history
+
+    def __len__(self):
+        return len(self.history)
+
+    def __getitem__(self, i):
+        return self.history.seq_at(i)
@@ -0,0 +1,258 @@
+"""サーバーの計測値(カウンター・ヒストグラム)とPrometheusのテキスト形式での出力
+
+カウンターとヒストグラムはスレッドごとに別の値(セル)を持ち、加算はロックなしで行う。
+セルは最初にそのスレッドから記録したときに1度だけロックを取って登録し、
+出力するときに全スレッドのセルを合計する。
+"""
+
+import bisect
+import threading
+
+# レイテンシ(秒)のバケット
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+# 1回の中継の送信先数のバケット
+FANOUT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1000)
+
+
+class _Sharded:
+    """スレッドごとのセルを管理する基底クラス"""
+
+    def __init__(self, name, description):
+        """
+        Args:
+            name (str): 計測値の名前
+            description (str): 説明(HELP行)
+        """
+        self.name = name
+        self.description = description
+        self._local = threading.local()
+        self._cells = []
+        self.__lock = threading.Lock()
+
+    def _new_cell(self):
+        raise NotImplementedError
+
+    def _cell(self):
+        """このスレッドのセル"""
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._new_cell()
+            self._local.cell = cell
+            with self.__lock:
+                self._cells.append(cell)
+            return cell
+
+
+class Counter(_Sharded):
+    """単調増加するカウンター"""
+
+    def _new_cell(self):
+        return [0]
+
+    def inc(self, amount=1):
+        """カウンターにamountを加える"""
+        self._cell()[0] += amount
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells))
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class LabeledCounter:
+    """ラベルの値ごとに数えるカウンター(ラベルは1つ)"""
+
+    def __init__(self, name, description, label):
+        """
+        Args:
+            name (str): 計測値の名前
+            description (str): 説明(HELP行)
+            label (str): ラベルの名前
+        """
+        self.name = name
+        self.description = description
+        self.label = label
+        self.__children = {}
+        self.__lock = threading.Lock()
+
+    def labels(self, value):
+        """ラベルの値に対応するカウンター(初めての値なら作成する)
+
+        Args:
+            value (str): ラベルの値
+
+        Returns:
+            Counter: カウンター
+        """
+        counter = self.__children.get(value)
+        if counter is None:
+            with self.__lock:
+                counter = self.__children.setdefault(
+                    value, Counter(self.name, self.description)
+                )
+        return counter
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        for value, counter in sorted(self.__children.items()):
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {counter.value}')
+        return lines
+
+
+class Gauge:
+    """出力するときに関数を呼び出して値を求めるゲージ"""
+
+    def __init__(self, name, description, read):
+        """
+        Args:
+            name (str): 計測値の名前
+            description (str): 説明(HELP行)
+            read (callable): 現在の値を返す関数
+        """
+        self.name = name
+        self.description = description
+        self.read = read
+
+    @property
+    def value(self):
+        return self.read()
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Histogram(_Sharded):
+    """値の分布を固定のバケットで数えるヒストグラム"""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name (str): 計測値の名前
+            description (str): 説明(HELP行)
+            buckets (tuple): 各バケットの上限(昇順)
+        """
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def _new_cell(self):
+        # 各バケットの件数(最後は上限なし), 合計, 件数
+        return [[0] * (len(self.buckets) + 1), 0, 0]
+
+    def observe(self, value):
+        """値を1件記録する"""
+        cell = self._cell()
+        cell[0][bisect.bisect_left(self.buckets, value)] += 1
+        cell[1] += value
+        cell[2] += 1
+
+    def snapshot(self):
+        """全スレッドの合計
+
+        Returns:
+            tuple: (各バケットの件数のリスト, 合計, 件数)
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0
+        count = 0
+        for cell in list(self._cells):
+            for i, n in enumerate(cell[0]):
+                counts[i] += n
+            total += cell[1]
+            count += cell[2]
+        return counts, total, count
+
+    def render(self):
+        counts, total, count = self.snapshot()
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Registry:
+    """計測値の一覧"""
+
+    def __init__(self):
+        self.__metrics = []
+
+    def counter(self, name, description):
+        return self.__register(Counter(name, description))
+
+    def labeled_counter(self, name, description, label):
+        return self.__register(LabeledCounter(name, description, label))
+
+    def gauge(self, name, description, read):
+        return self.__register(Gauge(name, description, read))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self.__register(Histogram(name, description, buckets))
+
+    def __register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheusのテキスト形式で全計測値を出力する
+
+        Returns:
+            bytes: UTF-8エンコード済みのテキスト
+        """
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def http_response(body):
+    """計測値のテキストをHTTPのレスポンスにする
+
+    Args:
+        body (bytes): Registry.renderの出力
+
+    Returns:
+        bytes: HTTP/1.0のレスポンス
+    """
+    header = (
+        "HTTP/1.0 200 OK\r\n"
+        "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+    )
+    return header.encode("ascii") + body
@@ -0,0 +1,111 @@
+"""部屋ごとのIPマルチキャストグループによる中継(ハンドシェイクでFLAG_MULTICASTを指定したユーザーのみ)
+
+python3 server.py --multicast 239.255.0.0/16 [--multicast-port 9004] [--multicast-ttl 1]
+
+部屋のグループは部屋名のCRC32で指定したネットワークのアドレスから選ぶ(ワーカー・クラスターの
+ノードでも同じ部屋は同じグループになる)。サーバーは中継を部屋名と受け取らないユーザー(送信者など)の
+セッションID付きのフレーム(protocol.FRAME_MULTICAST)にして1回だけ送り、複製はカーネルが行う。
+グループが重なった別の部屋のフレームと、自分が除外されたフレームはクライアントが捨てる。
+
+送信はサーバーのUDPアドレスのインターフェースから行い、IP_MULTICAST_LOOPを有効にするため、
+サーバーとクライアントが同じLinuxホストならループバック(127.0.0.1)だけで動作する。
+グループに参加できないクライアントはprotocol.OP_UNICASTでユニキャストの中継に戻す。
+"""
+
+import ipaddress
+import socket
+import zlib
+
+
+class MulticastGroups:
+    """部屋とマルチキャストグループの対応と、グループへの送信"""
+
+    PORT = 9004
+    TTL = 1
+
+    def __init__(self, network, port=PORT, interface="127.0.0.1", ttl=TTL):
+        """
+        Args:
+            network (str): 部屋のグループを選ぶマルチキャストのネットワーク(例: 239.255.0.0/16)
+            port (int): グループの宛先ポート(全部屋で共通)
+            interface (str): 送信するインターフェースのIPアドレス
+            ttl (int): マルチキャストのTTL(1ならローカルのネットワークから出さない)
+
+        Raises:
+            ValueError: networkがIPv4のマルチキャストアドレスでない場合
+        """
+        self.network = ipaddress.IPv4Network(network, strict=False)
+        if not self.network.is_multicast:
+            raise ValueError(f"{network} is not an IPv4 multicast network.")
+        self.port = port
+        self.interface = interface
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+        )
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        # 送信バッファが一杯のときは待たずにユニキャストで送る
+        self.sock.setblocking(False)
+
+    def group_of(self, room_name):
+        """部屋のグループを求める
+
+        Args:
+            room_name (str): 部屋名
+
+        Returns:
+            tuple: (グループのIPアドレス, ポート)
+        """
+        index = zlib.crc32(room_name.encode("utf-8")) % self.network.num_addresses
+        return str(self.network[index]), self.port
+
+    def send(self, frame, group):
+        """グループにフレームを送信する
+
+        Raises:
+            OSError: 送信できなかった場合
+        """
+        self.sock.sendto(frame, group)
+
+    def close(self):
+        self.sock.close()
+
+
+def open_receiver(group, interface):
+    """グループに参加した受信用のソケットを作成する
+
+    Note:
+        Linuxではグループのアドレスにバインドして、同じポートの別のグループのデータグラムを受け取らない
+        (バインドできない環境では全アドレスにバインドし、部屋名で振り分ける)。
+
+    Args:
+        group (tuple): (グループのIPアドレス, ポート)
+        interface (str): グループに参加するインターフェースのIPアドレス
+
+    Returns:
+        socket.socket: ノンブロッキングのUDPソケット
+
+    Raises:
+        OSError: バインドやグループへの参加に失敗した場合
+    """
+    host, port = group
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            sock.bind(("", port))
+        sock.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton(host) + socket.inet_aton(interface),
+        )
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
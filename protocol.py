@@ -0,0 +1,874 @@
+"""TCP(ハンドシェイク)とUDP(チャットメッセージ)の通信データのエンコード・デコード
+
+ハンドシェイクのペイロードはJSON形式と、バイナリ形式の2種類をサポートする。
+バイナリ形式は先頭がBINARY_MAGIC(JSONの先頭文字にはならない値)で始まり、
+サーバーはリクエストと同じ形式でレスポンスを返す。
+"""
+
+import json
+import socket
+import struct
+
+# ハンドシェイクのヘッダー: 部屋名のバイト数, アクション番号, state, ペイロードのバイト数
+HANDSHAKE_HEADER_FORMAT = "!B B B 29s"
+HANDSHAKE_HEADER_SIZE = 32
+# チャットメッセージのヘッダー: 部屋名のバイト数, トークンのバイト数
+CHAT_HEADER_FORMAT = "!B B"
+# 部屋名のバイト数が0の場合は短い形式で、トークンの代わりに
+# バイナリのトークン(RAW_TOKEN_SIZEバイト)かセッションID(SESSION_ID_SIZEバイト)が続く
+RAW_TOKEN_SIZE = 32
+SESSION_ID_FORMAT = "!I"
+SESSION_ID_SIZE = struct.calcsize(SESSION_ID_FORMAT)
+
+# バイナリ形式のペイロードの先頭バイト
+BINARY_MAGIC = 0xB1
+
+# リクエストのフラグ
+# 短い形式のチャットメッセージを使う(レスポンスでセッションIDを受け取る)
+FLAG_COMPACT = 0x01
+# 中継を再送・順序保証付きで受け取る(reliable.pyを参照)
+FLAG_RELIABLE = 0x02
+# 中継を圧縮して受け取る(compression.pyを参照)
+FLAG_COMPRESS = 0x04
+# 中継を部屋名付きのフレーム(FRAME_ROOM)で受け取る
+# (1つのUDPソケットで複数の部屋のユーザーを扱うクライアント用、async_client.pyを参照)
+FLAG_ROOM_TAG = 0x08
+# 中継を部屋ごとのIPマルチキャストグループ(FRAME_MULTICAST)で受け取る(multicast.pyを参照)
+FLAG_MULTICAST = 0x10
+
+# リクエスト: magic, flags, アドレスファミリー(4/6), ユーザー名のバイト数, ポート番号
+# の後にIPアドレス(4または16バイト)とユーザー名が続く
+REQUEST_FORMAT = "!B B B B H"
+REQUEST_HEADER_SIZE = struct.calcsize(REQUEST_FORMAT)
+
+# レスポンス: magic, ステータスコード, トークンのバイト数 の後にトークンが続く
+# (セッションIDを発行した場合はさらにセッションID(!I)が続き、
+# マルチキャストで中継する場合はさらにグループのアドレスとポート番号(MULTICAST_FORMAT)が続く)
+RESPONSE_FORMAT = "!B H B"
+RESPONSE_HEADER_SIZE = struct.calcsize(RESPONSE_FORMAT)
+MULTICAST_FORMAT = "!4s H"
+MULTICAST_SIZE = struct.calcsize(MULTICAST_FORMAT)
+# リダイレクトのレスポンスでは、トークンの代わりに担当ノードの
+# TCPポート, UDPポート, ホスト名のバイト数 の後にホスト名が続く
+REDIRECT_FORMAT = "!H H B"
+REDIRECT_SIZE = struct.calcsize(REDIRECT_FORMAT)
+
+# 部屋の一覧(LIST_ROOMS_NUM)はヘッダーの部屋名に検索する部屋名の先頭を入れる
+# リクエスト: magic, 返す部屋数(0ならサーバーの上限), カーソルのバイト数 の後にカーソルが続く
+LIST_REQUEST_FORMAT = "!B H B"
+LIST_REQUEST_SIZE = struct.calcsize(LIST_REQUEST_FORMAT)
+# レスポンス: magic, ステータスコード, 部屋数, 続きのカーソルのバイト数 の後に
+# 部屋ごとに (部屋名のバイト数, 人数)(LIST_ENTRY_FORMAT) と部屋名、最後にカーソルが続く
+LIST_RESPONSE_FORMAT = "!B H B B"
+LIST_RESPONSE_SIZE = struct.calcsize(LIST_RESPONSE_FORMAT)
+LIST_ENTRY_FORMAT = "!B I"
+LIST_ENTRY_SIZE = struct.calcsize(LIST_ENTRY_FORMAT)
+
+# ステータスコード
+STATUS_ACCEPTED = 200
+STATUS_COMPLETED = 202
+STATUS_REDIRECT = 307
+STATUS_BAD_REQUEST = 400
+STATUS_ERROR = 500
+
+CREATE_ROOM_NUM = 1
+LIST_ROOMS_NUM = 4
+
+
+def describe_status(status, operation, room_name):
+    """ステータスコードに対応するメッセージ
+
+    Args:
+        status (int): ステータスコード
+        operation (int): アクション番号(1:部屋作成, 2:参加, 4:部屋の一覧)
+        room_name (str): 部屋名
+
+    Returns:
+        str: メッセージ
+    """
+    if status == STATUS_BAD_REQUEST:
+        if operation == CREATE_ROOM_NUM:
+            return "部屋 {} はすでに存在します".format(room_name)
+        return "部屋 {} は存在しません".format(room_name)
+    elif status == STATUS_ACCEPTED:
+        return "リクエストを受理しました。"
+    elif status == STATUS_ERROR:
+        return "リクエストを完了できませんでした。\n入力し直してください。"
+    elif status == STATUS_REDIRECT:
+        return "部屋 {} は別のサーバーが担当しています。接続し直します。".format(room_name)
+    return "リクエストを完了しました。"
+
+
+def is_binary(payload):
+    """ペイロードがバイナリ形式かどうか"""
+    return len(payload) > 0 and payload[0] == BINARY_MAGIC
+
+
+def encode_handshake_request(room_name, operation, state, payload):
+    """ハンドシェイクのリクエスト(ヘッダー + ボディ)を生成する
+
+    Args:
+        room_name (str): 部屋名
+        operation (int): アクション番号(1:部屋作成, 2:参加)
+        state (int): 状態(リクエスト時は0)
+        payload (bytes): ペイロード
+
+    Returns:
+        bytes: リクエスト
+    """
+    encoded_room_name = room_name.encode("utf-8")
+    header = struct.pack(
+        HANDSHAKE_HEADER_FORMAT,
+        len(encoded_room_name),
+        operation,
+        state,
+        len(payload).to_bytes(29, byteorder="big"),
+    )
+    return header + encoded_room_name + payload
+
+
+def encode_chat_datagram(room_name, token, message):
+    """UDPで送信するチャットメッセージを生成する
+
+    Args:
+        room_name (str): 部屋名
+        token (str): トークン
+        message (str): メッセージ
+
+    Returns:
+        bytes: 送信データ
+    """
+    header = struct.pack(
+        CHAT_HEADER_FORMAT,
+        len(room_name.encode("utf-8")),
+        len(token.encode("utf-8")),
+    )
+    body = room_name + token + message
+    return header + body.encode("utf-8")
+
+
+def encode_compact_datagram(session, message):
+    """部屋名を含まない短い形式のチャットメッセージを生成する
+
+    Args:
+        session (bytes): バイナリのトークンまたはセッションID
+        message (str): メッセージ
+
+    Returns:
+        bytes: 送信データ
+    """
+    header = struct.pack(CHAT_HEADER_FORMAT, 0, len(session))
+    return header + session + message.encode("utf-8")
+
+
+def encode_session_id(session_id):
+    """セッションIDを短い形式のチャットメッセージで使うバイト列に変換する"""
+    return struct.pack(SESSION_ID_FORMAT, session_id)
+
+
+def encode_join_request(user_name, user_address, binary=True, flags=0):
+    """部屋作成・参加リクエストのペイロードを生成する
+
+    Args:
+        user_name (str): ユーザー名
+        user_address (tuple): (IPアドレス, ポート番号)
+        binary (bool): バイナリ形式にするかどうか(Falseの場合はJSON形式)
+        flags (int): バイナリ形式のフラグ
+
+    Returns:
+        bytes: ペイロード
+    """
+    if not binary:
+        payload = {"user_name": user_name, "user_address": user_address}
+        if flags:
+            payload["flags"] = flags
+        return json.dumps(payload).encode("utf-8")
+
+    host, port = user_address[0], user_address[1]
+    try:
+        family, packed_host = 4, socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        family, packed_host = 6, socket.inet_pton(socket.AF_INET6, host)
+    encoded_name = user_name.encode("utf-8")
+    header = struct.pack(
+        REQUEST_FORMAT, BINARY_MAGIC, flags, family, len(encoded_name), port
+    )
+    return header + packed_host + encoded_name
+
+
+def check_name(name):
+    """ユーザー名・部屋名に使えるかを確認する
+
+    Args:
+        name (str): ユーザー名または部屋名
+
+    Returns:
+        str: name
+
+    Raises:
+        ValueError: 制御フレームと区別できない名前の場合
+
+    Note:
+        中継する行は「ユーザー名: メッセージ」で始まるため、CONTROL_PREFIXで始まる名前を許すと
+        利用者が他のクライアントに制御フレームを偽装して送れてしまう。
+    """
+    if name.startswith(chr(CONTROL_PREFIX)):
+        raise ValueError("Names must not start with the control prefix.")
+    return name
+
+
+def decode_join_request(payload):
+    """部屋作成・参加リクエストのペイロードを解析する
+
+    Args:
+        payload (bytes): ペイロード
+
+    Returns:
+        dict: user_name, user_address, flags, binary をキーとする辞書
+
+    Raises:
+        ValueError: ペイロードの形式が不正な場合・ユーザー名が制御フレームと区別できない場合
+    """
+    if not is_binary(payload):
+        data = json.loads(payload.decode("utf-8"))
+        return {
+            "user_name": check_name(data["user_name"]),
+            "user_address": tuple(data["user_address"]),
+            "flags": data.get("flags", 0),
+            "binary": False,
+        }
+
+    _, flags, family, name_size, port = struct.unpack_from(REQUEST_FORMAT, payload)
+    if family == 4:
+        address_family, host_size = socket.AF_INET, 4
+    elif family == 6:
+        address_family, host_size = socket.AF_INET6, 16
+    else:
+        raise ValueError(f"Unknown address family {family}.")
+    host_end = REQUEST_HEADER_SIZE + host_size
+    if len(payload) != host_end + name_size:
+        raise ValueError("Invalid binary payload size.")
+    host = socket.inet_ntop(address_family, payload[REQUEST_HEADER_SIZE:host_end])
+    return {
+        "user_name": check_name(payload[host_end:].decode("utf-8")),
+        "user_address": (host, port),
+        "flags": flags,
+        "binary": True,
+    }
+
+
+def encode_join_response(
+    status,
+    token,
+    operation,
+    room_name,
+    binary=False,
+    session_id=None,
+    redirect=None,
+    multicast=None,
+):
+    """部屋作成・参加リクエストに対するレスポンスのペイロードを生成する
+
+    Args:
+        status (int): ステータスコード
+        token (str): 16進数文字列のトークン(完了時以外は空文字)
+        operation (int): アクション番号(1:部屋作成, 2:参加)
+        room_name (str): 部屋名
+        binary (bool): バイナリ形式にするかどうか
+        session_id (int): 発行したセッションID(発行していない場合はNone)
+        redirect (tuple): リダイレクト先の (ホスト, TCPポート, UDPポート)
+        multicast (tuple): 中継を受け取るマルチキャストグループの (IPアドレス, ポート)
+            (セッションIDを発行した場合のみ)
+
+    Returns:
+        bytes: ペイロード
+    """
+    if not binary:
+        payload = {
+            "status": status,
+            "message": describe_status(status, operation, room_name),
+        }
+        if status == STATUS_COMPLETED:
+            payload["token"] = token
+            if session_id is not None:
+                payload["session_id"] = session_id
+            if multicast is not None:
+                payload["multicast"] = list(multicast)
+        if status == STATUS_REDIRECT:
+            payload["redirect"] = list(redirect)
+        return json.dumps(payload).encode("utf-8")
+
+    raw_token = bytes.fromhex(token) if token else b""
+    response = struct.pack(RESPONSE_FORMAT, BINARY_MAGIC, status, len(raw_token))
+    if status == STATUS_COMPLETED and session_id is not None:
+        response += raw_token + encode_session_id(session_id)
+        if multicast is not None:
+            group, port = multicast
+            response += struct.pack(MULTICAST_FORMAT, socket.inet_aton(group), port)
+        return response
+    if status == STATUS_REDIRECT:
+        host, tcp_port, udp_port = redirect
+        encoded_host = host.encode("utf-8")
+        return (
+            response
+            + struct.pack(REDIRECT_FORMAT, tcp_port, udp_port, len(encoded_host))
+            + encoded_host
+        )
+    return response + raw_token
+
+
+def decode_join_response(payload, operation, room_name):
+    """部屋作成・参加リクエストに対するレスポンスのペイロードを解析する
+
+    Args:
+        payload (bytes): ペイロード
+        operation (int): アクション番号(1:部屋作成, 2:参加)
+        room_name (str): 部屋名
+
+    Returns:
+        dict: status, message, token・session_id・multicast(完了時のみ),
+            redirect(リダイレクト時のみ、(ホスト, TCPポート, UDPポート)) をキーとする辞書
+    """
+    if not is_binary(payload):
+        response = json.loads(payload.decode("utf-8"))
+        if "redirect" in response:
+            response["redirect"] = tuple(response["redirect"])
+        return response
+
+    _, status, token_size = struct.unpack_from(RESPONSE_FORMAT, payload)
+    response = {
+        "status": status,
+        "message": describe_status(status, operation, room_name),
+    }
+    if status == STATUS_COMPLETED:
+        token_end = RESPONSE_HEADER_SIZE + token_size
+        response["token"] = payload[RESPONSE_HEADER_SIZE:token_end].hex()
+        if len(payload) >= token_end + SESSION_ID_SIZE:
+            (response["session_id"],) = struct.unpack_from(
+                SESSION_ID_FORMAT, payload, token_end
+            )
+            multicast_start = token_end + SESSION_ID_SIZE
+            if len(payload) >= multicast_start + MULTICAST_SIZE:
+                group, port = struct.unpack_from(
+                    MULTICAST_FORMAT, payload, multicast_start
+                )
+                response["multicast"] = (socket.inet_ntoa(group), port)
+    elif status == STATUS_REDIRECT:
+        tcp_port, udp_port, host_size = struct.unpack_from(
+            REDIRECT_FORMAT, payload, RESPONSE_HEADER_SIZE
+        )
+        host_start = RESPONSE_HEADER_SIZE + REDIRECT_SIZE
+        host = payload[host_start : host_start + host_size].decode("utf-8")
+        response["redirect"] = (host, tcp_port, udp_port)
+    return response
+
+
+def encode_list_request(cursor="", limit=0, binary=True):
+    """部屋の一覧リクエストのペイロードを生成する(検索する部屋名の先頭はヘッダーの部屋名に入れる)
+
+    Args:
+        cursor (str): 前回のレスポンスの続きのカーソル(空文字なら最初から)
+        limit (int): 返してほしい部屋数(0ならサーバーの上限)
+        binary (bool): バイナリ形式にするかどうか(Falseの場合はJSON形式)
+
+    Returns:
+        bytes: ペイロード
+    """
+    if not binary:
+        return json.dumps({"cursor": cursor, "limit": limit}).encode("utf-8")
+    encoded_cursor = cursor.encode("utf-8")
+    return (
+        struct.pack(LIST_REQUEST_FORMAT, BINARY_MAGIC, limit, len(encoded_cursor))
+        + encoded_cursor
+    )
+
+
+def decode_list_request(payload):
+    """部屋の一覧リクエストのペイロードを解析する
+
+    Returns:
+        dict: cursor, limit, binary をキーとする辞書
+
+    Raises:
+        ValueError: ペイロードの形式が不正な場合
+    """
+    if not is_binary(payload):
+        data = json.loads(payload.decode("utf-8")) if payload else {}
+        return {
+            "cursor": data.get("cursor", ""),
+            "limit": int(data.get("limit", 0)),
+            "binary": False,
+        }
+    _, limit, cursor_size = struct.unpack_from(LIST_REQUEST_FORMAT, payload)
+    if len(payload) != LIST_REQUEST_SIZE + cursor_size:
+        raise ValueError("Invalid list request size.")
+    return {
+        "cursor": payload[LIST_REQUEST_SIZE:].decode("utf-8"),
+        "limit": limit,
+        "binary": True,
+    }
+
+
+def encode_list_response(status, rooms, cursor, binary=False):
+    """部屋の一覧リクエストに対するレスポンスのペイロードを生成する
+
+    Args:
+        status (int): ステータスコード
+        rooms (list): (部屋名, 人数) のリスト(255件まで)
+        cursor (str): 続きのカーソル(最後まで返した場合は空文字)
+        binary (bool): バイナリ形式にするかどうか
+
+    Returns:
+        bytes: ペイロード
+    """
+    if not binary:
+        payload = {
+            "status": status,
+            "message": describe_status(status, LIST_ROOMS_NUM, ""),
+            "rooms": [list(room) for room in rooms],
+            "cursor": cursor,
+        }
+        return json.dumps(payload).encode("utf-8")
+
+    encoded_cursor = cursor.encode("utf-8")
+    parts = [
+        struct.pack(
+            LIST_RESPONSE_FORMAT, BINARY_MAGIC, status, len(rooms), len(encoded_cursor)
+        )
+    ]
+    for room_name, members in rooms:
+        encoded_room_name = room_name.encode("utf-8")
+        parts.append(struct.pack(LIST_ENTRY_FORMAT, len(encoded_room_name), members))
+        parts.append(encoded_room_name)
+    parts.append(encoded_cursor)
+    return b"".join(parts)
+
+
+def decode_list_response(payload):
+    """部屋の一覧リクエストに対するレスポンスのペイロードを解析する
+
+    Note:
+        エラーのレスポンスは部屋作成・参加と同じ形式で返るため、ステータスコードだけを読む。
+
+    Returns:
+        dict: status, message, rooms((部屋名, 人数) のリスト), cursor をキーとする辞書
+    """
+    if not is_binary(payload):
+        response = json.loads(payload.decode("utf-8"))
+        response["rooms"] = [tuple(room) for room in response.get("rooms", [])]
+        response.setdefault("cursor", "")
+        return response
+
+    _, status = struct.unpack_from("!B H", payload)
+    response = {
+        "status": status,
+        "message": describe_status(status, LIST_ROOMS_NUM, ""),
+        "rooms": [],
+        "cursor": "",
+    }
+    if status != STATUS_COMPLETED:
+        return response
+    _, _, count, cursor_size = struct.unpack_from(LIST_RESPONSE_FORMAT, payload)
+    offset = LIST_RESPONSE_SIZE
+    for _ in range(count):
+        name_size, members = struct.unpack_from(LIST_ENTRY_FORMAT, payload, offset)
+        offset += LIST_ENTRY_SIZE
+        response["rooms"].append(
+            (payload[offset : offset + name_size].decode("utf-8"), members)
+        )
+        offset += name_size
+    response["cursor"] = payload[offset : offset + cursor_size].decode("utf-8")
+    return response
+
+
+# UDPの制御メッセージ・制御フレーム
+# クライアントからの制御メッセージは、メッセージ部分がCONTROL_PREFIX + 種別で始まる
+# サーバーからの制御フレームは、データグラム全体がCONTROL_PREFIX + 種別で始まる
+CONTROL_PREFIX = 0x00
+# 履歴の要求: 種別の後に受信済みの最後のシーケンス番号(!Q)が続く
+OP_HISTORY = 0x01
+# 履歴の応答: 種別の後に件数(!H)と、(シーケンス番号(!Q), バイト数(!H), メッセージ)の並びが続く
+FRAME_HISTORY = 0x01
+# 中継のまとめ送り: 履歴の応答と同じ形式で、flush windowの間に届いたメッセージを1つにまとめる
+FRAME_BATCH = 0x02
+# 再送・順序保証付きの中継: 種別の後に送信者の世代(!H)、受信者ごとのシーケンス番号(!I)と、
+# 中継するデータグラムが続く。世代はサーバーがシーケンス番号を1からやり直すたびに変わる
+FRAME_RELIABLE = 0x03
+RELIABLE_HEADER_FORMAT = "!B B H I"
+RELIABLE_HEADER_SIZE = struct.calcsize(RELIABLE_HEADER_FORMAT)
+# 再送・順序保証付きの中継の確認応答: 種別の後に受信中の世代(!H)、順番どおり受信済みの最後の
+# シーケンス番号(!I)、範囲の数(!B)と、それより後で受信済みの範囲(先頭(!I), 末尾(!I))の並びが続く
+OP_ACK = 0x02
+ACK_FORMAT = "!B B H I B"
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+ACK_RANGE_FORMAT = "!I I"
+ACK_RANGE_SIZE = struct.calcsize(ACK_RANGE_FORMAT)
+MAX_ACK_RANGES = 16
+# 大きなメッセージの分割送信(fragment.pyを参照)
+# クライアントからの断片: 種別の後にメッセージID(!I)、断片の番号(!H)、断片の数(!H)、
+# メッセージ全体のバイト数(!I)と、断片のデータが続く
+OP_FRAGMENT = 0x03
+FRAGMENT_FORMAT = "!B B I H H I"
+FRAGMENT_HEADER_SIZE = struct.calcsize(FRAGMENT_FORMAT)
+# 中継する断片: 種別、メッセージID、断片の番号、断片の数、メッセージ全体のバイト数(送信者の
+# 「ユーザー名: 」を含まない)、「ユーザー名: 」のバイト数(!B) の後に「ユーザー名: 」と断片のデータが続く
+FRAME_FRAGMENT = 0x04
+FRAGMENT_FRAME_FORMAT = "!B B I H H I B"
+FRAGMENT_FRAME_HEADER_SIZE = struct.calcsize(FRAGMENT_FRAME_FORMAT)
+# 最後以外の断片のデータのバイト数(部屋名とトークンを付けてもIPフラグメントが起きにくいサイズ)
+FRAGMENT_SIZE = 1024
+# 分割して送れるメッセージの最大バイト数
+MAX_MESSAGE_SIZE = 64 * 1024
+# 圧縮した中継(compression.pyを参照): 種別の後に辞書ID(!I)と、中継するデータグラムを
+# 辞書で圧縮したデータ(raw deflate)が続く。辞書IDが0の場合は辞書を使わない
+FRAME_COMPRESSED = 0x05
+# 圧縮の辞書: 種別の後に辞書ID(!I)と辞書のデータが続く
+FRAME_DICTIONARY = 0x06
+DICTIONARY_HEADER_FORMAT = "!B B I"
+DICTIONARY_HEADER_SIZE = struct.calcsize(DICTIONARY_HEADER_FORMAT)
+# 辞書の要求(知らない辞書IDの圧縮データを受け取った場合): 種別の後に辞書ID(!I)が続く
+OP_DICTIONARY = 0x04
+# マルチキャストの中継をやめ、ユニキャストで受け取る(グループに参加できなかったクライアント用)
+OP_UNICAST = 0x05
+# 部屋名付きのフレーム(FLAG_ROOM_TAGを指定したユーザーのみ): 種別の後に部屋名のバイト数(!B)と
+# 部屋名が続き、その後に他のユーザーと同じデータグラム(制御フレームを含む)が続く
+FRAME_ROOM = 0x07
+ROOM_TAG_FORMAT = "!B B B"
+ROOM_TAG_SIZE = struct.calcsize(ROOM_TAG_FORMAT)
+# マルチキャストで中継するフレーム: CONTROL_PREFIX, FRAME_MULTICAST, 部屋名のバイト数,
+# 受け取らないユーザーの数 の後に部屋名、そのユーザーのセッションID(!I)、中継するデータグラムが続く
+FRAME_MULTICAST = 0x08
+MULTICAST_FRAME_FORMAT = "!B B B B"
+MULTICAST_FRAME_HEADER_SIZE = struct.calcsize(MULTICAST_FRAME_FORMAT)
+HISTORY_ENTRY_FORMAT = "!Q H"
+HISTORY_ENTRY_SIZE = struct.calcsize(HISTORY_ENTRY_FORMAT)
+# 1つのデータグラムに詰めるバイト数の上限(IPフラグメントが起きにくいサイズ)
+MAX_FRAME_SIZE = 1400
+
+
+def is_control(data):
+    """制御メッセージ・制御フレームかどうか"""
+    return len(data) > 1 and data[0] == CONTROL_PREFIX
+
+
+def encode_history_request(room_name, token, since_seq):
+    """履歴を要求するデータグラムを生成する
+
+    Args:
+        room_name (str): 部屋名
+        token (str): トークン
+        since_seq (int): 受信済みの最後のシーケンス番号(この番号より後を要求する)
+
+    Returns:
+        bytes: 送信データ
+    """
+    return encode_chat_datagram(room_name, token, "") + encode_history_control(since_seq)
+
+
+def encode_history_control(since_seq):
+    """履歴を要求する制御メッセージ(データグラムのメッセージ部分)を生成する"""
+    return struct.pack("!B B Q", CONTROL_PREFIX, OP_HISTORY, since_seq)
+
+
+def encode_history_frames(entries, max_size=MAX_FRAME_SIZE, kind=FRAME_HISTORY):
+    """履歴をmax_sizeバイト以下のデータグラムにまとめる
+
+    Args:
+        entries (list): (シーケンス番号, メッセージ) のリスト
+        max_size (int): 1つのデータグラムの最大バイト数
+        kind (int): 制御フレームの種別(FRAME_HISTORY または FRAME_BATCH)
+
+    Returns:
+        list: データグラムのリスト
+    """
+    frames = []
+    chunks = []
+    size = 4
+    for seq, data in entries:
+        entry_size = HISTORY_ENTRY_SIZE + len(data)
+        if chunks and size + entry_size > max_size:
+            frames.append(_pack_history_frame(kind, chunks))
+            chunks = []
+            size = 4
+        chunks.append(struct.pack(HISTORY_ENTRY_FORMAT, seq, len(data)) + data)
+        size += entry_size
+    if chunks:
+        frames.append(_pack_history_frame(kind, chunks))
+    return frames
+
+
+def encode_batch_frames(entries, max_size=MAX_FRAME_SIZE):
+    """まとめ送りするメッセージをmax_sizeバイト以下のデータグラムにまとめる
+
+    Args:
+        entries (list): (シーケンス番号, メッセージ) のリスト
+        max_size (int): 1つのデータグラムの最大バイト数
+
+    Returns:
+        list: データグラムのリスト
+    """
+    return encode_history_frames(entries, max_size, FRAME_BATCH)
+
+
+def _pack_history_frame(kind, chunks):
+    header = struct.pack("!B B H", CONTROL_PREFIX, kind, len(chunks))
+    return header + b"".join(chunks)
+
+
+def decode_history_frame(data):
+    """履歴の応答・まとめ送りのフレームを(シーケンス番号, メッセージ)のリストに変換する
+
+    Args:
+        data (bytes): 受信データ
+
+    Returns:
+        list: (シーケンス番号, メッセージ) のリスト
+    """
+    _, _, count = struct.unpack_from("!B B H", data)
+    entries = []
+    offset = 4
+    for _ in range(count):
+        seq, size = struct.unpack_from(HISTORY_ENTRY_FORMAT, data, offset)
+        offset += HISTORY_ENTRY_SIZE
+        entries.append((seq, data[offset : offset + size]))
+        offset += size
+    return entries
+
+
+def encode_reliable_frame(seq, data, epoch=0):
+    """中継するデータグラムを再送・順序保証付きのフレームにする
+
+    Args:
+        seq (int): 受信者ごとのシーケンス番号
+        data (bytes): 中継するデータグラム(チャットメッセージまたは制御フレーム)
+        epoch (int): 送信者の世代
+
+    Returns:
+        bytes: 送信データ
+    """
+    header = struct.pack(
+        RELIABLE_HEADER_FORMAT, CONTROL_PREFIX, FRAME_RELIABLE, epoch, seq
+    )
+    return header + data
+
+
+def decode_reliable_frame(data):
+    """再送・順序保証付きのフレームを(世代, シーケンス番号, 中継されたデータグラム)に変換する"""
+    _, _, epoch, seq = struct.unpack_from(RELIABLE_HEADER_FORMAT, data)
+    return epoch, seq, data[RELIABLE_HEADER_SIZE:]
+
+
+def encode_ack_control(cumulative, ranges=(), epoch=0):
+    """確認応答の制御メッセージ(データグラムのメッセージ部分)を生成する
+
+    Args:
+        cumulative (int): 順番どおり受信済みの最後のシーケンス番号
+        ranges (list): それより後で受信済みの範囲 (先頭, 末尾) のリスト(MAX_ACK_RANGES個まで)
+        epoch (int): 受信中の送信者の世代
+
+    Returns:
+        bytes: 制御メッセージ
+    """
+    ranges = list(ranges)[:MAX_ACK_RANGES]
+    header = struct.pack(
+        ACK_FORMAT, CONTROL_PREFIX, OP_ACK, epoch, cumulative, len(ranges)
+    )
+    return header + b"".join(struct.pack(ACK_RANGE_FORMAT, *r) for r in ranges)
+
+
+def decode_ack_control(message):
+    """確認応答の制御メッセージを(世代, 順番どおり受信済みの最後の番号, 範囲のリスト)に変換する"""
+    _, _, epoch, cumulative, count = struct.unpack_from(ACK_FORMAT, message)
+    count = min(count, MAX_ACK_RANGES)
+    ranges = [
+        struct.unpack_from(ACK_RANGE_FORMAT, message, ACK_SIZE + i * ACK_RANGE_SIZE)
+        for i in range(count)
+    ]
+    return epoch, cumulative, ranges
+
+
+def encode_fragment_controls(message_id, data):
+    """メッセージを断片の制御メッセージ(データグラムのメッセージ部分)に分割する
+
+    Args:
+        message_id (int): 送信者ごとのメッセージID
+        data (bytes): エンコード済みのメッセージ(MAX_MESSAGE_SIZEバイトまで)
+
+    Returns:
+        list: 制御メッセージのリスト(断片の番号の順)
+    """
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message size {len(data)} is too large.")
+    count = max(-(-len(data) // FRAGMENT_SIZE), 1)
+    return [
+        struct.pack(
+            FRAGMENT_FORMAT,
+            CONTROL_PREFIX,
+            OP_FRAGMENT,
+            message_id,
+            index,
+            count,
+            len(data),
+        )
+        + data[index * FRAGMENT_SIZE : (index + 1) * FRAGMENT_SIZE]
+        for index in range(count)
+    ]
+
+
+def decode_fragment_control(message):
+    """断片の制御メッセージを(メッセージID, 番号, 数, 全体のバイト数, データ)に変換する
+
+    Raises:
+        ValueError: 断片の番号・数・バイト数が一致しない場合
+    """
+    _, _, message_id, index, count, total = struct.unpack_from(
+        FRAGMENT_FORMAT, message
+    )
+    chunk = message[FRAGMENT_HEADER_SIZE:]
+    expected_count = max(-(-total // FRAGMENT_SIZE), 1)
+    if (
+        total > MAX_MESSAGE_SIZE
+        or count != expected_count
+        or index >= count
+        or len(chunk) != min(FRAGMENT_SIZE, total - index * FRAGMENT_SIZE)
+    ):
+        raise ValueError(f"Invalid fragment {index}/{count} of {total} bytes")
+    return message_id, index, count, total, chunk
+
+
+def encode_fragment_frame(prefix, message_id, index, count, total, chunk):
+    """断片を中継するフレームを生成する
+
+    Args:
+        prefix (bytes): 送信者の「ユーザー名: 」(エンコード済み)
+        message_id (int): 送信者ごとのメッセージID
+        index (int): 断片の番号
+        count (int): 断片の数
+        total (int): メッセージ全体のバイト数
+        chunk (bytes): 断片のデータ
+
+    Returns:
+        bytes: 送信データ
+    """
+    header = struct.pack(
+        FRAGMENT_FRAME_FORMAT,
+        CONTROL_PREFIX,
+        FRAME_FRAGMENT,
+        message_id,
+        index,
+        count,
+        total,
+        len(prefix),
+    )
+    return header + prefix + chunk
+
+
+def decode_fragment_frame(data):
+    """断片を中継するフレームを(送信者の「ユーザー名: 」, メッセージID, 番号, 数, 全体のバイト数, データ)に変換する"""
+    _, _, message_id, index, count, total, prefix_size = struct.unpack_from(
+        FRAGMENT_FRAME_FORMAT, data
+    )
+    prefix_end = FRAGMENT_FRAME_HEADER_SIZE + prefix_size
+    prefix = bytes(data[FRAGMENT_FRAME_HEADER_SIZE:prefix_end])
+    return prefix, message_id, index, count, total, data[prefix_end:]
+
+
+def encode_dictionary_frame(kind, dictionary_id, data=b""):
+    """圧縮した中継・辞書のフレームを生成する
+
+    Args:
+        kind (int): FRAME_COMPRESSED または FRAME_DICTIONARY
+        dictionary_id (int): 辞書ID
+        data (bytes): 圧縮したデータまたは辞書
+
+    Returns:
+        bytes: 送信データ
+    """
+    return struct.pack(DICTIONARY_HEADER_FORMAT, CONTROL_PREFIX, kind, dictionary_id) + data
+
+
+def decode_dictionary_frame(data):
+    """圧縮した中継・辞書のフレームを(辞書ID, データ)に変換する"""
+    _, _, dictionary_id = struct.unpack_from(DICTIONARY_HEADER_FORMAT, data)
+    return dictionary_id, data[DICTIONARY_HEADER_SIZE:]
+
+
+def encode_dictionary_control(dictionary_id):
+    """辞書を要求する制御メッセージ(データグラムのメッセージ部分)を生成する"""
+    return struct.pack(DICTIONARY_HEADER_FORMAT, CONTROL_PREFIX, OP_DICTIONARY, dictionary_id)
+
+
+def encode_room_tag(room_name):
+    """部屋名付きのフレームの先頭部分を生成する(これに中継するデータグラムをつなげる)
+
+    Args:
+        room_name (str): 部屋名
+
+    Returns:
+        bytes: フレームの先頭部分
+    """
+    encoded_room_name = room_name.encode("utf-8")
+    return (
+        struct.pack(ROOM_TAG_FORMAT, CONTROL_PREFIX, FRAME_ROOM, len(encoded_room_name))
+        + encoded_room_name
+    )
+
+
+def decode_room_frame(data):
+    """部屋名付きのフレームを(部屋名, 中継されたデータグラム)に変換する
+
+    Raises:
+        ValueError: フレームの長さが部屋名のバイト数より短い場合
+    """
+    room_name_end = ROOM_TAG_SIZE + data[2]
+    if len(data) < room_name_end:
+        raise ValueError("Truncated room frame.")
+    return str(data[ROOM_TAG_SIZE:room_name_end], "utf-8"), data[room_name_end:]
+
+
+def encode_multicast_frame(encoded_room_name, excluded, data):
+    """マルチキャストで中継するフレームを生成する
+
+    Args:
+        encoded_room_name (bytes): UTF-8エンコード済みの部屋名
+        excluded (list): 受け取らないユーザー(送信者など)のセッションID(255件まで)
+        data (bytes): 中継するデータグラム
+
+    Returns:
+        bytes: 送信データ
+    """
+    return (
+        struct.pack(
+            MULTICAST_FRAME_FORMAT,
+            CONTROL_PREFIX,
+            FRAME_MULTICAST,
+            len(encoded_room_name),
+            len(excluded),
+        )
+        + encoded_room_name
+        + struct.pack(f"!{len(excluded)}I", *excluded)
+        + data
+    )
+
+
+def decode_multicast_frame(data):
+    """マルチキャストで中継するフレームを(部屋名, 受け取らないセッションID, データグラム)に変換する
+
+    Raises:
+        ValueError: フレームの長さが部屋名とセッションIDのバイト数より短い場合
+    """
+    _, _, room_name_size, excluded_count = struct.unpack_from(
+        MULTICAST_FRAME_FORMAT, data
+    )
+    room_name_end = MULTICAST_FRAME_HEADER_SIZE + room_name_size
+    excluded_end = room_name_end + excluded_count * SESSION_ID_SIZE
+    if len(data) < excluded_end:
+        raise ValueError("Truncated multicast frame.")
+    excluded = struct.unpack_from(f"!{excluded_count}I", data, room_name_end)
+    room_name = str(data[MULTICAST_FRAME_HEADER_SIZE:room_name_end], "utf-8")
+    return room_name, excluded, data[excluded_end:]
+
+
+def encode_unicast_control():
+    """マルチキャストからユニキャストの中継に戻す制御メッセージを生成する"""
+    return bytes((CONTROL_PREFIX, OP_UNICAST))
@@ -0,0 +1,45 @@
+class TokenBucket:
+    """トークンバケットによる流量制限
+
+    Note:
+        1秒あたりrate個のトークンが最大burst個まで溜まり、送信のたびにコスト分を消費する。
+        トークンは必要になったときに経過時間から補充するので、タイマーは使わない。
+        wait_timeで送信できるまでの秒数を調べてからtakeで消費する。takeはトークンが足りなくても
+        前借り(負の値)して消費し、前借りした分だけ次のwait_timeが延びる。
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        """
+        Args:
+            rate (float): 1秒あたりに補充するトークン数
+            burst (float): 溜められるトークンの最大数
+            now (float): 現在時刻(time.monotonic)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def __refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, cost, now):
+        """cost分のトークンが溜まるまでの秒数(すぐに送信できる場合は0)
+
+        Note:
+            burstを超えるコストはburstとして扱い、どんなに大きな送信でもいずれは通るようにする。
+        """
+        self.__refill(now)
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost, now):
+        """cost分のトークンを消費する(足りない場合は前借りする)"""
+        self.__refill(now)
+        self.tokens -= min(cost, self.burst)
@@ -0,0 +1,201 @@
+"""任意で使える、UDPの中継の再送・順序保証
+
+ハンドシェイクでFLAG_RELIABLEを指定したユーザーには、サーバーが受信者ごとのシーケンス番号を
+付けたフレーム(protocol.FRAME_RELIABLE)で中継し、確認応答(protocol.OP_ACK)が届くまで保持する。
+確認応答は順番どおり受信済みの最後の番号と、それより後で受信済みの範囲(選択的確認応答)からなる。
+確認応答のない状態が再送タイムアウト(往復時間から求める)を過ぎたフレームは再送する。
+未確認のフレームはWINDOW個までで、それを超えた分はBACKLOG件まで送信を待たせる。
+受信側(ReliableReceiver)は番号の順に並べ直してから表示する。
+サーバーが再起動して追記型ログから復元したユーザーは、シーケンス番号を1からやり直すため、
+送信者の世代(epoch)を変えて送る。受信側は世代が変わったら受信済みの番号を捨てて1から受け取り直し、
+確認応答にも受信中の世代を付けて、古い世代への確認応答が新しいフレームを消さないようにする。
+指定していないユーザーへの中継は、これまでどおり送信するだけで再送しない。
+"""
+
+import collections
+
+import protocol
+
+
+class ReliableSender:
+    """サーバー側の、受信者1人分の未確認のフレームと再送タイムアウト"""
+
+    __slots__ = (
+        "epoch",
+        "next_seq",
+        "unacked",
+        "backlog",
+        "srtt",
+        "rttvar",
+        "rto",
+        "timer_scheduled",
+    )
+
+    WINDOW = 256
+    BACKLOG = 1024
+    INITIAL_RTO = 0.2
+    MIN_RTO = 0.05
+    MAX_RTO = 2.0
+
+    def __init__(self, epoch=0):
+        """
+        Args:
+            epoch (int): 送信者の世代(シーケンス番号を1からやり直すときに変える)
+        """
+        self.epoch = epoch
+        self.next_seq = 1
+        # シーケンス番号:[フレーム, 最後に送信した時刻, 再送したかどうか](番号の順)
+        self.unacked = {}
+        self.backlog = collections.deque()  # 未確認のフレームが多いため送信を待っているデータ
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = self.INITIAL_RTO
+        # 再送のタイマーを登録済みかどうか
+        self.timer_scheduled = False
+
+    def send(self, data, now):
+        """データにシーケンス番号を付ける
+
+        Args:
+            data (bytes): 中継するデータグラム
+            now (float): 現在時刻(time.monotonic)
+
+        Returns:
+            list: すぐに送信するフレームのリスト(送信待ちにした場合は空)。
+                送信待ちも一杯で破棄した場合はNone
+        """
+        if len(self.unacked) >= self.WINDOW:
+            if len(self.backlog) >= self.BACKLOG:
+                return None
+            self.backlog.append(bytes(data))
+            return []
+        return [self.__frame(data, now)]
+
+    def __frame(self, data, now):
+        seq = self.next_seq
+        self.next_seq += 1
+        frame = protocol.encode_reliable_frame(seq, data, self.epoch)
+        self.unacked[seq] = [frame, now, False]
+        return frame
+
+    def on_ack(self, cumulative, ranges, now, epoch=0):
+        """確認応答を受け取ったフレームを削除し、往復時間から再送タイムアウトを更新する
+
+        Args:
+            cumulative (int): 順番どおり受信済みの最後のシーケンス番号
+            ranges (list): それより後で受信済みの範囲 (先頭, 末尾) のリスト
+            now (float): 現在時刻(time.monotonic)
+            epoch (int): 確認応答の世代(この送信者の世代と異なる場合は無視する)
+
+        Returns:
+            list: 空きができたため送信待ちから送信するフレームのリスト
+        """
+        if epoch != self.epoch:
+            return []
+        acked = []
+        for seq in self.unacked:
+            if seq <= cumulative:
+                acked.append(seq)
+            elif not ranges:
+                break
+            elif any(start <= seq <= end for start, end in ranges):
+                acked.append(seq)
+        # 再送していないフレームの往復時間だけを使う(再送した場合はどちらへの応答か分からない)
+        sent_at = None
+        for seq in acked:
+            _, sent, retransmitted = self.unacked.pop(seq)
+            if not retransmitted and (sent_at is None or sent > sent_at):
+                sent_at = sent
+        if sent_at is not None:
+            self.__update_rto(now - sent_at)
+
+        frames = []
+        while self.backlog and len(self.unacked) < self.WINDOW:
+            frames.append(self.__frame(self.backlog.popleft(), now))
+        return frames
+
+    def __update_rto(self, rtt):
+        """往復時間の平滑値と変動から再送タイムアウトを求める(RFC 6298)"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+
+    def poll(self, now):
+        """再送タイムアウトを過ぎたフレームを返す
+
+        Args:
+            now (float): 現在時刻(time.monotonic)
+
+        Returns:
+            tuple: (再送するフレームのリスト, 次に確認するまでの秒数(未確認のフレームがなければNone))
+        """
+        frames = []
+        for entry in self.unacked.values():
+            if entry[1] + self.rto <= now:
+                frames.append(entry[0])
+                entry[1] = now
+                entry[2] = True
+        if frames:
+            # 再送が続く場合はタイムアウトを倍にして、混雑したネットワークに送りすぎないようにする
+            self.rto = min(self.rto * 2, self.MAX_RTO)
+        if not self.unacked:
+            return frames, None
+        oldest = min(entry[1] for entry in self.unacked.values())
+        return frames, max(oldest + self.rto - now, 0)
+
+
+class ReliableReceiver:
+    """クライアント側の、受信したフレームを番号の順に並べ直すバッファ"""
+
+    WINDOW = 4096
+
+    def __init__(self):
+        self.epoch = None  # 受信中の送信者の世代(まだ受信していなければNone)
+        self.expected = 1  # 次に表示するシーケンス番号
+        self.buffer = {}  # 先に届いたフレーム(シーケンス番号:データグラム)
+
+    def receive(self, seq, data, epoch=0):
+        """フレームを受け取り、順番どおりに表示できるデータグラムを返す
+
+        Args:
+            seq (int): シーケンス番号
+            data (bytes): 中継されたデータグラム
+            epoch (int): 送信者の世代
+
+        Returns:
+            list: 表示するデータグラムのリスト(番号の順)
+        """
+        if epoch != self.epoch:
+            # 送信者がシーケンス番号をやり直したので、前の世代の受信状態を捨てる
+            self.epoch = epoch
+            self.expected = 1
+            self.buffer = {}
+        if seq < self.expected or seq >= self.expected + self.WINDOW:
+            return []
+        self.buffer[seq] = data
+        delivered = []
+        while self.expected in self.buffer:
+            delivered.append(self.buffer.pop(self.expected))
+            self.expected += 1
+        return delivered
+
+    def ack(self):
+        """確認応答の内容
+
+        Returns:
+            tuple: (順番どおり受信済みの最後のシーケンス番号, 先に届いた範囲のリスト)
+                (送信者の世代はepochを参照する)
+        """
+        ranges = []
+        for seq in sorted(self.buffer):
+            if ranges and ranges[-1][1] == seq - 1:
+                ranges[-1][1] = seq
+            elif len(ranges) < protocol.MAX_ACK_RANGES:
+                ranges.append([seq, seq])
+            else:
+                break
+        return self.expected - 1, [tuple(r) for r in ranges]
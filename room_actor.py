@@ -0,0 +1,194 @@
+import collections
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from log import get_logger
+
+logger = get_logger("server")
+
+
+class RoomActor:
+    """1つの部屋宛ての処理を到着順に保持する受信キュー"""
+
+    __slots__ = ("key", "mailbox", "scheduled", "retired")
+
+    def __init__(self, key):
+        """
+        Args:
+            key (str): 部屋名
+        """
+        self.key = key
+        self.mailbox = collections.deque()  # (Future, 関数, 引数)
+        # 実行待ちの一覧に入っているか、いずれかのスレッドが実行中かどうか
+        self.scheduled = False
+        # 部屋が終了したため、受信キューが空になったら破棄するかどうか
+        self.retired = False
+
+
+class RoomActorPool:
+    """部屋ごとのRoomActorを、CPUコア数のスレッドで実行するプール
+
+    Note:
+        同じ部屋宛ての処理(参加・退出・ホストの退出・中継)は常に1つのスレッドだけが
+        到着順に実行するため、部屋の状態はロックなしで変更できる。
+        スレッドは実行待ちの部屋を順番に取り出し、1回にBATCH件までしか処理しないので、
+        メッセージの多い部屋があっても他の部屋の処理は待たされない。
+    """
+
+    BATCH = 32
+
+    def __init__(self, workers=None, max_pending=10000):
+        """
+        Args:
+            workers (int): スレッド数(Noneの場合はCPUコア数)
+            max_pending (int): offerで受け付ける、全部屋の受信キューの合計件数の目安
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.__actors = {}  # 部屋名:RoomActor
+        self.__lock = threading.Lock()
+        self.__ready = queue.SimpleQueue()  # 実行待ちのRoomActor
+        self.__threads = []
+        self.__pending = 0  # 全部屋の受信キューの合計件数
+        self.__busy = 0  # 受信キューに処理が残っている部屋の数
+
+    def __len__(self):
+        return len(self.__actors)
+
+    @property
+    def pending(self):
+        """全部屋の受信キューに溜まっている処理の件数"""
+        return self.__pending
+
+    def start(self):
+        """スレッドを起動する"""
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.__run, name=f"room-actor-{i}", daemon=True
+            )
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        """実行中の処理が終わるのを待ってスレッドを終了する"""
+        for _ in self.__threads:
+            self.__ready.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def post(self, key, fn, *args):
+        """部屋の受信キューに処理を追加する(結果は受け取らない)
+
+        Args:
+            key (str): 部屋名
+            fn (callable): 部屋の担当スレッドで実行する関数
+            *args: fnの引数
+        """
+        self.__enqueue(key, None, fn, args)
+
+    def offer(self, key, fn, *args):
+        """受信キューが溜まりすぎていなければ処理を追加する(結果は受け取らない)
+
+        Note:
+            合計件数がmax_pendingを超えている間は、受信キューが平均(合計件数 / 処理が残っている部屋の数)
+            以上に溜まっている部屋の処理だけを断る。大量に送信されている部屋があっても、
+            他の部屋の処理は受け付け続ける。
+
+        Returns:
+            bool: 追加した場合はTrue
+        """
+        return self.__enqueue(key, None, fn, args, limited=True)
+
+    def submit(self, key, fn, *args):
+        """部屋の受信キューに処理を追加し、結果を受け取るFutureを返す
+
+        Args:
+            key (str): 部屋名
+            fn (callable): 部屋の担当スレッドで実行する関数
+            *args: fnの引数
+
+        Returns:
+            concurrent.futures.Future: fnの戻り値
+        """
+        future = Future()
+        self.__enqueue(key, future, fn, args)
+        return future
+
+    def retire(self, key):
+        """部屋が終了したときに呼び出し、受信キューが空になった時点でRoomActorを破棄する
+
+        Note:
+            破棄した後に同じ部屋名宛ての処理が届いた場合は新しいRoomActorを作る。
+            破棄は実行中でないときにだけ行うので、同じ部屋名の処理が並行して実行されることはない。
+        """
+        with self.__lock:
+            actor = self.__actors.get(key)
+            if actor is not None:
+                actor.retired = True
+
+    def __enqueue(self, key, future, fn, args, limited=False):
+        with self.__lock:
+            actor = self.__actors.get(key)
+            if (
+                limited
+                and actor is not None
+                and self.__pending >= self.max_pending
+                and len(actor.mailbox) * self.__busy >= self.__pending
+            ):
+                return False
+            if actor is None:
+                actor = RoomActor(key)
+                self.__actors[key] = actor
+            actor.mailbox.append((future, fn, args))
+            self.__pending += 1
+            if actor.scheduled:
+                return True
+            actor.scheduled = True
+            self.__busy += 1
+        self.__ready.put(actor)
+        return True
+
+    def __run(self):
+        """実行待ちの部屋を取り出し、BATCH件まで処理してから次の部屋に移る"""
+        while True:
+            actor = self.__ready.get()
+            if actor is None:
+                return
+            done = 0
+            for _ in range(self.BATCH):
+                try:
+                    future, fn, args = actor.mailbox.popleft()
+                except IndexError:
+                    break
+                self.__call(future, fn, args)
+                done += 1
+            with self.__lock:
+                self.__pending -= done
+                if actor.mailbox:
+                    requeue = True
+                else:
+                    requeue = False
+                    actor.scheduled = False
+                    self.__busy -= 1
+                    if actor.retired and self.__actors.get(actor.key) is actor:
+                        del self.__actors[actor.key]
+            # 残りがあれば他の部屋の後ろに並び直す
+            if requeue:
+                self.__ready.put(actor)
+
+    def __call(self, future, fn, args):
+        if future is None:
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.warning("Server Error:%s", e)
+            return
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
@@ -0,0 +1,117 @@
+"""部屋の一覧・前方一致検索に使う、部屋名の索引"""
+
+import bisect
+import threading
+
+
+class RoomDirectory:
+    """部屋名を辞書順に保持する索引
+
+    Note:
+        部屋名はCHUNK_SIZE件前後のソート済みリスト(チャンク)に分けて持ち、各チャンクの先頭の
+        部屋名の一覧を二分探索して位置を求める。作成・削除は二分探索(O(log n))と長さに上限のある
+        チャンク内の移動だけで済み、部屋数が増えても全体を並べ直したり走査したりしない。
+        人数は一覧を返すときに部屋(ChatRoom)から読むため、参加・退出では索引を更新しない。
+    """
+
+    # チャンクの部屋数の目安(2倍を超えたら分割する)
+    CHUNK_SIZE = 512
+    # 1回の一覧で返す部屋数の上限
+    MAX_PAGE = 100
+
+    def __init__(self, rooms=None):
+        """
+        Args:
+            rooms (dict): 最初に登録する 部屋名:ChatRoom の辞書(復元・引き継ぎ時)
+        """
+        # 部屋の担当スレッド(スレッド方式)から並行して更新されるため、ロックで守る
+        self.lock = threading.Lock()
+        self.__rooms = dict(rooms or {})
+        names = sorted(self.__rooms)
+        self.__chunks = [
+            names[i : i + self.CHUNK_SIZE] for i in range(0, len(names), self.CHUNK_SIZE)
+        ]
+        self.__heads = [chunk[0] for chunk in self.__chunks]
+
+    def __len__(self):
+        return len(self.__rooms)
+
+    def add(self, room):
+        """部屋を登録する
+
+        Args:
+            room (chat_room.ChatRoom): 作成した部屋
+        """
+        with self.lock:
+            name = room.name
+            if name in self.__rooms:
+                self.__rooms[name] = room
+                return
+            self.__rooms[name] = room
+            if not self.__chunks:
+                self.__chunks.append([name])
+                self.__heads.append(name)
+                return
+            i = max(bisect.bisect_right(self.__heads, name) - 1, 0)
+            chunk = self.__chunks[i]
+            bisect.insort(chunk, name)
+            self.__heads[i] = chunk[0]
+            if len(chunk) > self.CHUNK_SIZE * 2:
+                half = len(chunk) // 2
+                self.__chunks[i : i + 1] = [chunk[:half], chunk[half:]]
+                self.__heads.insert(i + 1, chunk[half])
+
+    def remove(self, room_name):
+        """部屋の登録を削除する
+
+        Args:
+            room_name (str): 終了した部屋名
+        """
+        with self.lock:
+            if self.__rooms.pop(room_name, None) is None:
+                return
+            i = bisect.bisect_right(self.__heads, room_name) - 1
+            chunk = self.__chunks[i]
+            del chunk[bisect.bisect_left(chunk, room_name)]
+            if chunk:
+                self.__heads[i] = chunk[0]
+            else:
+                del self.__chunks[i]
+                del self.__heads[i]
+
+    def page(self, prefix="", cursor="", limit=MAX_PAGE):
+        """部屋名がprefixで始まる部屋を、cursorの次から辞書順に返す
+
+        Args:
+            prefix (str): 部屋名の先頭(空文字なら全部屋)
+            cursor (str): 前回の一覧の続きを表すカーソル(空文字なら最初から)
+            limit (int): 返す部屋数(MAX_PAGEを超える場合と0以下の場合はMAX_PAGE)
+
+        Returns:
+            tuple: ((部屋名, 人数) のリスト, 続きのカーソル(最後まで返した場合は空文字))
+        """
+        if limit <= 0 or limit > self.MAX_PAGE:
+            limit = self.MAX_PAGE
+        rooms = []
+        with self.lock:
+            # カーソルは最後に返した部屋名で、その次の部屋から返す
+            if cursor and cursor >= prefix:
+                i = max(bisect.bisect_right(self.__heads, cursor) - 1, 0)
+                j = bisect.bisect_right(self.__chunks[i], cursor) if self.__chunks else 0
+            else:
+                i = max(bisect.bisect_right(self.__heads, prefix) - 1, 0)
+                j = bisect.bisect_left(self.__chunks[i], prefix) if self.__chunks else 0
+            while i < len(self.__chunks):
+                chunk = self.__chunks[i]
+                while j < len(chunk):
+                    name = chunk[j]
+                    # 辞書順なので、前方一致する部屋名は連続している
+                    if not name.startswith(prefix):
+                        return rooms, ""
+                    if len(rooms) == limit:
+                        return rooms, rooms[-1][0]
+                    rooms.append((name, len(self.__rooms[name].members)))
+                    j += 1
+                i += 1
+                j = 0
+        return rooms, ""
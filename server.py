@@ -1,101 +1,1072 @@
+import argparse
+import asyncio
+import collections
+import logging
+import queue
 import socket
-import json
 import secrets
+import selectors
 import struct
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
+import cluster
+import handover
+import multicast
+import signed_token
+import metrics
+import protocol
 from chat_room import ChatRoom
+from buffer_pool import BufferPool
+from coalesce import FlushTimer
+from compression import RoomCompressor
+from fanout import FanOut
+from log import configure_logging, get_logger
+from member import Member
+from rate_limit import TokenBucket
+from room_actor import RoomActorPool
+from room_directory import RoomDirectory
+from timing_wheel import TimingWheel
+from wal import WriteAheadLog
+
+logger = get_logger("server")
 
 
 class Server:
-    def __init__(self):
-        self.tcp_address = ("127.0.0.1", 9002)
-        self.udp_address = ("127.0.0.1", 9003)
-        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.tcp_socket.bind(self.tcp_address)
-        self.udp_socket.bind(self.udp_address)
+    def __init__(
+        self,
+        reuse_port=False,
+        wal=None,
+        tcp_port=9002,
+        udp_port=9003,
+        sockets=None,
+        state=None,
+    ):
+        """
+        Args:
+            reuse_port (bool): SO_REUSEPORTで複数プロセスが同じポートを共有するかどうか
+            wal (wal.WriteAheadLog): 部屋の状態を記録する追記型ログ(Noneなら記録しない)
+            tcp_port (int): ハンドシェイクを受け付けるTCPポート
+            udp_port (int): チャットメッセージを中継するUDPポート
+            sockets (tuple): 動作中のサーバーから引き継いだバインド済みの (TCPソケット, UDPソケット)
+            state (handover.RestoredState): 動作中のサーバーから引き継いだ部屋の状態
+                (指定した場合は追記型ログから復元しない)
+        """
+        self.tcp_address = ("127.0.0.1", tcp_port)
+        self.udp_address = ("127.0.0.1", udp_port)
+        if sockets is not None:
+            self.tcp_socket, self.udp_socket = sockets
+            self.tcp_address = self.tcp_socket.getsockname()
+            self.udp_address = self.udp_socket.getsockname()
+        else:
+            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # サーバー側で閉じた接続がTIME_WAITでも再起動できるようにする
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.tcp_socket.bind(self.tcp_address)
+            self.udp_socket.bind(self.udp_address)
         # room_name: ChatRoom インスタンスの辞書
         self.rooms = {}
+        # 部屋の一覧・前方一致検索用の部屋名の索引
+        self.directory = RoomDirectory()
         self.HEADER_BYTE_SIZE = 32
+        # UDPの受信バッファのバイト数
+        self.UDP_BUFFER_SIZE = 4096
+        # ハンドシェイク用TCP接続の設定
+        self.TCP_BACKLOG = 1024
+        self.TCP_TIMEOUT = 10
+        self.MAX_PAYLOAD_SIZE = 65536
         # クライアントが入力したアクション番号
         self.CREATE_ROOM_NUM = 1
         self.JOIN_ROOM_NUM = 2
-        self.QUIT_NUM = 3
+        self.LIST_ROOMS_NUM = protocol.LIST_ROOMS_NUM
         # state
         self.SERVER_INIT = 0
         self.RESPONSE_OF_REQUEST = 1
         self.REQUEST_COMPLETION = 2
         self.ERROR_RESPONSE = 3
+        self.REDIRECT_RESPONSE = 4
+        # 中継用の一括送信(asyncioモードではsendtoをトランスポートのものに差し替える)
+        self.fanout = FanOut(self.udp_socket)
+        # マルチプロセス時に部屋の担当ワーカーへ転送するルーター(workers.WorkerRouter)
+        self.router = None
+        # クラスター構成で部屋の担当ノードを決めるノード一覧(cluster.ClusterMembership)
+        self.cluster = None
+        # 署名したトークンの発行と検証(signed_token.TokenSigner、Noneならランダムなトークン)
+        self.tokens = None
+        # 部屋ごとのマルチキャストグループへの中継(multicast.MulticastGroups、Noneなら使わない)
+        self.multicast = None
+        # スレッド方式で部屋ごとの処理を担当スレッドで順番に実行するプール(room_actor.RoomActorPool)
+        # asyncioモードではすべての部屋をイベントループのスレッドで処理するため使わない
+        self.actors = None
+        # 一定時間メッセージを送信していないユーザーを退出させるためのタイミングホイール
+        # キーはmember.Member
+        self.IDLE_TIMEOUT = ChatRoom.TIMEOUT
+        self.idle_wheel = TimingWheel(now=time.monotonic())
+        self.__idle_lock = threading.Lock()
+        # バイナリのトークン・セッションIDからMember(とその部屋)を1回で引くためのインデックス
+        # (短い形式のチャットメッセージは部屋名を含まない)
+        self.sessions = {}
+        # マルチプロセス時はワーカーごとに重ならない値になるようにルーターが設定する
+        self.token_prefix = b""
+        self.next_session_id = 1
+        self.session_id_step = 1
+        self.__session_lock = threading.Lock()
+        # メッセージの多い部屋の中継をまとめて送る設定(coalesce.py)
+        # 直前の送信からCOALESCE_WINDOW秒以内に届いたメッセージを、windowの終わりか
+        # COALESCE_BYTESバイト溜まった時点で1つのフレームにまとめる(0ならまとめない)
+        self.COALESCE_WINDOW = 0.0
+        self.COALESCE_BYTES = protocol.MAX_FRAME_SIZE
+        self.__flush_timer = None
+        self.__loop = None
+        # 圧縮して受け取るユーザーに、このバイト数以上のデータグラムを圧縮して送る(compression.py)
+        self.COMPRESS_MIN_BYTES = RoomCompressor.MIN_SIZE
+        # 流量制限(rate_limit.py)の設定。0の場合は制限しない
+        # ユーザーごとの1秒あたりのメッセージ数と、連続して送信できるメッセージ数
+        self.RATE_LIMIT = 0.0
+        self.RATE_BURST = 10
+        # 部屋ごとの1秒あたりの中継バイト数(メッセージのバイト数 x 送信先数)
+        self.ROOM_BYTES_PER_SECOND = 0
+        # 制限を超えた場合の扱い: drop(破棄), delay(トークンが溜まるまで遅らせて中継),
+        # notify(破棄して送信者に通知)
+        self.RATE_POLICY = "drop"
+        # delayで遅らせる最大秒数(これより長く待つ必要がある場合は破棄する)
+        self.MAX_RELAY_DELAY = 1.0
+        # 中継待ちの処理(スレッド方式の受信キューと、delayで遅らせている中継)の合計の上限
+        self.MAX_QUEUED_RELAYS = 10000
+        # ユーザーごとに、最初の断片を中継して残りの断片を待つ分割メッセージ数の上限
+        # (超えた場合は古いメッセージの残りの断片を中継しない)
+        self.MAX_FRAGMENTED_MESSAGES = 8
+        # 引き継ぎ中に届いたデータグラムを溜めるUDPの受信バッファのバイト数
+        # (カーネルのnet.core.rmem_maxまでに制限される)
+        self.HANDOVER_RECEIVE_BUFFER = 4 * 1024 * 1024
+        # delayで遅らせている中継(id:(中継する時刻(time.monotonic), 部屋, 送信者, メッセージ))
+        self.__delayed = {}
+        self.__delayed_lock = threading.Lock()
+        # 計測値と、それをPrometheusのテキスト形式で返すTCPのアドレス(Noneなら公開しない)
+        self.metrics_address = None
+        # 動作中のサーバーから引き継いだ計測値のソケット(Noneならmetrics_addressにバインドする)
+        self.metrics_socket = None
+        # ホットリスタート(handover.py)の要求を待つUnixドメインソケットのパス(Noneなら待たない)
+        self.handover_path = None
+        # 引き継ぎ元のサーバーとの接続(受信を始めたらREADYを返す)
+        self.takeover_conn = None
+        # 新しいプロセスに引き継いだ後はTrue(タイマーや処理中の接続で状態を変えない)
+        self.handed_over = False
+        self.__restored = None
+        self.__stopped = None
+        self.__udp_transport = None
+        # asyncioモードで処理中のTCP接続(Task:asyncio.StreamReader)
+        self.__tcp_clients = {}
+        self.__init_metrics()
+        # 再起動時はログから部屋の状態を復元してから記録を再開する
+        self.wal = wal
+        if state is not None:
+            self.__adopt_state(state)
+        elif self.wal is not None:
+            self.__restore_rooms()
+        if self.wal is not None:
+            self.wal.open()
+            if state is not None:
+                # 引き継いだ状態をログの起点にする
+                self.wal.snapshot(self.rooms)
+
+    def __init_metrics(self):
+        """計測値を登録する関数"""
+        self.metrics = metrics.Registry()
+        self.datagrams_received = self.metrics.counter(
+            "chat_datagrams_received_total", "UDP datagrams received from clients"
+        )
+        self.datagrams_sent = self.metrics.counter(
+            "chat_datagrams_sent_total", "UDP datagrams sent to clients"
+        )
+        self.datagrams_dropped = self.metrics.counter(
+            "chat_datagrams_dropped_total",
+            "Datagrams dropped for an unknown room, token or session id",
+        )
+        self.room_lists = self.metrics.counter(
+            "chat_room_list_requests_total", "Room directory listings"
+        )
+        self.errors = self.metrics.counter(
+            "chat_errors_total", "Errors while handling datagrams and handshakes"
+        )
+        # 不正なリクエスト・部屋の有無・満員で断ったハンドシェイクは、エラーとは別に理由ごとに数える
+        self.handshake_rejections = self.metrics.labeled_counter(
+            "chat_handshake_rejections_total",
+            "Handshakes rejected because of the request or the room state",
+            "reason",
+        )
+        self.tokens_rejected = self.metrics.counter(
+            "chat_tokens_rejected_total",
+            "Datagrams rejected for a forged, expired or mismatched signed token",
+        )
+        self.member_rate_limited = self.metrics.counter(
+            "chat_member_rate_limited_total",
+            "Chat messages over the per-token rate limit",
+        )
+        self.room_rate_limited = self.metrics.counter(
+            "chat_room_rate_limited_total",
+            "Chat messages over the per-room relay bytes limit",
+        )
+        self.relays_delayed = self.metrics.counter(
+            "chat_relays_delayed_total", "Chat messages delayed by the rate limits"
+        )
+        self.overload_dropped = self.metrics.counter(
+            "chat_overload_dropped_total",
+            "Datagrams dropped because too much relay work was queued",
+        )
+        self.metrics.gauge(
+            "chat_queued_relays",
+            "Queued room work and delayed relays",
+            lambda: (self.actors.pending if self.actors is not None else 0)
+            + len(self.__delayed),
+        )
+        self.coalesced_messages = self.metrics.counter(
+            "chat_coalesced_messages_total", "Chat messages relayed in batch frames"
+        )
+        self.fragments_relayed = self.metrics.counter(
+            "chat_fragments_relayed_total", "Fragments of large messages relayed"
+        )
+        self.fragments_dropped = self.metrics.counter(
+            "chat_fragments_dropped_total",
+            "Fragments dropped because the first fragment of the message was not relayed",
+        )
+        self.compressed_datagrams = self.metrics.counter(
+            "chat_compressed_datagrams_total", "Relayed datagrams sent compressed"
+        )
+        self.compression_saved_bytes = self.metrics.counter(
+            "chat_compression_saved_bytes_total",
+            "Bytes saved by compressing relayed datagrams",
+        )
+        self.reliable_retransmits = self.metrics.counter(
+            "chat_reliable_retransmits_total",
+            "Reliable relay frames retransmitted after a timeout",
+        )
+        self.multicast_datagrams = self.metrics.counter(
+            "chat_multicast_datagrams_total",
+            "Relayed datagrams sent once to a room multicast group",
+        )
+        self.multicast_fallbacks = self.metrics.counter(
+            "chat_multicast_fallbacks_total",
+            "Relays sent by unicast because the multicast send failed",
+        )
+        self.reliable_overflow = self.metrics.counter(
+            "chat_reliable_overflow_total",
+            "Relays dropped because a reliable member had too many unacknowledged",
+        )
+        self.cluster_redirects = self.metrics.counter(
+            "chat_cluster_redirects_total",
+            "Handshakes redirected to the node that owns the room",
+        )
+        self.cluster_rooms_moved = self.metrics.counter(
+            "chat_cluster_rooms_moved_total",
+            "Rooms closed because another node owns them after a membership change",
+        )
+        self.handshakes = self.metrics.counter(
+            "chat_handshakes_total", "Create and join requests handled"
+        )
+        self.relay_fanout = self.metrics.histogram(
+            "chat_relay_fanout_size",
+            "Recipients per relayed message",
+            metrics.FANOUT_BUCKETS,
+        )
+        self.relay_latency = self.metrics.histogram(
+            "chat_relay_latency_seconds",
+            "Time from receiving a chat datagram until it has been relayed",
+        )
+        self.handshake_latency = self.metrics.histogram(
+            "chat_handshake_latency_seconds", "Time to handle a create or join request"
+        )
+        self.metrics.gauge("chat_active_rooms", "Open rooms", lambda: len(self.rooms))
+        self.metrics.gauge(
+            "chat_active_members",
+            "Members in open rooms",
+            lambda: sum(len(room.members) for room in list(self.rooms.values())),
+        )
+
+    def __restore_rooms(self):
+        """追記型ログから部屋の状態を復元する関数
+
+        Note:
+            再送・順序保証のユーザーは未確認のフレームを引き継げないため、シーケンス番号を1から
+            数え直す。新しい世代を付けて、クライアントに受信側の状態をやり直させる。
+        """
+        start = time.perf_counter()
+        self.rooms = self.wal.replay()
+        self.directory = RoomDirectory(self.rooms)
+        members = 0
+        for room_name, room in self.rooms.items():
+            for member in room.members.values():
+                if member.reliable is not None:
+                    member.reliable.epoch = secrets.randbelow(0xFFFF) + 1
+                self.__touch(member)
+                self.__index_member(member)
+                members += 1
+        print(
+            f"Restored {len(self.rooms)} rooms, {members} members "
+            f"in {time.perf_counter() - start:.3f} s"
+        )
+
+    def __adopt_state(self, state):
+        """動作中のサーバーから引き継いだ部屋の状態を設定する関数
+
+        Note:
+            設定(圧縮・マルチキャスト)に依存する部分と、中継の再開はイベントループの開始後に行う。
+
+        Args:
+            state (handover.RestoredState): 引き継いだ状態
+        """
+        start = time.perf_counter()
+        self.rooms = state.rooms
+        self.directory = RoomDirectory(self.rooms)
+        self.next_session_id = max(self.next_session_id, state.next_session_id)
+        members = 0
+        for room in self.rooms.values():
+            for member in room.members.values():
+                self.__touch(member)
+                self.__index_member(member)
+                members += 1
+        self.__restored = state
+        print(
+            f"Took over {len(self.rooms)} rooms, {members} members "
+            f"in {time.perf_counter() - start:.3f} s"
+        )
+
+    def __prepare_rooms(self):
+        """復元・引き継いだ部屋を、起動後の設定(圧縮・マルチキャスト)に合わせる関数"""
+        for room in self.rooms.values():
+            if room.compressor is not None:
+                room.compressor.min_size = self.COMPRESS_MIN_BYTES
+            elif len(room.compressed_recipients):
+                room.compressor = RoomCompressor(self.COMPRESS_MIN_BYTES)
+            if room.multicast_members:
+                if self.multicast is None:
+                    for member in list(room.multicast_members):
+                        room.use_unicast(member)
+                else:
+                    room.multicast_group = self.multicast.group_of(room.name)
+
+    def __resume_state(self):
+        """引き継いだ部屋の中継を再開する関数(イベントループで実行する)"""
+        state, self.__restored = self.__restored, None
+        for room in state.pending_rooms:
+            room.pending.scheduled = True
+            self.__call_later_in_room(0, room, self.__flush_room, room)
+        for room, member in state.reliable_members:
+            member.reliable.timer_scheduled = True
+            self.__call_later_in_room(
+                member.reliable.rto, room, self.__retransmit, room, member
+            )
+        for delay, room, member, message in state.delayed:
+            self.__delay_relay(delay, room, member, message, None)
+
+    def __close_wal(self):
+        """書き込み待ちのレコードを書き込んでログを閉じる関数"""
+        if self.wal is not None:
+            self.wal.close()
 
     # サーバー起動の関数
     def start(self):
-        print("Server Started on port", 9002)
+        print("Server Started on port", self.tcp_address[1])
+        self.__prepare_rooms()
+        self.actors = RoomActorPool(max_pending=self.MAX_QUEUED_RELAYS)
+        self.actors.start()
+        # まとめ送り・遅延中継・再送のタイマー(再送はクライアントが指定すれば使うため常に起動する)
+        self.__flush_timer = FlushTimer()
+        self.__flush_timer.start()
 
         while True:
             try:
-                with ThreadPoolExecutor(max_workers=2) as executor:
+                with ThreadPoolExecutor(max_workers=4) as executor:
                     executor.submit(self.__handle_tcp_conn)
                     executor.submit(self.__handle_udp_conn)
+                    executor.submit(self.__reap_idle_users_loop)
+                    if self.metrics_address is not None:
+                        executor.submit(self.__serve_metrics)
 
             except KeyboardInterrupt:
                 print("Keyboard Interrupted")
+                self.print_fanout_stats()
+                self.__close_wal()
                 self.tcp_socket.close()
                 self.udp_socket.close()
                 print("\nServer Closed")
                 break
 
-    def __handle_tcp_conn(self):
-        """TCO接続を処理する関数"""
-        while True:
-            self.tcp_socket.listen(5)
-            conn, _ = self.tcp_socket.accept()
-            # クライアントからのTCP接続を処理(並列処理)
+    def start_async(self):
+        """asyncioのイベントループでサーバーを起動する関数
+
+        Note:
+            TCPのハンドシェイクとUDPのメッセージ中継を1つのイベントループで処理し、
+            メッセージごとのスレッドを生成しない。
+        """
+        print("Server Started on port", self.tcp_address[1], "(asyncio)")
+        try:
+            asyncio.run(self.__serve_async())
+        except KeyboardInterrupt:
+            print("Keyboard Interrupted")
+        finally:
+            self.print_fanout_stats()
+            self.__close_wal()
+            self.tcp_socket.close()
+            self.udp_socket.close()
+            print("\nServer Closed")
+
+    async def __serve_async(self):
+        """TCPサーバーとUDPエンドポイントをイベントループに登録する関数"""
+        loop = asyncio.get_running_loop()
+        self.__loop = loop
+        tcp_server = await asyncio.start_server(
+            self.__handle_tcp_client, sock=self.tcp_socket, backlog=self.TCP_BACKLOG
+        )
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: UDPRelayProtocol(self), sock=self.udp_socket
+        )
+        self.__udp_transport = transport
+        self.fanout.fallback_send = transport.sendto
+        if self.router is not None:
+            await self.router.start()
+        reaper = asyncio.create_task(self.__reap_idle_users_periodically())
+        metrics_server = None
+        if self.metrics_socket is not None:
+            metrics_server = await asyncio.start_server(
+                self.__handle_metrics_client, sock=self.metrics_socket
+            )
+        elif self.metrics_address is not None:
+            metrics_server = await asyncio.start_server(
+                self.__handle_metrics_client, *self.metrics_address
+            )
+        self.__prepare_rooms()
+        if self.__restored is not None:
+            self.__resume_state()
+        if self.takeover_conn is not None:
+            handover.confirm(self.takeover_conn)
+            self.takeover_conn = None
+            print("Took over the sockets and started serving")
+        listener = None
+        if self.handover_path is not None:
+            listener = handover.listen(self.handover_path)
+            loop.add_reader(
+                listener.fileno(), self.__hand_over, listener, tcp_server, metrics_server
+            )
+        self.__stopped = loop.create_future()
+        try:
+            async with tcp_server:
+                await self.__stopped
+                if self.__tcp_clients:
+                    # 引き継ぎで受信を打ち切った接続を閉じ終えるまで待つ
+                    await asyncio.wait(list(self.__tcp_clients), timeout=self.TCP_TIMEOUT)
+        finally:
+            reaper.cancel()
+            if listener is not None:
+                loop.remove_reader(listener.fileno())
+                listener.close()
+            if metrics_server is not None:
+                metrics_server.close()
+            transport.close()
+
+    def __hand_over(self, listener, tcp_server, metrics_server):
+        """新しいプロセスにソケットと部屋の状態を引き継ぐ関数(handover.py)
+
+        Note:
+            引き継ぎが終わるまでイベントループを止めたまま送信するため、送った状態以降に
+            部屋が変わることはなく、その間に届いたデータグラムはカーネルの受信バッファに残る。
+            新しいプロセスからREADYが届かなかった場合は、このプロセスで処理を続ける。
+
+        Args:
+            listener (socket.socket): 引き継ぎの要求を待つUnixドメインソケット
+            tcp_server (asyncio.Server): ハンドシェイクのTCPサーバー
+            metrics_server (asyncio.Server): 計測値のTCPサーバー(公開していなければNone)
+        """
+        try:
+            conn, _ = listener.accept()
+        except BlockingIOError:
+            return
+        start = time.perf_counter()
+        with conn:
+            conn.setblocking(True)
             try:
-                # クライアントからのデータを受信
-                header = conn.recv(self.HEADER_BYTE_SIZE)
-                room_name_size, operation, _, _ = struct.unpack_from(
-                    "!B B B 29s", header
+                # 新しいプロセスが受信を始めるまでの間、データグラムを取りこぼさないようにする
+                self.udp_socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_RCVBUF, self.HANDOVER_RECEIVE_BUFFER
                 )
-                body = conn.recv(4096)
+                if self.wal is not None:
+                    # 書き込み待ちのレコードを含めて、新しいプロセスが開くログを今の状態にしておく
+                    self.wal.snapshot(self.rooms, wait=True)
+                sockets = [self.tcp_socket, self.udp_socket]
+                if metrics_server is not None:
+                    sockets.append(metrics_server.sockets[0])
+                with self.__delayed_lock:
+                    delayed = list(self.__delayed.values())
+                rooms_data, state_data = handover.encode_state(self.rooms, delayed)
+                encoded = time.perf_counter() - start
+                handover.send_state(
+                    conn, sockets, self.next_session_id, rooms_data, state_data
+                )
+                handover.wait_ready(conn)
+            except OSError as e:
+                self.errors.inc()
+                logger.warning("Server Error:Handover failed:%s", e)
+                return
+        # 次のイテレーションで届いたデータグラムや接続を処理しないように、すぐに受信をやめる
+        self.handed_over = True
+        self.__udp_transport.close()
+        tcp_server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        # 待機中のハンドシェイクの接続を閉じ、クライアントに新しいプロセスへ接続し直させる
+        for reader in self.__tcp_clients.values():
+            reader.feed_eof()
+        print(
+            f"Handed over {len(self.rooms)} rooms "
+            f"({len(rooms_data) + len(state_data)} bytes, encoded in {encoded:.3f} s) "
+            f"in {time.perf_counter() - start:.3f} s"
+        )
+        self.__stopped.set_result(None)
+
+    async def __handle_metrics_client(self, reader, writer):
+        """asyncioモードで計測値の取得リクエスト(HTTP GET)に応答する関数"""
+        try:
+            # リクエストの内容に関わらず、ヘッダーの終わりまで読んでから全計測値を返す
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.TCP_TIMEOUT)
+            writer.write(metrics.http_response(self.metrics.render()))
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            asyncio.TimeoutError,
+            ConnectionError,
+        ) as e:
+            logger.warning("Metrics Error:%r", e)
+        finally:
+            writer.close()
 
-                room_name = body[:room_name_size].decode("utf-8")
-                payload_data = body[room_name_size:].decode("utf-8")
+    def __serve_metrics(self):
+        """スレッド方式で計測値の取得リクエスト(HTTP GET)に応答する関数"""
+        with socket.create_server(self.metrics_address) as listener:
+            while True:
+                conn, _ = listener.accept()
+                with conn:
+                    try:
+                        conn.settimeout(self.TCP_TIMEOUT)
+                        request = b""
+                        while b"\r\n\r\n" not in request and len(request) < 65536:
+                            chunk = conn.recv(4096)
+                            if not chunk:
+                                break
+                            request += chunk
+                        conn.sendall(metrics.http_response(self.metrics.render()))
+                    except OSError as e:
+                        logger.warning("Metrics Error:%r", e)
 
-                # payloadはjson形式の文字列とする
-                # payloadをloadsして辞書に変換
-                payload = json.loads(payload_data)
-                user_name = payload["user_name"]
-                user_address = payload["user_address"]
+    async def __reap_idle_users_periodically(self):
+        """asyncioモードで一定間隔ごとに無操作のユーザーを退出させる関数"""
+        while not self.handed_over:
+            await asyncio.sleep(self.idle_wheel.tick)
+            if not self.handed_over:
+                self.reap_idle_users()
+
+    def __reap_idle_users_loop(self):
+        """スレッド方式で一定間隔ごとに無操作のユーザーを退出させる関数"""
+        while True:
+            time.sleep(self.idle_wheel.tick)
+            try:
+                self.reap_idle_users()
             except Exception as e:
-                print(f"Server Error:{e}")
-                self.__send_state_res(
-                    conn, room_name, operation, self.ERROR_RESPONSE, ""
+                logger.error("Server Error:%s", e)
+
+    def reap_idle_users(self):
+        """IDLE_TIMEOUT秒以上メッセージを送信していないユーザーをまとめて退出させる関数"""
+        with self.__idle_lock:
+            expired = self.idle_wheel.advance(time.monotonic())
+        for member in expired:
+            self.__run_in_room(member.room.name, self.__expire_member, member)
+        # トークンの鍵ファイルが変わった場合は読み込み直す(鍵の入れ替え)
+        if self.tokens is not None:
+            self.tokens.refresh()
+        # ノード一覧が変わった場合は、担当が他のノードに移った部屋だけを閉じる
+        if self.cluster is not None and self.cluster.refresh():
+            for room in list(self.rooms.values()):
+                owner = self.cluster.owner(room.name.encode("utf-8"))
+                if owner != self.cluster.node:
+                    self.__run_in_room(room.name, self.__hand_off_room, room, owner)
+        # ログが長くなったらスナップショットに置き換え、再起動時のリプレイ時間を抑える
+        if self.wal is not None and self.wal.needs_snapshot():
+            self.wal.snapshot(self.rooms)
+
+    def __hand_off_room(self, room, owner):
+        """担当が他のノードに移った部屋を閉じ、ユーザーに移動先を通知する関数
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            owner (tuple): 新しく担当するノードの (ホスト, TCPポート, UDPポート)
+        """
+        if self.rooms.get(room.name) is not room:
+            return
+        if room.pending:
+            self.__flush_room(room)
+        message = (
+            f"チャットルーム:{room.name}は{owner[0]}:{owner[1]}のサーバーに移動したため、"
+            "終了します。接続し直してください。"
+        )
+        self.__broadcast(room, message.encode("utf-8"))
+        self.__close_room(room)
+        self.cluster_rooms_moved.inc()
+        logger.info(message)
+
+    def __expire_member(self, member):
+        """無操作タイムアウトしたユーザーを退出させる関数"""
+        room = member.room
+        if room.members.get(member.token) is member:
+            self.__leave_room(room, member, notify_self=True)
+
+    def __run_in_room(self, room_name, fn, *args):
+        """部屋の状態を変更する処理を実行する関数
+
+        Note:
+            スレッド方式では部屋の担当スレッドの受信キューに追加し、同じ部屋の処理は到着順に1つずつ実行する。
+            asyncioモードではその場で実行する。
+
+        Args:
+            room_name (str): 部屋名
+            fn (callable): 実行する関数
+            *args: fnの引数
+        """
+        if self.actors is None:
+            fn(*args)
+        else:
+            self.actors.post(room_name, fn, *args)
+
+    def __touch(self, member):
+        """ユーザーの無操作タイムアウトの期限を延長する関数"""
+        now = time.monotonic()
+        member.last_seen = now
+        with self.__idle_lock:
+            self.idle_wheel.schedule(member, self.IDLE_TIMEOUT, now)
+
+    def __forget(self, members):
+        """退出したユーザーを無操作タイムアウトの対象から外す関数"""
+        with self.__idle_lock:
+            for member in members:
+                self.idle_wheel.cancel(member)
+
+    def __allocate_session_id(self):
+        """他のユーザーと重ならないセッションIDを発行する関数"""
+        with self.__session_lock:
+            while True:
+                session_id = self.next_session_id
+                self.next_session_id += self.session_id_step
+                if protocol.encode_session_id(session_id) not in self.sessions:
+                    return session_id
+
+    def __index_member(self, member):
+        """バイナリのトークンとセッションIDをインデックスに登録する関数"""
+        self.sessions[member.token] = member
+        if member.session_id is not None:
+            self.sessions[protocol.encode_session_id(member.session_id)] = member
+
+    def __unindex_member(self, member):
+        """退出したユーザーをインデックスから削除する関数"""
+        self.sessions.pop(member.token, None)
+        if member.session_id is not None:
+            self.sessions.pop(protocol.encode_session_id(member.session_id), None)
+
+    def __body_size(self, header):
+        """ヘッダーからボディ(部屋名 + ペイロード)のバイト数を求める関数
+
+        Args:
+            header (bytes): リクエストヘッダー
+
+        Returns:
+            int: ボディのバイト数
+
+        Raises:
+            ValueError: ペイロードサイズが上限を超えている場合
+        """
+        room_name_size, _, _, payload_size = struct.unpack_from("!B B B 29s", header)
+        operation_payload_size = int.from_bytes(payload_size, byteorder="big")
+        if operation_payload_size > self.MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Payload size {operation_payload_size} is too large.")
+        return room_name_size + operation_payload_size
+
+    async def __handle_tcp_client(self, reader, writer):
+        """asyncioモードでクライアントからのTCP接続を処理する関数
+
+        Note:
+            1つの接続で複数の作成・参加リクエストを受け付ける。
+            TCP_TIMEOUT秒以内に次のリクエストが届かない場合は接続を閉じる。
+
+        Args:
+            reader (asyncio.StreamReader): 受信用ストリーム
+            writer (asyncio.StreamWriter): 送信用ストリーム
+        """
+        task = asyncio.current_task()
+        self.__tcp_clients[task] = reader
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(
+                        reader.readexactly(self.HEADER_BYTE_SIZE), self.TCP_TIMEOUT
+                    )
+                except asyncio.IncompleteReadError as e:
+                    # リクエストの区切りで接続が閉じられた場合は正常終了
+                    if e.partial:
+                        raise
+                    break
+                body = await asyncio.wait_for(
+                    reader.readexactly(self.__body_size(header)), self.TCP_TIMEOUT
                 )
+                # 引き継ぎ後のリクエストは、接続し直したクライアントが新しいプロセスに送り直す
+                if self.handed_over:
+                    break
+                writer.write(await self.__dispatch_handshake(header, body))
+                await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ValueError,
+        ) as e:
+            logger.warning("Server Error:%r", e)
+        finally:
+            del self.__tcp_clients[task]
+            writer.close()
+
+    def __handle_tcp_conn(self):
+        """TCP接続を処理する関数
+
+        Note:
+            selectorsでノンブロッキングに複数の接続を同時に扱い、
+            ヘッダーのペイロードサイズ分だけ受信してからリクエストを処理する。
+        """
+        self.tcp_socket.listen(self.TCP_BACKLOG)
+        self.tcp_socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.tcp_socket, selectors.EVENT_READ)
+        # 部屋の担当スレッドでハンドシェイクの処理が終わったことを通知するためのソケット
+        wakeup, self.__wakeup = socket.socketpair()
+        wakeup.setblocking(False)
+        self.__wakeup.setblocking(False)
+        selector.register(wakeup, selectors.EVENT_READ)
+        self.__finished = queue.SimpleQueue()  # 処理が終わったHandshakeConnection
+        connections = {}  # ソケット:HandshakeConnection
+
+        while True:
+            for key, mask in selector.select(timeout=1):
+                if key.fileobj is self.tcp_socket:
+                    self.__accept_tcp_conns(selector, connections)
+                    continue
+                if key.fileobj is wakeup:
+                    self.__collect_handshakes(wakeup, selector, connections)
+                    continue
+                conn = connections[key.fileobj]
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self.__read_tcp_conn(conn)
+                    if conn.out_buffer:
+                        sent = conn.sock.send(conn.out_buffer)
+                        del conn.out_buffer[:sent]
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except (ConnectionError, ValueError) as e:
+                    logger.warning("Server Error:%r", e)
+                    conn.closed = True
+                self.__update_tcp_conn(selector, connections, conn)
 
+            # タイムアウトした接続を閉じる
+            now = time.monotonic()
+            for conn in list(connections.values()):
+                if conn.deadline < now:
+                    self.__close_tcp_conn(selector, connections, conn)
+
+    def __update_tcp_conn(self, selector, connections, conn):
+        """送信待ちのデータに合わせて監視するイベントを変更し、終わった接続を閉じる関数"""
+        if conn.closed and not conn.out_buffer and not conn.pending:
+            self.__close_tcp_conn(selector, connections, conn)
+            return
+        events = selectors.EVENT_READ
+        if conn.out_buffer:
+            events |= selectors.EVENT_WRITE
+        selector.modify(conn.sock, events)
+
+    def __accept_tcp_conns(self, selector, connections):
+        """接続待ちのクライアントをまとめて受け付ける関数"""
+        while True:
             try:
-                token = self.__create_or_join_room(
-                    room_name, user_address, user_name, operation
+                sock, _ = self.tcp_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            connections[sock] = HandshakeConnection(
+                sock, time.monotonic() + self.TCP_TIMEOUT
+            )
+            selector.register(sock, selectors.EVENT_READ)
+
+    def __read_tcp_conn(self, conn):
+        """受信したデータからリクエストを切り出して処理する関数
+
+        Args:
+            conn (HandshakeConnection): クライアントとの接続
+        """
+        data = conn.sock.recv(65536)
+        if not data:
+            conn.closed = True
+            return
+        conn.in_buffer += data
+        while len(conn.in_buffer) >= self.HEADER_BYTE_SIZE:
+            header = bytes(conn.in_buffer[: self.HEADER_BYTE_SIZE])
+            request_size = self.HEADER_BYTE_SIZE + self.__body_size(header)
+            if len(conn.in_buffer) < request_size:
+                break
+            body = bytes(conn.in_buffer[self.HEADER_BYTE_SIZE : request_size])
+            del conn.in_buffer[:request_size]
+            if header[1] == self.LIST_ROOMS_NUM:
+                # 部屋の一覧は索引を読むだけなので、このスレッドで処理する
+                future = Future()
+                future.set_result(self.process_handshake(header, body))
+            else:
+                # 部屋の担当スレッドで処理し、終わったら__collect_handshakesでレスポンスを送る
+                room_name = body[: header[0]].decode("utf-8", "replace")
+                future = self.actors.submit(
+                    room_name, self.process_handshake, header, body
                 )
+            conn.pending.append(future)
+            future.add_done_callback(lambda _, conn=conn: self.__notify_finished(conn))
+            conn.deadline = time.monotonic() + self.TCP_TIMEOUT
+
+    def __notify_finished(self, conn):
+        """ハンドシェイクの処理が終わったことをTCPのスレッドに通知する関数"""
+        self.__finished.put(conn)
+        try:
+            self.__wakeup.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # 通知が溜まっている場合は既に起こされているので不要
+            pass
+
+    def __collect_handshakes(self, wakeup, selector, connections):
+        """処理が終わったハンドシェイクのレスポンスを、リクエストの順に送信する関数"""
+        try:
+            while wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                conn = self.__finished.get_nowait()
+            except queue.Empty:
+                return
+            # タイムアウトなどで既に閉じた接続
+            if connections.get(conn.sock) is not conn:
+                continue
+            while conn.pending and conn.pending[0].done():
+                conn.out_buffer += conn.pending.popleft().result()
+            try:
+                if conn.out_buffer:
+                    sent = conn.sock.send(conn.out_buffer)
+                    del conn.out_buffer[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except ConnectionError as e:
+                logger.warning("Server Error:%r", e)
+                conn.closed = True
+                conn.out_buffer.clear()
+            self.__update_tcp_conn(selector, connections, conn)
+
+    def __close_tcp_conn(self, selector, connections, conn):
+        """接続を閉じる関数"""
+        selector.unregister(conn.sock)
+        del connections[conn.sock]
+        conn.sock.close()
 
-                self.__send_state_res(
-                    conn, room_name, operation, self.REQUEST_COMPLETION, token
+    async def __dispatch_handshake(self, header, body):
+        """担当ワーカーでハンドシェイクを処理する関数
+
+        Args:
+            header (bytes): リクエストヘッダー
+            body (bytes): 部屋名とペイロード
+
+        Returns:
+            bytes: レスポンス(ヘッダー + ペイロード)
+        """
+        room_name = body[: header[0]]
+        # 部屋の一覧はマルチプロセスでは全ワーカーの部屋をまとめて返す
+        if header[1] == self.LIST_ROOMS_NUM:
+            if self.router is not None:
+                return await self.router.list_rooms(header, body)
+            return self.process_handshake(header, body)
+        if self.router is not None and not self.router.owns(room_name):
+            return await self.router.forward_handshake(room_name, header + body)
+        return self.process_handshake(header, body)
+
+    def process_handshake(self, header, body):
+        """部屋作成・参加リクエストを処理してレスポンスを生成する関数
+
+        Args:
+            header (bytes): リクエストヘッダー
+            body (bytes): 部屋名とペイロード
+
+        Returns:
+            bytes: レスポンス(ヘッダー + ペイロード)
+        """
+        start = time.perf_counter()
+        self.handshakes.inc()
+        try:
+            return self.__process_handshake(header, body)
+        finally:
+            self.handshake_latency.observe(time.perf_counter() - start)
+
+    def __process_handshake(self, header, body):
+        room_name = ""
+        operation = 0
+        binary = False
+        try:
+            room_name_size, operation, _, _ = struct.unpack_from("!B B B 29s", header)
+            room_name = body[:room_name_size].decode("utf-8")
+            # payloadはjson形式またはバイナリ形式(protocol.pyを参照)
+            binary = protocol.is_binary(body[room_name_size:])
+            if operation == self.LIST_ROOMS_NUM:
+                return self.__list_rooms(room_name, body[room_name_size:])
+            protocol.check_name(room_name)
+            payload = protocol.decode_join_request(body[room_name_size:])
+            user_name = payload["user_name"]
+            user_address = payload["user_address"]
+            compact = bool(payload["flags"] & protocol.FLAG_COMPACT)
+            reliable = bool(payload["flags"] & protocol.FLAG_RELIABLE)
+            compress = bool(payload["flags"] & protocol.FLAG_COMPRESS)
+            tagged = bool(payload["flags"] & protocol.FLAG_ROOM_TAG)
+            use_multicast = bool(payload["flags"] & protocol.FLAG_MULTICAST)
+        except ValueError as e:
+            self.handshake_rejections.labels("invalid_request").inc()
+            logger.info("Handshake rejected:%s", e)
+            return self.__build_state_res(
+                room_name, operation, self.ERROR_RESPONSE, "", binary
+            )
+        except Exception as e:
+            self.errors.inc()
+            logger.warning("Server Error:%s", e)
+            return self.__build_state_res(
+                room_name, operation, self.ERROR_RESPONSE, "", binary
+            )
+
+        # クラスター構成では担当ノードに接続し直してもらう
+        if self.cluster is not None:
+            owner = self.cluster.owner(room_name.encode("utf-8"))
+            if owner is not None and owner != self.cluster.node:
+                self.cluster_redirects.inc()
+                return self.__build_state_res(
+                    room_name,
+                    operation,
+                    self.REDIRECT_RESPONSE,
+                    "",
+                    binary,
+                    redirect=owner,
                 )
-            except Exception as e:
-                print(f"Server Error:{e}")
-                self.__send_state_res(conn, room_name, operation, self.SERVER_INIT, "")
 
-    def __generate_token(self):
-        """トークンをrandomで生成する関数
+        try:
+            token, session_id, group = self.__create_or_join_room(
+                room_name,
+                user_address,
+                user_name,
+                operation,
+                compact,
+                reliable,
+                compress,
+                tagged,
+                use_multicast,
+            )
+            # 満員で参加できなかった場合は空のトークンで完了にせず、エラーを返す
+            if token is None:
+                self.handshake_rejections.labels("room_full").inc()
+                logger.info("%sは満員のため%sが参加できませんでした。", room_name, user_name)
+                return self.__build_state_res(
+                    room_name, operation, self.ERROR_RESPONSE, "", binary
+                )
+            return self.__build_state_res(
+                room_name,
+                operation,
+                self.REQUEST_COMPLETION,
+                token,
+                binary,
+                session_id,
+                multicast=group,
+            )
+        except KeyError as e:
+            # 作成する部屋がすでにある・参加する部屋がない場合
+            if operation == self.CREATE_ROOM_NUM:
+                self.handshake_rejections.labels("room_exists").inc()
+            else:
+                self.handshake_rejections.labels("room_not_found").inc()
+            logger.info("Handshake rejected:%s", e)
+            return self.__build_state_res(
+                room_name, operation, self.SERVER_INIT, "", binary
+            )
+        except Exception as e:
+            self.errors.inc()
+            logger.warning("Server Error:%s", e)
+            return self.__build_state_res(
+                room_name, operation, self.SERVER_INIT, "", binary
+            )
+
+    def __list_rooms(self, prefix, payload):
+        """部屋の一覧リクエストを処理してレスポンスを生成する関数
+
+        Args:
+            prefix (str): 検索する部屋名の先頭(空文字なら全部屋)
+            payload (bytes): カーソルと部屋数のペイロード
+
+        Returns:
+            bytes: レスポンス(ヘッダー + ペイロード)
+
+        Raises:
+            ValueError: ペイロードの形式が不正な場合
+        """
+        request = protocol.decode_list_request(payload)
+        rooms, cursor = self.directory.page(
+            prefix, request["cursor"], request["limit"]
+        )
+        self.room_lists.inc()
+        res_payload = protocol.encode_list_response(
+            protocol.STATUS_COMPLETED, rooms, cursor, request["binary"]
+        )
+        header = struct.pack(
+            "!B B B 29s",
+            len(prefix.encode("utf-8")),
+            self.LIST_ROOMS_NUM,
+            self.REQUEST_COMPLETION,
+            len(res_payload).to_bytes(29, byteorder="big"),
+        )
+        return header + res_payload
+
+    def __generate_token(self, room_name):
+        """トークンをrandomで生成する関数(署名したトークンを使う場合はsigned_token.pyで発行する)
+
+        Args:
+            room_name (str): 参加する部屋名
 
         Returns:
-            token: トークン
+            bytes: トークン(クライアントには16進数文字列で渡す)
         """
-        token = secrets.token_hex(32)
+        if self.tokens is not None:
+            return self.tokens.issue(room_name)
+        token = self.token_prefix + secrets.token_bytes(32 - len(self.token_prefix))
         return token
 
-    def __create_or_join_room(self, room_name, user_address, user_name, operation):
+    def __create_or_join_room(
+        self,
+        room_name,
+        user_address,
+        user_name,
+        operation,
+        compact=False,
+        reliable=False,
+        compress=False,
+        tagged=False,
+        use_multicast=False,
+    ):
         """部屋を作成もしくは参加する関数
 
         Args:
@@ -103,9 +1074,19 @@ class Server:
             user_address (tuple): クライアントのアドレス（IPアドレスとポート番号)
             user_name (str): ユーザー名
             operation (int): クライアントが入力したアクション番号(1:部屋作成, 2:参加)
+            compact (bool): 短い形式のチャットメッセージ用にセッションIDを発行するかどうか
+            reliable (bool): 中継を再送・順序保証付きで受け取るかどうか
+            compress (bool): 中継を圧縮して受け取るかどうか
+            tagged (bool): 中継を部屋名付きのフレームで受け取るかどうか
+            use_multicast (bool): 中継をマルチキャストで受け取るかどうか
+                (サーバーでマルチキャストを有効にしていない場合はユニキャストで送る)
+
+        Returns:
+            tuple: (トークン(bytes), セッションID, マルチキャストグループ)
+                部屋が満員の場合は(None, None, None)
         """
         # クライアントにトークンを発行
-        token = self.__generate_token()
+        token = self.__generate_token(room_name)
 
         if operation == self.CREATE_ROOM_NUM:
             # 作成する部屋が存在する場合
@@ -116,7 +1097,8 @@ class Server:
                 # 部屋を作成
                 room = ChatRoom(room_name)
                 self.rooms[room_name] = room
-                print(f"{user_name}が{room_name}を作成しました。")
+                self.directory.add(room)
+                logger.info("%sが%sを作成しました。", user_name, room_name)
                 # ホストトークン設定
                 room.host_token = token
         elif operation == self.JOIN_ROOM_NUM:
@@ -128,38 +1110,97 @@ class Server:
                 room = self.rooms[room_name]
 
         # 部屋にユーザーを追加
-        if room.add_client(token, user_address, user_name):
-            print(f"{user_name}が{room_name}に参加しました。")
-            return token
+        member = room.add_client(
+            token,
+            user_address,
+            user_name,
+            reliable=reliable,
+            compress=compress,
+            tagged=tagged,
+            multicast=use_multicast and self.multicast is not None,
+        )
+        if member is not None:
+            logger.info("%sが%sに参加しました。", user_name, room_name)
+            session_id = None
+            group = None
+            # マルチキャストのフレームで除外するユーザーはセッションIDで指定する
+            if compact or member.multicast:
+                session_id = self.__allocate_session_id()
+                member.session_id = session_id
+            if member.multicast:
+                if room.multicast_group is None:
+                    room.multicast_group = self.multicast.group_of(room_name)
+                group = room.multicast_group
+            self.__index_member(member)
+            self.__touch(member)
+            # 部屋の辞書を作成済みなら、圧縮したメッセージより先に受け取れるように送っておく
+            if member.compress:
+                if room.compressor is None:
+                    room.compressor = RoomCompressor(self.COMPRESS_MIN_BYTES)
+                self.__send_dictionary(room, member)
+            if self.wal is not None:
+                if operation == self.CREATE_ROOM_NUM:
+                    self.wal.log_room_create(room_name, token)
+                self.wal.log_member_join(
+                    room_name,
+                    token,
+                    user_name,
+                    user_address,
+                    session_id or 0,
+                    member.flags,
+                )
+            return token, session_id, group
+        return None, None, None
 
-    # リクエストの状態に応じてヘッダーとペイロードを送信する関数
-    def __send_state_res(self, conn, room_name, operation, state, token):
-        """_summary_
+    # リクエストの状態に応じてヘッダーとペイロードを生成する関数
+    def __build_state_res(
+        self,
+        room_name,
+        operation,
+        state,
+        token,
+        binary=False,
+        session_id=None,
+        redirect=None,
+        multicast=None,
+    ):
+        """リクエストの状態に応じたレスポンスを生成する
 
         Args:
-            conn (socket.socket): 接続されたクライアントのソケットオブジェクト
             room_name (str): 部屋名
             operation (str): クライアントが入力したアクション番号(1:部屋作成, 2:参加)
-            state (int): 操作コード: サーバの初期化(0)、リクエストの応答(1)、リクエストの完了(2)
-            token (str): トークン
+            state (int): 操作コード: サーバの初期化(0)、リクエストの応答(1)、リクエストの完了(2)、
+                エラー(3)、リダイレクト(4)
+            token (bytes): トークン
+            binary (bool): ペイロードをバイナリ形式にするかどうか
+            session_id (int): 発行したセッションID
+            redirect (tuple): リダイレクト先のノードの (ホスト, TCPポート, UDPポート)
+            multicast (tuple): 中継を受け取るマルチキャストグループの (IPアドレス, ポート)
+
+        Returns:
+            bytes: レスポンス(ヘッダー + ペイロード)
         """
         if state == self.SERVER_INIT:
-            payload_data = (
-                {"status": 400, "message": "部屋 {} はすでに存在します".format(room_name)}
-                if operation == 1
-                else {"status": 400, "message": "部屋 {} は存在しません".format(room_name)}
-            )
+            status = protocol.STATUS_BAD_REQUEST
         elif state == self.RESPONSE_OF_REQUEST:
-            payload_data = {"status": 200, "message": "リクエストを受理しました。"}
+            status = protocol.STATUS_ACCEPTED
         elif state == self.ERROR_RESPONSE:
-            payload_data = {
-                "status": 500,
-                "message": "リクエストを完了できませんでした。\n入力し直してください。",
-            }
+            status = protocol.STATUS_ERROR
+        elif state == self.REDIRECT_RESPONSE:
+            status = protocol.STATUS_REDIRECT
         else:
-            payload_data = {"status": 202, "message": "リクエストを完了しました。", "token": token}
+            status = protocol.STATUS_COMPLETED
 
-        res_payload = json.dumps(payload_data).encode("utf-8")
+        res_payload = protocol.encode_join_response(
+            status,
+            token.hex() if token else "",
+            operation,
+            room_name,
+            binary,
+            session_id,
+            redirect,
+            multicast,
+        )
 
         header = struct.pack(
             "!B B B 29s",
@@ -169,75 +1210,950 @@ class Server:
             len(res_payload).to_bytes(29, byteorder="big"),
         )
 
-        conn.sendall(header + res_payload)
+        return header + res_payload
 
     def __handle_udp_conn(self):
         """クライアントからのUDP接続経由でメッセージを受信する関数"""
+        # 受信ごとにbytesを確保せず、プールのバッファにrecvfrom_intoで受信する
+        buffers = BufferPool(self.UDP_BUFFER_SIZE)
+        while True:
+            buffer = buffers.acquire()
+            size, addr = self.udp_socket.recvfrom_into(buffer)
+            received = time.perf_counter()
+            self.datagrams_received.inc()
+            try:
+                data = memoryview(buffer)[:size]
+                if self.tokens is not None:
+                    self.__authenticate(data)
+                message, room, member = self.__parse_datagram(data, addr)
+            except Exception as e:
+                self.datagrams_dropped.inc()
+                logger.warning("Server Error:%s", e)
+                buffers.release(buffer)
+                continue
+
+            # 部屋の担当スレッドで処理し、同じ部屋のメッセージは到着順に1つずつ処理する
+            # 処理待ちが溜まりすぎている場合は、溜まっている部屋のメッセージから破棄する
+            accepted = self.actors.offer(
+                room.name,
+                self.__handle_room_message,
+                message,
+                room,
+                member,
+                received,
+                buffers,
+                buffer,
+            )
+            if not accepted:
+                self.overload_dropped.inc()
+                buffers.release(buffer)
+
+    def __handle_room_message(self, message, room, member, received, buffers, buffer):
+        """部屋の担当スレッドでメッセージを処理する関数
+
+        Note:
+            受信してから処理するまでの間に退出したユーザーのメッセージは破棄する。
+            処理が終わったら受信に使ったバッファをプールに返却する。
+        """
+        try:
+            if room.members.get(member.token) is not member:
+                self.datagrams_dropped.inc()
+                return
+            self.handle_message(message, room, member, received)
+        except Exception as e:
+            self.errors.inc()
+            logger.warning("Server Error:%s", e)
+        finally:
+            buffers.release(buffer)
+
+    def __authenticate(self, data):
+        """署名したトークンを使う場合に、部屋の状態を引く前にトークンを検証する関数
+
+        Note:
+            署名・有効期限と、部屋名を含む形式では部屋名と部屋IDの一致を確かめる。
+            セッションIDの短い形式は参加時のアドレスからの送信のみ受け付けるため、ここでは検証しない。
+
+        Args:
+            data (memoryview): 受信データ
+
+        Raises:
+            PermissionError: トークンが偽造・期限切れ・別の部屋のものの場合
+        """
         HEADER_SIZE = 2
 
-        while True:
-            data, _ = self.udp_socket.recvfrom(4096)
+        room_name_size, token_size = data[0], data[1]
+        if room_name_size == 0:
+            if token_size != protocol.RAW_TOKEN_SIZE:
+                return
+            token = data[HEADER_SIZE : HEADER_SIZE + token_size]
+            valid = self.tokens.verify(token)
+        else:
+            token_start = HEADER_SIZE + room_name_size
+            token = bytes.fromhex(
+                str(data[token_start : token_start + token_size], "utf-8")
+            )
+            valid = self.tokens.verify(token) and signed_token.token_room_id(
+                token
+            ) == signed_token.room_id(data[HEADER_SIZE:token_start])
+        if not valid:
+            self.tokens_rejected.inc()
+            raise PermissionError("Invalid or expired token.")
 
-            room_name_size, token_size = struct.unpack_from("!B B", data[:HEADER_SIZE])
-            room_name = data[HEADER_SIZE : HEADER_SIZE + room_name_size].decode("utf-8")
-            token = data[
-                HEADER_SIZE + room_name_size : HEADER_SIZE + room_name_size + token_size
-            ].decode("utf-8")
-            message = data[HEADER_SIZE + room_name_size + token_size :]
+    def __parse_datagram(self, data, addr=None):
+        """UDPで受信したデータをメッセージ・部屋・トークンに分解する関数
 
-            # クライアントからのメッセージを処理(並列処理)
-            threading.Thread(
-                target=self.handle_message, args=(message, room_name, token)
-            ).start()
+        Note:
+            部屋名のバイト数が0の短い形式では、バイナリのトークンかセッションIDで
+            インデックスを1回引くだけで部屋とトークンが決まる。
+            セッションIDは推測できるため、参加時に登録したアドレスからの送信のみ受け付ける。
 
-    def handle_message(self, message, room_name, token):
-        """クライアントからのメッセージを処理する関数
+            受信データはmemoryviewのまま切り出し、メッセージはコピーせずにmemoryviewで返す。
+            (中継時は送信者のエンコード済みの「ユーザー名: 」とつなげるだけでデコードしない)
 
         Args:
-            message (bytes): クライアントから送信されたメッセージ
-            room_name (str): 部屋名
-            token (str): トークン
+            data (memoryview): 受信データ
+            addr (tuple): 送信元アドレス
+
+        Returns:
+            tuple: (メッセージ(memoryview), ChatRoomインスタンス, 送信者のMember)
+
+        Raises:
+            KeyError: 部屋またはトークンが存在しない場合
+            PermissionError: セッションIDの送信元アドレスが登録されたものと異なる場合
         """
+        HEADER_SIZE = 2
+
+        room_name_size, token_size = data[0], data[1]
+        if room_name_size == 0:
+            session_end = HEADER_SIZE + token_size
+            member = self.sessions[bytes(data[HEADER_SIZE:session_end])]
+            if token_size == protocol.SESSION_ID_SIZE and addr is not None:
+                if member.address != addr[:2]:
+                    raise PermissionError(f"Session id sent from {addr}.")
+            return data[session_end:], member.room, member
+
+        token_start = HEADER_SIZE + room_name_size
+        message_start = token_start + token_size
+        room_name = str(data[HEADER_SIZE:token_start], "utf-8")
+        token = bytes.fromhex(str(data[token_start:message_start], "utf-8"))
         room = self.rooms[room_name]
-        sender_name = room.token_to_user_name[token]
+        return data[message_start:], room, room.members[token]
+
+    def handle_datagram(self, data, addr=None):
+        """受信データを解析し、スレッドを使わずにその場でメッセージを処理する関数
+
+        Args:
+            data (bytes): 受信データ
+            addr (tuple): 送信元アドレス
+        """
+        received = time.perf_counter()
+        self.datagrams_received.inc()
+        try:
+            if self.tokens is not None:
+                self.__authenticate(data)
+            if self.router is not None and not self.router.owns_datagram(data):
+                self.router.forward_datagram(data, addr)
+                return
+            message, room, member = self.__parse_datagram(memoryview(data), addr)
+        except Exception as e:
+            self.datagrams_dropped.inc()
+            logger.warning("Server Error:%s", e)
+            return
+        try:
+            self.handle_message(message, room, member, received)
+        except Exception as e:
+            self.errors.inc()
+            logger.warning("Server Error:%s", e)
+
+    def handle_message(self, message, room, member, received=None):
+        """クライアントからのメッセージを処理する関数
+
+        Args:
+            message (memoryview): クライアントから送信されたメッセージ
+                (受信バッファの一部のため、処理が終わった後は参照しない)
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信者
+            received (float): 受信した時刻(time.perf_counter)。中継のレイテンシの計測に使う
+        """
         # exitと送信したユーザーは部屋から退出
         if message == b"exit":
-            if token == room.host_token:
-                message = f"{sender_name}が{room_name}から退出しました。\nホストが退出したため、チャットルーム:{room_name}を終了します。"
-                self.__send_others_in_same_room(room, token, message)
-                room.remove_all_users()
-                del self.rooms[room_name]
-            else:
-                message = f"{sender_name}が{room_name}から退出しました。"
-                self.__send_others_in_same_room(room, token, message)
-                room.remove_client(token)
-            print(message)
+            self.__leave_room(room, member)
+        elif protocol.is_control(message):
+            self.__touch(member)
+            self.__handle_control(room, member, message)
+        else:
+            self.__touch(member)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "%s: %sが'%s'を送信しました。",
+                    room.name,
+                    member.name,
+                    str(message, "utf-8", "replace"),
+                )
+            if not self.__rate_limited(room, member, message, received):
+                self.__relay_message(room, member, message, received)
+
+    def __rate_limited(self, room, member, message, received):
+        """流量制限を超えたメッセージをRATE_POLICYに従って処理する関数
+
+        Note:
+            ユーザーごとのメッセージ数と、部屋ごとの中継バイト数の両方のトークンバケットを確認する。
+            delayの場合は両方のトークンを前借りし、溜まるまでの時間だけ遅らせて部屋の担当スレッドで中継する。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信者
+            message (memoryview): クライアントから送信されたメッセージ
+            received (float): 受信した時刻(time.perf_counter)
+
+        Returns:
+            bool: 制限を超えていた(すぐには中継しない)場合はTrue
+        """
+        if self.RATE_LIMIT <= 0 and self.ROOM_BYTES_PER_SECOND <= 0:
+            return False
+        now = time.monotonic()
+        member_wait = 0.0
+        room_wait = 0.0
+        cost = (len(member.prefix) + len(message)) * max(len(room.members) - 1, 0)
+        if self.RATE_LIMIT > 0:
+            member_wait = self.__member_bucket(member, now).wait_time(1, now)
+        if self.ROOM_BYTES_PER_SECOND > 0:
+            room_wait = self.__room_bucket(room, now).wait_time(cost, now)
+        wait = max(member_wait, room_wait)
+
+        if wait == 0 or (
+            self.RATE_POLICY == "delay"
+            and wait <= self.MAX_RELAY_DELAY
+            and len(self.__delayed) < self.MAX_QUEUED_RELAYS
+        ):
+            if member.bucket is not None:
+                member.bucket.take(1, now)
+            if room.relay_bucket is not None:
+                room.relay_bucket.take(cost, now)
+            if wait == 0:
+                return False
+            self.relays_delayed.inc()
+            # 受信バッファは処理が終わると再利用されるので、メッセージはコピーしておく
+            self.__delay_relay(wait, room, member, bytes(message), received)
+            return True
+
+        if member_wait > 0:
+            self.member_rate_limited.inc()
+        else:
+            self.room_rate_limited.inc()
+        if self.RATE_POLICY == "notify" and now - member.notified >= 1.0:
+            member.notified = now
+            notice = "送信が多すぎるため、メッセージを破棄しました。しばらく待ってから送信してください。"
+            self.__send_to(member, notice.encode("utf-8"))
+        return True
+
+    def __member_bucket(self, member, now):
+        """ユーザーごとのメッセージ数のトークンバケット(初めて送信したときに作成する)"""
+        if member.bucket is None:
+            member.bucket = TokenBucket(self.RATE_LIMIT, self.RATE_BURST, now)
+        return member.bucket
+
+    def __room_bucket(self, room, now):
+        """部屋ごとの中継バイト数のトークンバケット(初めて中継したときに作成する)"""
+        if room.relay_bucket is None:
+            room.relay_bucket = TokenBucket(
+                self.ROOM_BYTES_PER_SECOND, self.ROOM_BYTES_PER_SECOND, now
+            )
+        return room.relay_bucket
+
+    def __delay_relay(self, delay, room, member, message, received):
+        """流量制限でメッセージの中継を遅らせる関数(引き継ぎに備えて遅らせている中継を記録する)"""
+        entry = (time.monotonic() + delay, room, member, message)
+        with self.__delayed_lock:
+            self.__delayed[id(entry)] = entry
+        self.__call_later_in_room(delay, room, self.__relay_delayed, entry, received)
+
+    def __relay_delayed(self, entry, received):
+        """流量制限で遅らせたメッセージを中継する関数"""
+        with self.__delayed_lock:
+            del self.__delayed[id(entry)]
+        _, room, member, message = entry
+        if room.members.get(member.token) is not member:
+            self.datagrams_dropped.inc()
+            return
+        self.__relay_message(room, member, message, received)
+
+    def __call_later_in_room(self, delay, room, fn, *args):
+        """delay秒後に部屋の処理を実行する関数
+
+        Note:
+            asyncioモードではイベントループで、スレッド方式では部屋の担当スレッドで実行する。
+        """
+        if self.actors is None:
+            self.__loop.call_later(delay, self.__run_timer, fn, args)
+        else:
+            self.__flush_timer.call_later(delay, self.actors.post, room.name, fn, *args)
+
+    def __run_timer(self, fn, args):
+        """asyncioモードでタイマーの処理を実行する関数(新しいプロセスに引き継いだ後は何もしない)"""
+        if not self.handed_over:
+            fn(*args)
+
+    def __relay_message(self, room, member, message, received):
+        """チャットメッセージを履歴に残し、同じ部屋の他のユーザーに中継する関数
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信者
+            message (memoryview | bytes): クライアントから送信されたメッセージ
+            received (float): 受信した時刻(time.perf_counter)
+        """
+        # エンコード済みの「ユーザー名: 」を付けるだけで、メッセージはデコードし直さない
+        payload = member.prefix + message
+        # 途中から参加したユーザーのために履歴に残す
+        seq = room.messages.append(payload)
+        if self.wal is not None:
+            self.wal.log_message(room.name, seq, payload)
+        # 最近のメッセージから圧縮の辞書を作り直した場合は、圧縮して受け取るユーザーに送る
+        if room.compressor is not None and room.compressor.observe(payload):
+            self.__send_dictionary(room)
+        if self.COALESCE_WINDOW > 0:
+            self.__relay_coalesced(room, member, seq, payload, received)
+            return
+        self.__send_others_in_same_room(room, member, payload)
+        if received is not None:
+            self.relay_latency.observe(time.perf_counter() - received)
+
+    def __relay_coalesced(self, room, member, seq, payload, received):
+        """まとめ送りを有効にしている場合にメッセージを中継する関数
+
+        Note:
+            直前の送信からCOALESCE_WINDOW秒以上経っていればすぐに送信する。
+            そうでなければ送信待ちにして、windowの終わりか、溜まったバイト数が
+            COALESCE_BYTESに達した時点でまとめて送信する。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信者
+            seq (int): メッセージのシーケンス番号
+            payload (bytes): エンコード済みの送信メッセージ
+            received (float): 受信した時刻(time.perf_counter)
+        """
+        pending = room.pending
+        now = time.monotonic()
+        if not pending.should_hold(self.COALESCE_WINDOW, now):
+            pending.last_flush = now
+            self.__send_others_in_same_room(room, member, payload)
+            if received is not None:
+                self.relay_latency.observe(time.perf_counter() - received)
+            return
+        if pending.add(seq, payload, member, received) >= self.COALESCE_BYTES:
+            self.__flush_room(room)
+        elif not pending.scheduled:
+            pending.scheduled = True
+            delay = max(pending.last_flush + self.COALESCE_WINDOW - now, 0)
+            # フラッシュも部屋の担当スレッドで行う
+            self.__call_later_in_room(delay, room, self.__flush_room, room)
+
+    def __flush_room(self, room):
+        """送信待ちのメッセージをまとめて中継する関数
+
+        Note:
+            全員に同じフレームを送り、まとめたメッセージの送信者には
+            自分のメッセージを除いたフレームを別に送る。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+        """
+        entries = room.pending.take(time.monotonic())
+        if not entries:
+            return
+        if len(entries) == 1:
+            _, payload, sender, _ = entries[0]
+            self.__send_others_in_same_room(room, sender, payload)
+        else:
+            # 既に退出した送信者には送らない
+            senders = {
+                sender
+                for _, _, sender, _ in entries
+                if room.members.get(sender.token) is sender
+            }
+            frames = protocol.encode_batch_frames(
+                [(seq, payload) for seq, payload, _, _ in entries]
+            )
+            for frame in frames:
+                self.__send_others_in_same_room(room, senders, frame)
+            for sender in senders:
+                own_frames = protocol.encode_batch_frames(
+                    [(seq, payload) for seq, payload, s, _ in entries if s is not sender]
+                )
+                for frame in own_frames:
+                    self.__send_to(sender, frame)
+            self.coalesced_messages.inc(len(entries))
+        now = time.perf_counter()
+        for _, _, _, received in entries:
+            if received is not None:
+                self.relay_latency.observe(now - received)
+
+    def __handle_control(self, room, member, message):
+        """クライアントからの制御メッセージを処理する関数
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信者
+            message (bytes): 制御メッセージ(CONTROL_PREFIX + 種別 + 引数)
+        """
+        opcode = message[1]
+        if opcode == protocol.OP_HISTORY:
+            (since_seq,) = struct.unpack_from("!Q", message, 2)
+            for frame in protocol.encode_history_frames(room.messages.since(since_seq)):
+                self.__send_to(member, frame)
+        elif opcode == protocol.OP_FRAGMENT:
+            self.__relay_fragment(room, member, message)
+        elif opcode == protocol.OP_DICTIONARY:
+            (dictionary_id,) = struct.unpack_from("!I", message, 2)
+            if (
+                member.compress
+                and room.compressor is not None
+                and room.compressor.dictionary_id == dictionary_id
+            ):
+                self.__send_dictionary(room, member)
+        elif opcode == protocol.OP_UNICAST:
+            room.use_unicast(member)
+            if self.wal is not None:
+                # 受け取り方の変更は、同じユーザーの参加のレコードを書き直して残す
+                self.wal.log_member_join(
+                    room.name,
+                    member.token,
+                    member.name,
+                    member.address,
+                    member.session_id or 0,
+                    member.flags,
+                )
+        elif opcode == protocol.OP_ACK:
+            if member.reliable is not None:
+                epoch, cumulative, ranges = protocol.decode_ack_control(message)
+                frames = member.reliable.on_ack(
+                    cumulative, ranges, time.monotonic(), epoch
+                )
+                self.__send_frames(room, member, frames)
+        else:
+            self.errors.inc()
+            logger.warning("Server Error:Unknown control message %s", opcode)
+
+    def __relay_fragment(self, room, member, message):
+        """大きなメッセージの断片を、溜めずにそのまま同じ部屋の他のユーザーに中継する関数
+
+        Note:
+            メッセージ全体は組み立てないため、履歴と追記型ログには残さない。
+            流量制限を超えた断片は遅らせずに破棄する。ユーザーごとのメッセージ数は最初の断片で数え、
+            2つ目以降の断片は最初の断片を中継したメッセージの分(断片の数-1個まで)だけ中継する。
+            途中の断片が部屋の流量制限を超えた場合は、そのメッセージの残りの断片も中継しない。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信者
+            message (memoryview): 断片の制御メッセージ
+        """
+        message_id, index, count, total, chunk = protocol.decode_fragment_control(
+            message
+        )
+        now = time.monotonic()
+        fragments = member.fragments
+        if index > 0:
+            remaining = fragments.get(message_id, 0) if fragments is not None else 0
+            if remaining == 0:
+                self.fragments_dropped.inc()
+                return
+        elif self.RATE_LIMIT > 0:
+            bucket = self.__member_bucket(member, now)
+            if bucket.wait_time(1, now) > 0:
+                self.member_rate_limited.inc()
+                return
+            bucket.take(1, now)
+        if self.ROOM_BYTES_PER_SECOND > 0:
+            cost = (len(member.prefix) + len(chunk)) * max(len(room.members) - 1, 0)
+            bucket = self.__room_bucket(room, now)
+            if bucket.wait_time(cost, now) > 0:
+                self.room_rate_limited.inc()
+                if index > 0:
+                    del fragments[message_id]
+                return
+            bucket.take(cost, now)
+        if index == 0:
+            if count > 1:
+                if fragments is None:
+                    fragments = member.fragments = {}
+                elif (
+                    message_id not in fragments
+                    and len(fragments) >= self.MAX_FRAGMENTED_MESSAGES
+                ):
+                    # 残りの断片が届かないメッセージで溜まらないように、古いものから忘れる
+                    del fragments[next(iter(fragments))]
+                fragments[message_id] = count - 1
+        elif remaining == 1:
+            del fragments[message_id]
+        else:
+            fragments[message_id] = remaining - 1
+        # 送信待ちのメッセージを先に送り、送信者ごとの順序を保つ
+        if room.pending:
+            self.__flush_room(room)
+        frame = protocol.encode_fragment_frame(
+            member.prefix, message_id, index, count, total, chunk
+        )
+        self.__send_others_in_same_room(room, member, frame)
+        self.fragments_relayed.inc()
+
+    def __leave_room(self, room, member, notify_self=False):
+        """ユーザーを部屋から退出させ、退出メッセージを送信する関数
+
+        Note:
+            ホストが退出した場合は部屋を終了する。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 退出するユーザー
+            notify_self (bool): 退出するユーザー自身にも退出メッセージを送るかどうか
+                (サーバー側でタイムアウトさせた場合はクライアントを終了させるために送る)
+        """
+        exclude = None if notify_self else member
+        # 送信待ちのメッセージを退出メッセージより先に送る
+        if room.pending:
+            self.__flush_room(room)
+        if member.token == room.host_token:
+            message = f"{member.name}が{room.name}から退出しました。\nホストが退出したため、チャットルーム:{room.name}を終了します。"
+            self.__broadcast(room, message.encode("utf-8"), exclude)
+            self.__close_room(room)
         else:
-            print(f"{room_name}: {sender_name}が'{message.decode('utf-8')}'を送信しました。")
-            decoded_message = message.decode("utf-8")
-            message = f"{sender_name}: {decoded_message}"
-            self.__send_others_in_same_room(room, token, message)
+            message = f"{member.name}が{room.name}から退出しました。"
+            self.__broadcast(room, message.encode("utf-8"), exclude)
+            self.__forget([member])
+            self.__unindex_member(member)
+            room.remove_client(member.token)
+            if self.wal is not None:
+                self.wal.log_member_leave(room.name, member.token)
+        logger.info(message)
+
+    def __close_room(self, room):
+        """部屋の全ユーザーを退出させて部屋を削除する関数"""
+        members = list(room.members.values())
+        self.__forget(members)
+        for room_member in members:
+            self.__unindex_member(room_member)
+        room.remove_all_users()
+        del self.rooms[room.name]
+        self.directory.remove(room.name)
+        if self.actors is not None:
+            self.actors.retire(room.name)
+        if self.wal is not None:
+            self.wal.log_room_close(room.name)
 
-    def __send_others_in_same_room(self, room, token, message):
+    def __send_others_in_same_room(self, room, member, message):
         """同じ部屋の他のユーザーにメッセージを送信
 
         Args:
             room (chat_room.ChatRoom): ChatRoomインスタンス
-            token (str): トークン
-            message (str): 送信メッセージ
+            member (member.Member | set): 送信者(まとめ送りの場合は送信者の集合)
+            message (bytes): エンコード済みの送信メッセージ
         """
-        # 受け取ったメッセージを部屋内の全クライアントに中継
-        for token_key, user_address in room.tokens_to_addrs.items():
-            if token != token_key:
-                self.udp_socket.sendto(message.encode("utf-8"), tuple(user_address))
+        # エンコード済みのメッセージを部屋内の全クライアントにまとめて中継
+        sent = self.__broadcast(room, message, member)
+        self.relay_fanout.observe(sent)
+
+    def __broadcast(self, room, message, exclude=None):
+        """部屋のユーザーにメッセージを送信する関数
+
+        Note:
+            再送・順序保証を指定していないユーザーにはFanOutでまとめて送信し、
+            指定したユーザーには1人ずつシーケンス番号を付けて送信する。
+            圧縮して受け取るユーザーには、1回だけ圧縮した同じバイト列を送る。
+            部屋名付きで受け取るユーザーには、部屋名を付けた同じバイト列を送る。
+            マルチキャストで受け取るユーザーには、部屋のグループに1回だけ送る。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            message (bytes): エンコード済みの送信メッセージ
+            exclude (member.Member | set): 送信しないユーザー(またはその集合)
+
+        Returns:
+            int: 送信先の数
+        """
+        sent = self.fanout.send(message, room.recipients, exclude)
+        compressed = message
+        if room.compressor is not None:
+            compressed = room.compressor.compress(message)
+            sent_compressed = self.fanout.send(
+                compressed, room.compressed_recipients, exclude
+            )
+            if compressed is not message:
+                self.compressed_datagrams.inc(sent_compressed)
+                self.compression_saved_bytes.inc(
+                    (len(message) - len(compressed)) * sent_compressed
+                )
+            sent += sent_compressed
+        if room.tagged_recipients:
+            sent += self.fanout.send(
+                room.tag + message, room.tagged_recipients, exclude
+            )
+        self.datagrams_sent.inc(sent)
+        if exclude is None:
+            excluded = ()
+        elif isinstance(exclude, Member):
+            excluded = (exclude,)
+        else:
+            excluded = exclude
+        if room.multicast_members:
+            sent += self.__send_multicast(room, message, excluded)
+        if room.reliable_members:
+            for member in room.reliable_members:
+                if member not in excluded:
+                    self.__send_reliable(
+                        room, member, compressed if member.compress else message
+                    )
+                    sent += 1
+        return sent
+
+    def __send_multicast(self, room, message, excluded):
+        """マルチキャストで受け取るユーザーに、部屋のグループへ1回だけ送信する関数
+
+        Note:
+            送信に失敗した場合と、除外するユーザーがフレームに収まらない場合は1人ずつユニキャストで送る。
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            message (bytes): エンコード済みの送信メッセージ
+            excluded (tuple | set): 送信しないユーザー
+
+        Returns:
+            int: 送信先の数
+        """
+        excluded_ids = [
+            member.session_id for member in excluded if member.multicast
+        ]
+        recipients = len(room.multicast_members) - len(excluded_ids)
+        if len(excluded_ids) <= 0xFF:
+            frame = protocol.encode_multicast_frame(
+                room.name.encode("utf-8"), excluded_ids, message
+            )
+            try:
+                self.multicast.send(frame, room.multicast_group)
+                self.multicast_datagrams.inc()
+                self.datagrams_sent.inc()
+                return recipients
+            except OSError as e:
+                logger.warning("Server Error:%s", e)
+        self.multicast_fallbacks.inc()
+        for member in room.multicast_members:
+            if member not in excluded:
+                self.__send_to(member, message)
+        return recipients
+
+    def __send_to(self, member, message, compress=True):
+        """1人のユーザーにメッセージ(履歴の応答や通知)を送信する関数
+
+        Args:
+            member (member.Member): 送信先
+            message (bytes): 送信データ
+            compress (bool): 圧縮して受け取るユーザーには圧縮して送るかどうか
+        """
+        if compress and member.compress and member.room.compressor is not None:
+            message = member.room.compressor.compress(message)
+        if member.reliable is not None:
+            self.__send_reliable(member.room, member, message)
+            return
+        if member.tagged:
+            message = member.room.tag + message
+        self.fanout.fallback_send(message, member.address)
+        self.datagrams_sent.inc()
+
+    def __send_dictionary(self, room, member=None):
+        """圧縮の辞書を送信する関数(辞書自体は圧縮しない)
+
+        Args:
+            room (chat_room.ChatRoom): ChatRoomインスタンス
+            member (member.Member): 送信先(Noneなら圧縮して受け取る全員)
+        """
+        frame = room.compressor.dictionary_frame()
+        if frame is None:
+            return
+        if member is not None:
+            self.__send_to(member, frame, compress=False)
+            return
+        self.datagrams_sent.inc(
+            self.fanout.send(frame, room.compressed_recipients, None)
+        )
+        for room_member in room.reliable_members:
+            if room_member.compress:
+                self.__send_reliable(room, room_member, frame)
+
+    def __send_reliable(self, room, member, message):
+        """再送・順序保証を指定したユーザーにシーケンス番号を付けて送信する関数"""
+        frames = member.reliable.send(message, time.monotonic())
+        if frames is None:
+            # 確認応答が長く届いていないユーザーのために、他のユーザーへの中継を止めない
+            self.reliable_overflow.inc()
+            return
+        self.__send_frames(room, member, frames)
+
+    def __send_frames(self, room, member, frames):
+        """再送・順序保証付きのフレームを送信し、再送のタイマーを登録する関数"""
+        tag = room.tag if member.tagged else b""
+        for frame in frames:
+            self.fanout.fallback_send(tag + frame, member.address)
+        self.datagrams_sent.inc(len(frames))
+        if frames and not member.reliable.timer_scheduled:
+            member.reliable.timer_scheduled = True
+            self.__call_later_in_room(
+                member.reliable.rto, room, self.__retransmit, room, member
+            )
+
+    def __retransmit(self, room, member):
+        """確認応答のないフレームを再送する関数(部屋の担当スレッドで実行する)"""
+        sender = member.reliable
+        sender.timer_scheduled = False
+        if room.members.get(member.token) is not member:
+            return
+        frames, delay = sender.poll(time.monotonic())
+        tag = room.tag if member.tagged else b""
+        for frame in frames:
+            self.fanout.fallback_send(tag + frame, member.address)
+        if frames:
+            self.datagrams_sent.inc(len(frames))
+            self.reliable_retransmits.inc(len(frames))
+        if delay is not None:
+            sender.timer_scheduled = True
+            self.__call_later_in_room(delay, room, self.__retransmit, room, member)
+
+    def print_fanout_stats(self):
+        """中継の統計情報(1秒あたりの送信件数)を表示する関数"""
+        print(
+            f"Fan-out: {self.fanout.recipients_sent} recipients, "
+            f"{self.fanout.recipients_per_second():.0f} recipients/s"
+        )
+
+
+class HandshakeConnection:
+    """スレッド方式でのハンドシェイク用TCP接続の状態"""
+
+    def __init__(self, sock, deadline):
+        """
+        Args:
+            sock (socket.socket): クライアントとの接続
+            deadline (float): この時刻(time.monotonic)までにリクエストがなければ閉じる
+        """
+        self.sock = sock
+        self.deadline = deadline
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        # 部屋の担当スレッドで処理中のリクエスト(concurrent.futures.Future)をリクエストの順に保持する
+        self.pending = collections.deque()
+        self.closed = False
+
+
+class UDPRelayProtocol(asyncio.DatagramProtocol):
+    """asyncioモードでUDP(9003)のデータグラムを受け取るプロトコル"""
+
+    def __init__(self, server):
+        """
+        Args:
+            server (Server): メッセージを処理するサーバー
+        """
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        logger.warning("Server Error:%s", exc)
 
 
 if __name__ == "__main__":
-    try:
-        server = Server()
-        server.start()
-    except KeyboardInterrupt:
-        print("Keyboard Interrupted")
-        server.tcp_socket.close()
-        server.udp_socket.close()
-        print("\nServer Closed")
+    parser = argparse.ArgumentParser(description="Online Chat Messenger Server")
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="スレッド方式(部屋ごとの処理をCPUコア数のスレッドで実行)で起動する",
+    )
+    parser.add_argument(
+        "--wal",
+        metavar="DIR",
+        help="部屋の状態を追記型ログとしてDIRに記録し、起動時に復元する",
+    )
+    parser.add_argument(
+        "--wal-messages",
+        action="store_true",
+        help="チャットメッセージ(履歴)もログに記録する",
+    )
+    parser.add_argument(
+        "--coalesce-ms",
+        type=float,
+        default=0,
+        help="メッセージの多い部屋で、この時間(ミリ秒)内に届いた中継をまとめて送る(0でまとめない)",
+    )
+    parser.add_argument(
+        "--coalesce-bytes",
+        type=int,
+        default=protocol.MAX_FRAME_SIZE,
+        help="まとめ送りで溜まったメッセージがこのバイト数に達したらすぐに送る",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="ユーザーごとの1秒あたりのメッセージ数の上限(0で制限しない)",
+    )
+    parser.add_argument(
+        "--rate-burst", type=int, default=10, help="ユーザーごとに連続して送信できるメッセージ数"
+    )
+    parser.add_argument(
+        "--room-bytes-per-second",
+        type=int,
+        default=0,
+        help="部屋ごとの1秒あたりの中継バイト数(メッセージ x 送信先数)の上限(0で制限しない)",
+    )
+    parser.add_argument(
+        "--rate-policy",
+        default="drop",
+        choices=["drop", "delay", "notify"],
+        help="上限を超えたメッセージを破棄する・遅らせて中継する・破棄して送信者に通知する",
+    )
+    parser.add_argument(
+        "--max-queued-relays",
+        type=int,
+        default=10000,
+        help="中継待ちの処理の合計の上限(超えた場合は処理待ちの多い部屋のメッセージから破棄する)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="計測値をPrometheusのテキスト形式で返すTCPポート(127.0.0.1)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"],
+        help="ログのレベル(DEBUGでメッセージごとのログも出力する)",
+    )
+    parser.add_argument(
+        "--log-rate", type=int, default=100, help="1秒あたりのログの最大件数(0で無制限)"
+    )
+    parser.add_argument(
+        "--compress-min-bytes",
+        type=int,
+        default=RoomCompressor.MIN_SIZE,
+        help="圧縮して受け取るユーザーに、このバイト数以上の中継を圧縮して送る",
+    )
+    parser.add_argument(
+        "--tcp-port", type=int, default=9002, help="ハンドシェイクを受け付けるTCPポート"
+    )
+    parser.add_argument(
+        "--udp-port", type=int, default=9003, help="チャットメッセージを中継するUDPポート"
+    )
+    parser.add_argument(
+        "--cluster-nodes",
+        help="クラスターのノード一覧(ホスト:TCPポート:UDPポート をカンマ区切りで指定)",
+    )
+    parser.add_argument(
+        "--cluster-file",
+        metavar="FILE",
+        help="クラスターのノード一覧のファイル(1行に1ノード、変更されたら読み込み直す)",
+    )
+    parser.add_argument(
+        "--token-key-file",
+        metavar="FILE",
+        help="署名したトークンを使う場合の鍵ファイル(1行に1つ 鍵ID:16進数の鍵、最後の鍵で署名する)",
+    )
+    parser.add_argument(
+        "--token-ttl",
+        type=int,
+        default=signed_token.TokenSigner.TTL,
+        help="署名したトークンの有効期限の秒数",
+    )
+    parser.add_argument(
+        "--multicast",
+        metavar="NETWORK",
+        help="部屋ごとのマルチキャストグループを選ぶネットワーク(例: 239.255.0.0/16)",
+    )
+    parser.add_argument(
+        "--multicast-port",
+        type=int,
+        default=multicast.MulticastGroups.PORT,
+        help="マルチキャストグループの宛先ポート",
+    )
+    parser.add_argument(
+        "--multicast-ttl",
+        type=int,
+        default=multicast.MulticastGroups.TTL,
+        help="マルチキャストのTTL(1ならローカルのネットワークから出さない)",
+    )
+    parser.add_argument(
+        "--handover",
+        metavar="PATH",
+        help="ホットリスタートの要求をこのUnixドメインソケットで待つ(asyncio方式のみ)",
+    )
+    parser.add_argument(
+        "--takeover",
+        action="store_true",
+        help="--handoverのパスで待っている動作中のサーバーからソケットと部屋の状態を引き継いで起動する",
+    )
+    args = parser.parse_args()
+    if args.handover and args.threaded:
+        parser.error("--handover is only supported in asyncio mode")
+    if args.takeover and not args.handover:
+        parser.error("--takeover requires --handover PATH")
+
+    configure_logging(args.log_level, args.log_rate)
+    wal = None
+    if args.wal:
+        wal = WriteAheadLog(args.wal, log_messages=args.wal_messages)
+    takeover = None
+    if args.takeover:
+        start = time.perf_counter()
+        takeover = handover.take_over(args.handover)
+        conn, sockets, next_session_id, rooms_data, state_data = takeover
+        state = handover.decode_state(next_session_id, rooms_data, state_data)
+        print(
+            f"Received {len(rooms_data) + len(state_data)} bytes of state "
+            f"in {time.perf_counter() - start:.3f} s"
+        )
+        server = Server(wal=wal, sockets=sockets[:2], state=state)
+        server.takeover_conn = conn
+        if len(sockets) > 2:
+            server.metrics_socket = sockets[2]
+            server.metrics_address = sockets[2].getsockname()
+    else:
+        server = Server(wal=wal, tcp_port=args.tcp_port, udp_port=args.udp_port)
+    server.handover_path = args.handover
+    if args.token_key_file:
+        server.tokens = signed_token.TokenSigner(
+            key_file=args.token_key_file, ttl=args.token_ttl
+        )
+    if args.multicast:
+        server.multicast = multicast.MulticastGroups(
+            args.multicast,
+            args.multicast_port,
+            server.udp_address[0],
+            args.multicast_ttl,
+        )
+    if args.cluster_nodes or args.cluster_file:
+        nodes = []
+        if args.cluster_nodes:
+            nodes = [cluster.parse_node(spec) for spec in args.cluster_nodes.split(",")]
+        server.cluster = cluster.ClusterMembership(
+            ("127.0.0.1", args.tcp_port, args.udp_port), nodes, args.cluster_file
+        )
+    server.COALESCE_WINDOW = args.coalesce_ms / 1000
+    server.COALESCE_BYTES = args.coalesce_bytes
+    server.RATE_LIMIT = args.rate_limit
+    server.RATE_BURST = args.rate_burst
+    server.ROOM_BYTES_PER_SECOND = args.room_bytes_per_second
+    server.RATE_POLICY = args.rate_policy
+    server.MAX_QUEUED_RELAYS = args.max_queued_relays
+    server.COMPRESS_MIN_BYTES = args.compress_min_bytes
+    if args.metrics_port is not None and server.metrics_socket is None:
+        server.metrics_address = ("127.0.0.1", args.metrics_port)
+    if not args.threaded:
+        server.start_async()
+    else:
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            print("Keyboard Interrupted")
+            server.tcp_socket.close()
+            server.udp_socket.close()
+            print("\nServer Closed")
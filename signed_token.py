@@ -0,0 +1,180 @@
+"""HMACで署名したトークン(部屋の状態を引かずに検証できる)
+
+python3 signed_token.py --key-id 1 >> token_keys.txt
+python3 server.py --token-key-file token_keys.txt [--token-ttl 86400]
+
+トークンはランダムなものと同じprotocol.RAW_TOKEN_SIZEバイトで、次の構成になる。
+    鍵ID(1) 部屋ID(4) 有効期限(4、UNIX時間の秒) メンバーID(7) | HMAC-SHA256の先頭16バイト
+部屋IDは部屋名のCRC32(workers.owner_ofと同じ値)で、部屋名を含まない短い形式のデータグラムも
+どのワーカーでも担当ワーカーを決められる。同じ鍵ファイルを読み込んだプロセス(ワーカー・再起動後の
+サーバー)は、発行したプロセスに問い合わせずにトークンを検証できる。
+
+鍵ファイルは1行に1つ「鍵ID:16進数の鍵」(#以降はコメント)で、最後の行の鍵で署名し、
+それ以外の鍵は検証にだけ使う。鍵を入れ替えるときは新しい鍵を末尾に追加し、古い鍵で署名した
+トークンの有効期限が切れてから古い鍵の行を消す。ファイルの変更は定期的に確認して読み込み直す。
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import secrets
+import struct
+import time
+import zlib
+
+import protocol
+from log import get_logger
+
+logger = get_logger("server")
+
+# 署名する部分: 鍵ID, 部屋ID, 有効期限, メンバーID
+PAYLOAD_FORMAT = "!B I I 7s"
+PAYLOAD_SIZE = struct.calcsize(PAYLOAD_FORMAT)
+MAC_SIZE = protocol.RAW_TOKEN_SIZE - PAYLOAD_SIZE
+
+
+def room_id(room_name):
+    """部屋名から部屋IDを求める
+
+    Args:
+        room_name (bytes): UTF-8エンコード済みの部屋名
+    """
+    return zlib.crc32(room_name)
+
+
+def token_room_id(token):
+    """署名したトークンの部屋ID"""
+    return int.from_bytes(token[1:5], byteorder="big")
+
+
+def read_keys(path):
+    """鍵ファイルを読み込む
+
+    Returns:
+        list: (鍵ID, 鍵) のリスト(ファイルの順)
+
+    Raises:
+        ValueError: 行の形式が不正な場合や、鍵が1つもない場合
+    """
+    keys = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            key_id, secret = line.split(":", 1)
+            key_id = int(key_id)
+            if not 0 <= key_id <= 0xFF:
+                raise ValueError(f"Key id {key_id} is out of range.")
+            keys.append((key_id, bytes.fromhex(secret.strip())))
+    if not keys:
+        raise ValueError(f"No token keys in {path}.")
+    return keys
+
+
+class TokenSigner:
+    """トークンの発行と検証"""
+
+    # トークンの有効期限の秒数
+    TTL = 24 * 60 * 60
+
+    def __init__(self, keys=(), key_file=None, ttl=TTL):
+        """
+        Args:
+            keys (list): (鍵ID, 鍵) のリスト(最後の鍵で署名する。key_fileを指定した場合は使わない)
+            key_file (str): 鍵ファイル(変更されたら読み込み直す)
+            ttl (int): 発行するトークンの有効期限の秒数
+        """
+        self.key_file = key_file
+        self.ttl = ttl
+        self.__mtime = None
+        if key_file is not None:
+            self.__mtime = os.stat(key_file).st_mtime_ns
+            keys = read_keys(key_file)
+        if not keys:
+            raise ValueError("At least one token key is required.")
+        self.__set_keys(keys)
+
+    def __set_keys(self, keys):
+        # 差し替えるだけで更新し、他のスレッドからはロックなしで参照する
+        self.signing_key_id, self.signing_key = keys[-1]
+        self.keys = dict(keys)
+
+    def issue(self, room_name, now=None):
+        """トークンを発行する
+
+        Args:
+            room_name (str): 参加する部屋名
+            now (float): 現在時刻(UNIX時間、省略時はtime.time())
+
+        Returns:
+            bytes: トークン(protocol.RAW_TOKEN_SIZEバイト)
+        """
+        if now is None:
+            now = time.time()
+        key_id, key = self.signing_key_id, self.signing_key
+        payload = struct.pack(
+            PAYLOAD_FORMAT,
+            key_id,
+            room_id(room_name.encode("utf-8")),
+            int(now + self.ttl) & 0xFFFFFFFF,
+            secrets.token_bytes(7),
+        )
+        return payload + hmac.digest(key, payload, hashlib.sha256)[:MAC_SIZE]
+
+    def verify(self, token, now=None):
+        """トークンの署名と有効期限を検証する(部屋の状態は参照しない)
+
+        Args:
+            token (bytes): トークン
+            now (float): 現在時刻(UNIX時間、省略時はtime.time())
+
+        Returns:
+            bool: 有効なトークンならTrue
+        """
+        if len(token) != protocol.RAW_TOKEN_SIZE:
+            return False
+        key = self.keys.get(token[0])
+        if key is None:
+            return False
+        payload = token[:PAYLOAD_SIZE]
+        expected = hmac.digest(key, payload, hashlib.sha256)[:MAC_SIZE]
+        if not hmac.compare_digest(expected, token[PAYLOAD_SIZE:]):
+            return False
+        expires = int.from_bytes(token[5:9], byteorder="big")
+        return (time.time() if now is None else now) < expires
+
+    def refresh(self):
+        """鍵ファイルが変更されていたら読み込み直す
+
+        Returns:
+            bool: 鍵が変わった場合はTrue
+        """
+        if self.key_file is None:
+            return False
+        try:
+            mtime = os.stat(self.key_file).st_mtime_ns
+            if mtime == self.__mtime:
+                return False
+            self.__mtime = mtime
+            keys = read_keys(self.key_file)
+        except (OSError, ValueError) as e:
+            logger.warning("Token Key Error:%s", e)
+            return False
+        if dict(keys) == self.keys and keys[-1][0] == self.signing_key_id:
+            return False
+        self.__set_keys(keys)
+        logger.info(
+            "Token keys changed: signing with %s, verifying %s",
+            self.signing_key_id,
+            ", ".join(map(str, sorted(self.keys))),
+        )
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a token signing key line")
+    parser.add_argument("--key-id", type=int, required=True, help="鍵ID(0〜255)")
+    args = parser.parse_args()
+    print(f"{args.key_id}:{secrets.token_hex(32)}")
@@ -0,0 +1,46 @@
+import protocol
+from fragment import Reassembler
+
+
+def fragments(message_id, data):
+    return [
+        protocol.decode_fragment_control(control)
+        for control in protocol.encode_fragment_controls(message_id, data)
+    ]
+
+
+def test_reassembles_out_of_order_and_ignores_duplicates():
+    data = b"y" * (protocol.FRAGMENT_SIZE * 2 + 10)
+    parts = fragments(1, data)
+    reassembler = Reassembler()
+    for message_id, index, count, total, chunk in (parts[2], parts[0], parts[0]):
+        assert reassembler.add(("a", message_id), index, count, total, chunk, 0.0) is None
+    _, index, count, total, chunk = parts[1]
+    assert reassembler.add(("a", 1), index, count, total, chunk, 0.0) == data
+    assert reassembler.pending_bytes == 0
+
+
+def test_single_fragment_message():
+    (message_id, index, count, total, chunk), = fragments(1, b"short")
+    assert Reassembler().add(("a", 1), index, count, total, chunk, 0.0) == b"short"
+
+
+def test_incomplete_message_expires():
+    parts = fragments(1, b"z" * (protocol.FRAGMENT_SIZE + 1))
+    reassembler = Reassembler(timeout=1.0)
+    _, index, count, total, chunk = parts[0]
+    reassembler.add(("a", 1), index, count, total, chunk, 0.0)
+    reassembler.expire(2.0)
+    assert reassembler.dropped == 1
+    _, index, count, total, chunk = parts[1]
+    assert reassembler.add(("a", 1), index, count, total, chunk, 2.0) is None
+
+
+def test_pending_bytes_limit_discards_oldest():
+    size = protocol.FRAGMENT_SIZE + 1
+    reassembler = Reassembler(max_pending_bytes=size * 2)
+    for message_id in range(3):
+        _, index, count, total, chunk = fragments(message_id, b"w" * size)[0]
+        reassembler.add(("a", message_id), index, count, total, chunk, 0.0)
+    assert list(reassembler.partials) == [("a", 1), ("a", 2)]
+    assert reassembler.dropped == 1
@@ -0,0 +1,69 @@
+import handover
+from chat_room import ChatRoom
+from rate_limit import TokenBucket
+
+
+def test_state_round_trip():
+    room = ChatRoom("部屋")
+    host = room.add_client(b"h" * 32, ("127.0.0.1", 1), "host", 1)
+    room.host_token = host.token
+    tagged = room.add_client(b"t" * 32, ("127.0.0.1", 2), "tagged", 2, tagged=True)
+    reliable = room.add_client(b"r" * 32, ("127.0.0.1", 3), "reliable", 3, reliable=True)
+    reliable.reliable.epoch = 3
+    room.messages.append(b"host: hi")
+    (frame,) = reliable.reliable.send(b"host: hi", now=0.0)
+    room.pending.add(2, b"host: pending", host, 0.0)
+    delayed = [(10.5, room, tagged, b"later")]
+
+    rooms_data, state_data = handover.encode_state({room.name: room}, delayed, now=10.0)
+    restored = handover.decode_state(9, rooms_data, state_data, now=20.0)
+
+    assert restored.next_session_id == 9
+    new_room = restored.rooms["部屋"]
+    assert new_room.host_token == b"h" * 32
+    assert new_room.messages.since(0) == [(1, b"host: hi")]
+    assert new_room.messages.next_seq == room.messages.next_seq
+    assert new_room.members[b"t" * 32].tagged
+    assert new_room.members[b"t" * 32] in new_room.tagged_recipients.members
+    new_reliable = new_room.members[b"r" * 32].reliable
+    assert new_reliable.epoch == reliable.reliable.epoch
+    assert list(new_reliable.unacked) == [1]
+    assert new_reliable.unacked[1][0] == frame
+    assert new_reliable.next_seq == 2
+    assert restored.reliable_members == [(new_room, new_room.members[b"r" * 32])]
+    assert restored.pending_rooms == [new_room]
+    assert [(seq, payload) for seq, payload, _, _ in new_room.pending.entries] == [
+        (2, b"host: pending")
+    ]
+    ((delay, delayed_room, sender, message),) = restored.delayed
+    assert abs(delay - 0.5) < 1e-6
+    assert (delayed_room, sender.token, message) == (new_room, b"t" * 32, b"later")
+
+
+
+def test_rate_limits_and_fragments_round_trip():
+    room = ChatRoom("room")
+    sender = room.add_client(b"s" * 32, ("127.0.0.1", 1), "sender")
+    idle = room.add_client(b"i" * 32, ("127.0.0.1", 2), "idle")
+    sender.bucket = TokenBucket(5.0, 10.0, 9.0)
+    sender.bucket.take(4, 9.0)
+    sender.notified = 9.5
+    sender.fragments = {7: 2, 8: 1}
+    room.relay_bucket = TokenBucket(1000.0, 1000.0, 9.75)
+    room.relay_bucket.take(600, 9.75)
+
+    rooms_data, state_data = handover.encode_state({room.name: room}, [], now=10.0)
+    restored = handover.decode_state(1, rooms_data, state_data, now=20.0)
+
+    new_room = restored.rooms["room"]
+    new_sender = new_room.members[b"s" * 32]
+    bucket = new_sender.bucket
+    assert (bucket.rate, bucket.burst, bucket.tokens) == (5.0, 10.0, 6.0)
+    assert abs(bucket.updated - 19.0) < 1e-6
+    assert abs(new_sender.notified - 19.5) < 1e-6
+    assert new_sender.fragments == {7: 2, 8: 1}
+    relay_bucket = new_room.relay_bucket
+    assert (relay_bucket.rate, relay_bucket.tokens) == (1000.0, 400.0)
+    assert abs(relay_bucket.updated - 19.75) < 1e-6
+    new_idle = new_room.members[b"i" * 32]
+    assert (new_idle.bucket, new_idle.fragments, new_idle.notified) == (None, None, 0.0)
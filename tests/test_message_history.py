@@ -0,0 +1,44 @@
+from message_history import MessageHistory
+
+
+def test_since_returns_newer_messages_in_order():
+    history = MessageHistory(capacity=4)
+    for i in range(3):
+        assert history.append(b"m%d" % i) == i + 1
+    assert history.since(0) == [(1, b"m0"), (2, b"m1"), (3, b"m2")]
+    assert history.since(2) == [(3, b"m2")]
+    assert history.since(3) == []
+
+
+def test_evicts_oldest_when_full():
+    history = MessageHistory(capacity=3)
+    for i in range(5):
+        history.append(b"m%d" % i)
+    assert len(history) == 3
+    assert history.since(0) == [(3, b"m2"), (4, b"m3"), (5, b"m4")]
+
+
+def test_evicts_by_total_bytes():
+    history = MessageHistory(capacity=10, max_bytes=10)
+    history.append(b"aaaa")
+    history.append(b"bbbb")
+    history.append(b"cccc")
+    assert history.since(0) == [(2, b"bbbb"), (3, b"cccc")]
+    assert history.size_bytes == 8
+
+
+def test_oversized_message_only_advances_seq():
+    history = MessageHistory(capacity=4, max_bytes=5)
+    history.append(b"ok")
+    assert history.append(b"too large") == 2
+    assert history.append(b"ok2") == 3
+    assert history.since(0) == [(1, b"ok"), (3, b"ok2")]
+
+
+def test_clear_keeps_sequence():
+    history = MessageHistory(capacity=4)
+    history.append(b"a")
+    history.clear()
+    assert history.since(0) == []
+    assert history.size_bytes == 0
+    assert history.append(b"b") == 2
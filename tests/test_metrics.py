@@ -0,0 +1,19 @@
+from metrics import Registry
+
+
+def test_labeled_counter_renders_one_line_per_label():
+    registry = Registry()
+    rejections = registry.labeled_counter("rejections_total", "Rejections", "reason")
+    errors = registry.counter("errors_total", "Errors")
+    rejections.labels("room_full").inc()
+    rejections.labels("room_exists").inc(2)
+    rejections.labels("room_full").inc()
+
+    lines = registry.render().decode("utf-8").splitlines()
+
+    assert lines[2:4] == [
+        'rejections_total{reason="room_exists"} 2',
+        'rejections_total{reason="room_full"} 2',
+    ]
+    assert "errors_total 0" in lines
+    assert errors.value == 0
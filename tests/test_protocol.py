@@ -0,0 +1,85 @@
+import pytest
+
+import protocol
+
+
+@pytest.mark.parametrize("binary", [True, False])
+@pytest.mark.parametrize("address", [("127.0.0.1", 5000), ("::1", 6000)])
+def test_join_request_round_trip(binary, address):
+    payload = protocol.encode_join_request(
+        "ユーザー", address, binary=binary, flags=protocol.FLAG_RELIABLE
+    )
+    request = protocol.decode_join_request(payload)
+    assert request == {
+        "user_name": "ユーザー",
+        "user_address": address,
+        "flags": protocol.FLAG_RELIABLE,
+        "binary": binary,
+    }
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_join_request_rejects_control_prefix_name(binary):
+    payload = protocol.encode_join_request("\x00\x01spoof", ("127.0.0.1", 1), binary=binary)
+    with pytest.raises(ValueError):
+        protocol.decode_join_request(payload)
+
+
+def test_check_name():
+    assert protocol.check_name("room") == "room"
+    with pytest.raises(ValueError):
+        protocol.check_name(chr(protocol.CONTROL_PREFIX) + "room")
+
+
+@pytest.mark.parametrize("binary", [True, False])
+def test_list_request_and_response_round_trip(binary):
+    request = protocol.decode_list_request(protocol.encode_list_request("b", 10, binary))
+    assert request == {"cursor": "b", "limit": 10, "binary": binary}
+    rooms = [("a", 1), ("部屋", 20)]
+    response = protocol.decode_list_response(
+        protocol.encode_list_response(protocol.STATUS_COMPLETED, rooms, "部屋", binary)
+    )
+    assert response["status"] == protocol.STATUS_COMPLETED
+    assert response["rooms"] == rooms
+    assert response["cursor"] == "部屋"
+
+
+def test_history_frames_split_by_size():
+    entries = [(i, b"x" * 100) for i in range(1, 40)]
+    frames = protocol.encode_history_frames(entries, max_size=500)
+    assert all(len(frame) <= 500 for frame in frames)
+    assert all(protocol.is_control(frame) for frame in frames)
+    decoded = [entry for frame in frames for entry in protocol.decode_history_frame(frame)]
+    assert decoded == entries
+
+
+def test_ack_control_round_trip_caps_ranges():
+    ranges = [(i * 10, i * 10 + 2) for i in range(1, 30)]
+    control = protocol.encode_ack_control(5, ranges, epoch=9)
+    epoch, cumulative, decoded = protocol.decode_ack_control(control)
+    assert (epoch, cumulative) == (9, 5)
+    assert decoded == ranges[: protocol.MAX_ACK_RANGES]
+
+
+def test_fragment_controls_round_trip():
+    data = bytes(range(256)) * 10
+    controls = protocol.encode_fragment_controls(7, data)
+    assert len(controls) == 3
+    chunks = []
+    for i, control in enumerate(controls):
+        message_id, index, count, total, chunk = protocol.decode_fragment_control(control)
+        assert (message_id, index, count, total) == (7, i, 3, len(data))
+        chunks.append(chunk)
+    assert b"".join(chunks) == data
+
+
+def test_fragment_control_rejects_inconsistent_header():
+    control = protocol.encode_fragment_controls(1, b"x" * 2000)[1]
+    with pytest.raises(ValueError):
+        protocol.decode_fragment_control(control + b"extra")
+
+
+def test_reliable_frame_round_trip():
+    frame = protocol.encode_reliable_frame(42, b"alice: hi", epoch=3)
+    assert protocol.is_control(frame)
+    assert protocol.decode_reliable_frame(frame) == (3, 42, b"alice: hi")
@@ -0,0 +1,22 @@
+from rate_limit import TokenBucket
+
+
+def test_burst_then_wait():
+    bucket = TokenBucket(rate=2, burst=2, now=0.0)
+    for _ in range(2):
+        assert bucket.wait_time(1, 0.0) == 0
+        bucket.take(1, 0.0)
+    assert bucket.wait_time(1, 0.0) == 0.5
+    assert bucket.wait_time(1, 0.5) == 0
+
+
+def test_take_borrows_tokens():
+    bucket = TokenBucket(rate=1, burst=1, now=0.0)
+    bucket.take(1, 0.0)
+    bucket.take(1, 0.0)
+    assert bucket.wait_time(1, 0.0) == 2.0
+
+
+def test_cost_above_burst_is_capped():
+    bucket = TokenBucket(rate=10, burst=5, now=0.0)
+    assert bucket.wait_time(100, 0.0) == 0
@@ -0,0 +1,63 @@
+import protocol
+from reliable import ReliableReceiver, ReliableSender
+
+
+def test_ack_removes_frames_and_updates_rto():
+    sender = ReliableSender()
+    frames = [sender.send(b"m%d" % i, now=0.0)[0] for i in range(3)]
+    assert [protocol.decode_reliable_frame(f)[1] for f in frames] == [1, 2, 3]
+    sender.on_ack(1, [(3, 3)], now=0.1)
+    assert list(sender.unacked) == [2]
+    assert sender.srtt == 0.1
+
+
+def test_retransmits_after_timeout_with_backoff():
+    sender = ReliableSender()
+    (frame,) = sender.send(b"m", now=0.0)
+    assert sender.poll(ReliableSender.INITIAL_RTO / 2)[0] == []
+    frames, wait = sender.poll(ReliableSender.INITIAL_RTO)
+    assert frames == [frame]
+    assert sender.rto == ReliableSender.INITIAL_RTO * 2
+    assert wait > 0
+    # 再送したフレームへの確認応答は往復時間の計測に使わない
+    sender.on_ack(1, [], now=1.0)
+    assert sender.srtt is None
+    assert sender.poll(10.0) == ([], None)
+
+
+def test_backlog_beyond_window():
+    sender = ReliableSender()
+    for i in range(ReliableSender.WINDOW):
+        sender.send(b"m", now=0.0)
+    assert sender.send(b"waiting", now=0.0) == []
+    frames = sender.on_ack(1, [], now=0.01)
+    assert [protocol.decode_reliable_frame(f)[2] for f in frames] == [b"waiting"]
+
+
+def test_receiver_reorders_and_acks_ranges():
+    receiver = ReliableReceiver()
+    assert receiver.receive(2, b"b") == []
+    assert receiver.receive(4, b"d") == []
+    assert receiver.ack() == (0, [(2, 2), (4, 4)])
+    assert receiver.receive(1, b"a") == [b"a", b"b"]
+    assert receiver.receive(1, b"a") == []
+    assert receiver.ack() == (2, [(4, 4)])
+
+
+def test_ack_from_another_epoch_is_ignored():
+    sender = ReliableSender(epoch=5)
+    (frame,) = sender.send(b"m", now=0.0)
+    assert protocol.decode_reliable_frame(frame) == (5, 1, b"m")
+    sender.on_ack(1, [], now=0.1, epoch=0)
+    assert list(sender.unacked) == [1]
+    sender.on_ack(1, [], now=0.1, epoch=5)
+    assert not sender.unacked
+
+
+def test_receiver_restarts_on_new_epoch():
+    receiver = ReliableReceiver()
+    assert receiver.receive(1, b"a") == [b"a"]
+    assert receiver.receive(3, b"c") == []
+    # 再起動したサーバーは新しい世代でシーケンス番号を1から数え直す
+    assert receiver.receive(1, b"new", epoch=7) == [b"new"]
+    assert receiver.ack() == (1, [])
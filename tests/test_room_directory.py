@@ -0,0 +1,63 @@
+import random
+
+from chat_room import ChatRoom
+from room_directory import RoomDirectory
+
+
+def scan(names, prefix, cursor, limit):
+    matched = sorted(name for name in names if name.startswith(prefix) and name > cursor)
+    return matched[:limit]
+
+
+def test_pages_follow_cursor_until_end():
+    directory = RoomDirectory()
+    names = [f"room-{i:03d}" for i in range(250)]
+    for name in names:
+        directory.add(ChatRoom(name))
+    seen = []
+    cursor = ""
+    while True:
+        rooms, cursor = directory.page("", cursor, 100)
+        seen.extend(name for name, _ in rooms)
+        if not cursor:
+            break
+    assert seen == names
+
+
+def test_prefix_search_and_member_count():
+    room = ChatRoom("abc")
+    room.add_client(b"t" * 32, ("127.0.0.1", 1), "user")
+    directory = RoomDirectory({"abc": room, "abd": ChatRoom("abd"), "b": ChatRoom("b")})
+    assert directory.page("ab", "", 10) == ([("abc", 1), ("abd", 0)], "")
+    assert directory.page("abc", "", 10) == ([("abc", 1)], "")
+    assert directory.page("z", "", 10) == ([], "")
+
+
+def test_limit_is_capped():
+    directory = RoomDirectory({f"r{i:04d}": ChatRoom(f"r{i:04d}") for i in range(300)})
+    rooms, cursor = directory.page("", "", 0)
+    assert len(rooms) == RoomDirectory.MAX_PAGE
+    assert cursor == rooms[-1][0]
+
+
+def test_matches_scan_after_random_changes():
+    rng = random.Random(1)
+    directory = RoomDirectory()
+    names = set()
+    for _ in range(5000):
+        name = f"{rng.choice('abc')}{rng.randrange(3000)}"
+        if name in names and rng.random() < 0.4:
+            directory.remove(name)
+            names.discard(name)
+        else:
+            directory.add(ChatRoom(name))
+            names.add(name)
+    assert len(directory) == len(names)
+    for prefix in ("", "a", "b1", "c29"):
+        cursor = ""
+        while True:
+            rooms, next_cursor = directory.page(prefix, cursor, 37)
+            assert [name for name, _ in rooms] == scan(names, prefix, cursor, 37)
+            if not next_cursor:
+                break
+            cursor = next_cursor
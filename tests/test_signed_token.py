@@ -0,0 +1,26 @@
+import protocol
+from signed_token import TokenSigner, room_id, token_room_id
+
+
+def test_issue_and_verify():
+    signer = TokenSigner([(1, b"k" * 32)], ttl=60)
+    token = signer.issue("部屋", now=1000)
+    assert len(token) == protocol.RAW_TOKEN_SIZE
+    assert token_room_id(token) == room_id("部屋".encode("utf-8"))
+    assert signer.verify(token, now=1059)
+    assert not signer.verify(token, now=1060)
+
+
+def test_rejects_tampered_and_unknown_key():
+    signer = TokenSigner([(1, b"k" * 32)])
+    token = signer.issue("a", now=0)
+    assert not signer.verify(token[:-1] + bytes([token[-1] ^ 1]), now=0)
+    assert not TokenSigner([(2, b"k" * 32)]).verify(token, now=0)
+
+
+def test_old_key_still_verifies_after_rotation():
+    old = TokenSigner([(1, b"a" * 32)])
+    token = old.issue("a", now=0)
+    rotated = TokenSigner([(1, b"a" * 32), (2, b"b" * 32)])
+    assert rotated.verify(token, now=0)
+    assert rotated.issue("a", now=0)[0] == 2
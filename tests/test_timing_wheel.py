@@ -0,0 +1,48 @@
+from timing_wheel import TimingWheel
+
+
+def test_expires_after_timeout():
+    wheel = TimingWheel(tick=1.0, now=0.0)
+    wheel.schedule("a", 5, now=0.0)
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.0) == ["a"]
+    assert "a" not in wheel
+    assert len(wheel) == 0
+
+
+def test_reschedule_extends_deadline():
+    wheel = TimingWheel(tick=1.0, now=0.0)
+    wheel.schedule("a", 5, now=0.0)
+    wheel.schedule("a", 5, now=3.0)
+    assert wheel.advance(7.0) == []
+    assert wheel.advance(8.0) == ["a"]
+
+
+def test_reschedule_shortens_deadline():
+    wheel = TimingWheel(tick=1.0, now=0.0)
+    wheel.schedule("a", 100, now=0.0)
+    wheel.schedule("a", 2, now=0.0)
+    assert wheel.advance(2.0) == ["a"]
+    assert wheel.advance(200.0) == []
+
+
+def test_cancel():
+    wheel = TimingWheel(tick=1.0, now=0.0)
+    wheel.schedule("a", 5, now=0.0)
+    wheel.cancel("a")
+    wheel.cancel("a")
+    assert wheel.advance(10.0) == []
+
+
+def test_long_timeouts_cascade_through_levels():
+    # 1階層4スロットにして、上位の階層から下位の階層への入れ直しを通す
+    wheel = TimingWheel(tick=1.0, slot_bits=2, levels=4, now=0.0)
+    timeouts = {f"k{t}": t for t in (1, 3, 4, 5, 15, 16, 17, 63, 64, 100)}
+    for key, timeout in timeouts.items():
+        wheel.schedule(key, timeout, now=0.0)
+    expired_at = {}
+    for now in range(1, 300):
+        for key in wheel.advance(float(now)):
+            expired_at[key] = now
+    # 最上位の階層の範囲を超える期限は、最上位の階層で入れ直しながら待つ
+    assert expired_at == timeouts
@@ -0,0 +1,168 @@
+import os
+
+import protocol
+import wal
+from chat_room import ChatRoom
+
+
+def make_room(name, members=2, messages=3):
+    room = ChatRoom(name)
+    for i in range(members):
+        room.add_client(bytes([i + 1]) * 32, ("127.0.0.1", 5000 + i), f"user{i}", i + 1)
+    room.host_token = bytes([1]) * 32
+    for i in range(messages):
+        room.messages.append(b"user0: m%d" % i)
+    return room
+
+
+def state(rooms):
+    return {
+        name: (
+            {
+                token: (member.name, member.address, member.session_id)
+                for token, member in room.members.items()
+            },
+            room.host_token,
+            room.messages.since(0),
+        )
+        for name, room in rooms.items()
+    }
+
+
+def open_log(directory, **options):
+    log = wal.WriteAheadLog(str(directory), log_messages=True, flush_interval=0, **options)
+    log.open()
+    return log
+
+
+def test_log_replay(tmp_path):
+    log = open_log(tmp_path)
+    log.log_room_create("a", b"h" * 32)
+    log.log_member_join("a", b"h" * 32, "host", ("127.0.0.1", 1), 7)
+    log.log_member_join("a", b"g" * 32, "guest", ("::1", 2))
+    log.log_message("a", 1, b"host: hi")
+    log.log_member_leave("a", b"g" * 32)
+    log.log_room_create("b", b"x" * 32)
+    log.log_room_close("b")
+    log.close()
+
+    rooms = wal.WriteAheadLog(str(tmp_path)).replay()
+    assert list(rooms) == ["a"]
+    room = rooms["a"]
+    assert room.host_token == b"h" * 32
+    assert list(room.members) == [b"h" * 32]
+    member = room.members[b"h" * 32]
+    assert (member.name, member.address, member.session_id) == ("host", ("127.0.0.1", 1), 7)
+    assert room.messages.since(0) == [(1, b"host: hi")]
+
+
+def test_snapshot_truncates_log_and_round_trips(tmp_path):
+    rooms = {"a": make_room("a"), "部屋": make_room("部屋", members=3, messages=0)}
+    log = open_log(tmp_path)
+    for i in range(5):
+        log.log_room_create(f"old{i}", b"")
+    log.snapshot(rooms, wait=True)
+    assert log.records_since_snapshot == 0
+    assert os.path.getsize(log.log_path) == 0
+    log.log_member_leave("a", bytes([2]) * 32)
+    rooms["a"].remove_client(bytes([2]) * 32)
+    log.close()
+
+    assert state(wal.WriteAheadLog(str(tmp_path)).replay()) == state(rooms)
+
+
+def test_needs_snapshot(tmp_path):
+    log = wal.WriteAheadLog(str(tmp_path), snapshot_every=3)
+    for _ in range(2):
+        log.log_room_close("a")
+    assert not log.needs_snapshot()
+    log.log_room_close("a")
+    assert log.needs_snapshot()
+
+
+def test_torn_batch_is_ignored(tmp_path):
+    log = wal.WriteAheadLog(str(tmp_path))
+    first = wal.encode_batch([wal.encode_room_create("a")])
+    second = wal.encode_batch([wal.encode_room_create("b")])
+    with open(log.log_path, "wb") as f:
+        f.write(first + second[:-1])
+    assert list(log.replay()) == ["a"]
+
+
+def test_message_already_in_snapshot_is_not_duplicated(tmp_path):
+    rooms = {"a": make_room("a", messages=2)}
+    log = open_log(tmp_path)
+    log.snapshot(rooms, wait=True)
+    # スナップショットに含まれた変更のレコードがマーカーの後に残っていた場合
+    log.log_message("a", 2, b"user0: m1")
+    log.log_message("a", 3, b"user0: m2")
+    log.close()
+
+    rooms = wal.WriteAheadLog(str(tmp_path)).replay()
+    assert rooms["a"].messages.since(0) == [
+        (1, b"user0: m0"),
+        (2, b"user0: m1"),
+        (3, b"user0: m2"),
+    ]
+
+
+def test_member_flags_survive_restart(tmp_path):
+    flags = protocol.FLAG_ROOM_TAG | protocol.FLAG_MULTICAST
+    log = open_log(tmp_path)
+    log.log_room_create("a", b"h" * 32)
+    log.log_member_join("a", b"h" * 32, "host", ("127.0.0.1", 1), 1, flags)
+    # マルチキャストをやめたユーザーは参加のレコードを書き直す
+    log.log_member_join("a", b"h" * 32, "host", ("127.0.0.1", 1), 1, protocol.FLAG_ROOM_TAG)
+    log.log_member_join("a", b"r" * 32, "guest", ("127.0.0.1", 2), 2, protocol.FLAG_RELIABLE)
+    log.close()
+
+    room = wal.WriteAheadLog(str(tmp_path)).replay()["a"]
+    assert room.members[b"h" * 32].flags == protocol.FLAG_ROOM_TAG
+    assert room.members[b"h" * 32] in room.tagged_recipients.members
+    assert room.members[b"r" * 32] in room.reliable_members
+    rooms = wal.decode_rooms(wal.encode_batch(wal.encode_rooms({"a": room})))
+    assert [member.flags for member in rooms["a"].members.values()] == [
+        protocol.FLAG_ROOM_TAG,
+        protocol.FLAG_RELIABLE,
+    ]
+
+
+
+def test_changes_after_snapshot_call_are_replayed_once(tmp_path):
+    rooms = {"a": make_room("a"), "b": make_room("b")}
+    # 書き込みスレッドがマーカーを処理する前に変更が入るよう、書き込みの間隔を空ける
+    log = wal.WriteAheadLog(str(tmp_path), log_messages=True, flush_interval=0.05)
+    log.open()
+    log.snapshot(rooms)
+    # 書き込みスレッドが変換する前に、部屋を変更してからレコードを追加する
+    seq = rooms["a"].messages.append(b"user0: later")
+    log.log_message("a", seq, b"user0: later")
+    rooms["a"].remove_client(bytes([2]) * 32)
+    log.log_member_leave("a", bytes([2]) * 32)
+    rooms["b"] = make_room("b", members=1, messages=1)
+    log.log_room_close("b")
+    log.log_room_create("b", bytes([1]) * 32)
+    log.log_member_join("b", bytes([1]) * 32, "user0", ("127.0.0.1", 5000), 1)
+    log.log_message("b", 1, b"user0: m0")
+    log.close()
+
+    assert state(wal.WriteAheadLog(str(tmp_path)).replay()) == state(rooms)
+
+
+def test_log_changes_snapshot_rooms(tmp_path):
+    rooms = {name: make_room(name) for name in ("a", "b", "c")}
+    log = open_log(tmp_path)
+    log.snapshot(rooms, wait=True)
+    log.log_member_leave("a", bytes([2]) * 32)
+    log.log_member_join("a", bytes([1]) * 32, "user0", ("127.0.0.1", 6000), 1)
+    log.log_member_join("a", bytes([3]) * 32, "user2", ("127.0.0.1", 6001))
+    log.log_room_close("b")
+    log.close()
+
+    restored = wal.WriteAheadLog(str(tmp_path)).replay()
+    assert sorted(restored) == ["a", "c"]
+    room = restored["a"]
+    assert [member.name for member in room.members.values()] == ["user0", "user2"]
+    assert room.members[bytes([1]) * 32].address == ("127.0.0.1", 6000)
+    assert sorted(member.slot for member in room.recipients.members) == [0, 1]
+    assert state({"c": restored["c"]}) == state({"c": rooms["c"]})
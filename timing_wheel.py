@@ -0,0 +1,111 @@
+class TimingWheel:
+    """階層型タイミングホイール
+
+    Note:
+        期限の更新(schedule)は辞書の書き換えだけで済むO(1)の処理で、エントリーは
+        スロットに入れたまま、スロットの時刻になった時点で最新の期限を確認する。
+        期限がまだ先であれば入れ直し、過ぎていれば期限切れとしてまとめて返す。
+        利用者数が増えても更新・期限切れ処理のコストは1件あたり一定になる。
+    """
+
+    def __init__(self, tick=1.0, slot_bits=6, levels=4, now=0.0):
+        """
+        Args:
+            tick (float): 1スロットあたりの秒数(期限切れの判定の粒度)
+            slot_bits (int): 1階層あたりのスロット数(2のslot_bits乗)
+            levels (int): 階層数
+            now (float): 現在時刻(time.monotonic)
+        """
+        self.tick = tick
+        self.__bits = slot_bits
+        self.__mask = (1 << slot_bits) - 1
+        self.__levels = levels
+        self.__wheels = [[set() for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self.__current = int(now / tick)
+        self.__deadlines = {}  # キー:期限(tick単位)
+        self.__locations = {}  # キー:(階層, スロット)
+
+    def __len__(self):
+        return len(self.__deadlines)
+
+    def __contains__(self, key):
+        return key in self.__deadlines
+
+    def schedule(self, key, timeout, now):
+        """キーの期限を now + timeout 秒に設定(更新)する
+
+        Args:
+            key: 任意のハッシュ可能なキー
+            timeout (float): 期限までの秒数
+            now (float): 現在時刻(time.monotonic)
+        """
+        deadline = max(int((now + timeout) / self.tick), self.__current + 1)
+        previous = self.__deadlines.get(key)
+        self.__deadlines[key] = deadline
+        # 期限が延びただけであれば、スロットの時刻になった時点で入れ直す
+        if previous is not None and previous <= deadline:
+            return
+        if previous is not None:
+            self.__unlink(key)
+        self.__insert(key, deadline)
+
+    def cancel(self, key):
+        """キーを削除する"""
+        if self.__deadlines.pop(key, None) is not None:
+            self.__unlink(key)
+
+    def __unlink(self, key):
+        level, slot = self.__locations.pop(key)
+        self.__wheels[level][slot].discard(key)
+
+    def __insert(self, key, deadline):
+        """期限に応じた階層・スロットにキーを入れる"""
+        delta = deadline - self.__current
+        level = 0
+        while level < self.__levels - 1 and delta >> (self.__bits * (level + 1)):
+            level += 1
+        slot = (deadline >> (self.__bits * level)) & self.__mask
+        self.__wheels[level][slot].add(key)
+        self.__locations[key] = (level, slot)
+
+    def advance(self, now):
+        """現在時刻まで進め、期限切れのキーをまとめて返す
+
+        Args:
+            now (float): 現在時刻(time.monotonic)
+
+        Returns:
+            list: 期限切れになったキー
+        """
+        expired = []
+        target = int(now / self.tick)
+        while self.__current < target:
+            self.__current += 1
+            self.__cascade()
+            slot = self.__wheels[0][self.__current & self.__mask]
+            if not slot:
+                continue
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                del self.__locations[key]
+                deadline = self.__deadlines[key]
+                if deadline <= self.__current:
+                    del self.__deadlines[key]
+                    expired.append(key)
+                else:
+                    self.__insert(key, deadline)
+        return expired
+
+    def __cascade(self):
+        """上位の階層のスロットの時刻になったら、そのエントリーを下位の階層へ入れ直す"""
+        for level in range(1, self.__levels):
+            if self.__current & ((1 << (self.__bits * level)) - 1):
+                break
+            slot_index = (self.__current >> (self.__bits * level)) & self.__mask
+            slot = self.__wheels[level][slot_index]
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                del self.__locations[key]
+                self.__insert(key, self.__deadlines[key])
@@ -1,43 +1,32 @@
-import socket
-import struct
+import asyncio
+import os
+import sys
 import threading
 
 
 class User:
-    TIMEOUT = 300
-
     def __init__(self, name):
         """Userクラスインスタンス化
 
         Args:
             name (str): ユーザー名
 
-         Note:
-             UDPソケットをアドレスとポート番号にバインドする際に、ポート番号に0を渡すことで
-             OSが利用可能なランダムなポートを選び、それ利用することができる。
+        Note:
+            ターミナルでの入力と表示だけを受け持ち、サーバーとの通信は
+            async_client.ChatSessionに任せる。
         """
-        self.__RANDOM_PORT_NUM = 0
-        self.__udp_server_address = ("127.0.0.1", 9003)
-        self.__udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.__udp_socket.bind(("127.0.0.1", self.__RANDOM_PORT_NUM))
         self.name = name
-        self.token = ""
         self.room_name = ""
-        self.is_host = False
-        self.address = self.__udp_socket.getsockname()
-        self.__timer = None
 
         # クライアントが入力したアクション番号
         self.__CREATE_ROOM_NUM = 1
         self.__JOIN_ROOM_NUM = 2
         self.__QUIT = 3
+        self.__LIST_ROOMS_NUM = 4
 
     def __input_text(self, input_description):
         """テキスト入力
 
-        Note:
-            テキストの入力と同時にタイムアウトタイマーをリセットする
-
         Returns:
             (str): 入力テキスト
         """
@@ -55,19 +44,21 @@ class User:
             1: 新しく部屋を作成
             2: 既存の部屋に入室
             3: 入力操作をやめる
+            4: 部屋の一覧を表示
 
         Returns:
-            (str): 入力番号(1、2、3のいずれか)
+            (str): 入力番号(1、2、3、4のいずれか)
         """
         while True:
             try:
-                print("Please enter 1, 2 or 3")
-                input_description = "1. Create a new room\n2. Join an existing room\n3. Quit\nChoose an option: "
+                print("Please enter 1, 2, 3 or 4")
+                input_description = "1. Create a new room\n2. Join an existing room\n3. Quit\n4. List rooms\nChoose an option: "
                 operation = self.__input_text(input_description)
                 if int(operation) in [
                     self.__CREATE_ROOM_NUM,
                     self.__JOIN_ROOM_NUM,
                     self.__QUIT,
+                    self.__LIST_ROOMS_NUM,
                 ]:
                     return operation
             except Exception:
@@ -92,79 +83,92 @@ class User:
                 continue
             return self.room_name
 
-    def __generate_request(self, message):
-        """リクエスト情報の生成
+    def input_room_prefix(self):
+        """一覧で検索する部屋名の先頭の入力(空の場合は全部屋)
+
+        Returns:
+            (str): 部屋名の先頭
+        """
+        while True:
+            ROOM_NAME_MAX_BYTE_SIZE = 255
+            prefix = input("Enter the beginning of the room name (empty for all rooms): ")
+            prefix_size = len(prefix.encode("utf-8"))
+            if prefix_size > ROOM_NAME_MAX_BYTE_SIZE:
+                print(f"Room name bytes: {prefix_size} is too large.")
+                continue
+            return prefix
+
+    def show_rooms(self, rooms, has_next):
+        """部屋の一覧を表示し、続きを表示するかどうかを入力させる
 
         Args:
-            message (str): メッセージ
+            rooms (list): (部屋名, 人数) のリスト
+            has_next (bool): 続きのページがあるかどうか
 
         Returns:
-            bytes: リクエスト情報
+            (bool): 続きを表示する場合はTrue
         """
-        header = struct.pack(
-            "!B B",
-            len(self.room_name.encode("utf-8")),
-            len(self.token.encode("utf-8")),
-        )
-        body = self.room_name + self.token + message
-        encoded_body = body.encode("utf-8")
-        request_info = header + encoded_body
-        return request_info
-
-    def send_message(self):
-        """メッセージの送信"""
+        if not rooms:
+            print("No rooms found.")
+        for room_name, members in rooms:
+            print(f"  {room_name} ({members})")
+        if not has_next:
+            return False
+        return input("Show more rooms? [y/N]: ").strip().lower() == "y"
 
+    def __read_lines(self, loop, lines):
+        """入力された行をイベントループのキューに渡す(入力待ちで止まるため別スレッドで実行する)
+
+        Note:
+            input()は終了時にも標準入力のロックを持ったままになるため、
+            ファイルディスクリプタから直接読み込む。
+        """
+        pending = b""
         while True:
-            # メッセージの入力
-            input_message = self.__input_text("")
-            self.__reset_timer()
-            request_info = self.__generate_request(input_message)
-            # メッセージを送信
-            # Todo メッセージのバイトサイズを超えた際の例外処理
-            self.__udp_socket.sendto(request_info, self.__udp_server_address)
-            if "exit" == input_message:
-                self.__udp_socket.close()
-                exit()
-
-    def receive_message(self):
-        """メッセージの受信"""
-        while True:
-            # メッセージを受信
-            data, _ = self.__udp_socket.recvfrom(4096)
-            decoded_data = data.decode("utf-8")
-            print(decoded_data)
-            if (
-                f"ホストが退出したため、チャットルーム:{self.room_name}を終了します。" in decoded_data
-                or decoded_data == f"{self.name}が{self.room_name}から退出しました。"
-            ):
-                print("UDPソケットを閉じる。")
-                self.__cancel_timer()
-                self.__udp_socket.close()
-                exit()
-
-    def __reset_timer(self):
-        """タイムアウトのカウントをリセットする"""
-        self.start_timer()
-
-    def start_timer(self):
-        """タイマーを開始または再開する"""
-        if self.__timer:
-            # 既存のタイマーがあればキャンセル
-            self.__timer.cancel()
-        self.__timer = threading.Timer(User.TIMEOUT, self.__timeout)
-        self.__timer.start()
-
-    def __timeout(self):
-        """指定した時間が経過したときに実行されるメソッド"""
-        print("Timed out!")
-        request_info = self.__generate_request("exit")
-
-        # メッセージを送信
-        # Todo メッセージのバイトサイズを超えた際の例外処理
-        self.__udp_socket.sendto(request_info, self.__udp_server_address)
-        self.__udp_socket.close()
-        exit()
-
-    def __cancel_timer(self):
-        """タイマーを止める"""
-        self.__timer.cancel()
+            chunk = os.read(sys.stdin.fileno(), 4096)
+            if not chunk:
+                loop.call_soon_threadsafe(lines.put_nowait, None)
+                return
+            *completed, pending = (pending + chunk).split(b"\n")
+            for line in completed:
+                text = line.decode("utf-8", "replace").rstrip("\r")
+                # Enterなどの入力文字がない場合は送信しない
+                if text != "":
+                    loop.call_soon_threadsafe(lines.put_nowait, text)
+
+    async def __print_messages(self, session, lines):
+        """受信したメッセージを表示し、退出・部屋の終了で入力の待ちを終わらせる"""
+        async for message in session:
+            print(message)
+        lines.put_nowait(None)
+
+    async def chat(self, session):
+        """入力したメッセージを送信し、受信したメッセージを表示する
+
+        Note:
+            exitと入力するか、退出・部屋の終了の通知を受け取ると終了する。
+            入力待ちのスレッドはデーモンスレッドにして、終了時に待たない。
+
+        Args:
+            session (async_client.ChatSession): 参加した部屋のユーザー
+        """
+        lines = asyncio.Queue()
+        threading.Thread(
+            target=self.__read_lines,
+            args=(asyncio.get_running_loop(), lines),
+            daemon=True,
+        ).start()
+        printer = asyncio.create_task(self.__print_messages(session, lines))
+        try:
+            while not session.closed:
+                text = await lines.get()
+                if text is None:
+                    break
+                try:
+                    session.send(text)
+                except (ValueError, ConnectionError) as e:
+                    print(e)
+        finally:
+            session.leave()
+            await printer
+        print("UDPソケットを閉じる。")
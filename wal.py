@@ -0,0 +1,738 @@
+"""部屋の状態の追記型ログ(WAL)とスナップショット
+
+部屋の作成・終了、ユーザーの参加・退出、ホストの変更、(任意で)メッセージをバイナリのレコードとして
+ログファイルに追記し、サーバーの再起動時にスナップショットとログをmmapで読み込んで
+ChatRoomを復元する。
+
+ファイルはバッチの並びで、各バッチは (レコード部のバイト数(!I), CRC32(!I)) の後にレコードが続く。
+途中で書き込みが途切れたバッチ(CRCが一致しないもの)以降は読み込まない。
+レコードは種別ごとの固定長部分(種別と各文字列のバイト数など)の後に、文字列が続く。
+トークンは16進数文字列ではなくバイト列のまま格納する。
+スナップショットは部屋ごとに、ユーザー全員と履歴をそれぞれ1つのレコード(ROOM_MEMBERS,
+ROOM_MESSAGES)にまとめて格納し、再起動時は変更のレコードを経由せずに直接ChatRoomを組み立てる。
+"""
+
+import contextlib
+import functools
+import gc
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from itertools import accumulate, repeat
+
+import protocol
+from chat_room import ChatRoom
+from member import Member
+
+# レコードの種別
+ROOM_CREATE = 1
+ROOM_CLOSE = 2
+MEMBER_JOIN = 3
+MEMBER_LEAVE = 4
+HOST_CHANGE = 5
+MESSAGE = 6
+# スナップショットのみで使う種別
+ROOM_MEMBERS = 7
+ROOM_MESSAGES = 8
+
+BATCH_HEADER = struct.Struct("!I I")
+# 種別ごとの固定長部分(可変長の文字列はこの後に続く)
+# 部屋の作成・終了: 種別, 部屋名のバイト数 + 部屋名
+ROOM_HEADER = struct.Struct("!B B")
+# 参加: 種別, 部屋名・トークン・ユーザー名・IPアドレスのバイト数, ポート番号,
+# セッションID(発行していない場合は0), 中継の受け取り方(protocol.FLAG_*) + 各文字列
+# (同じユーザーのレコードが続いた場合は後のものが有効なので、受け取り方の変更にも使う)
+JOIN_HEADER = struct.Struct("!B B B B B H I B")
+# 退出・ホストの変更: 種別, 部屋名・トークンのバイト数 + 各文字列
+TOKEN_HEADER = struct.Struct("!B B B")
+# メッセージ: 種別, 部屋名のバイト数, シーケンス番号, メッセージのバイト数 + 部屋名, メッセージ
+MESSAGE_HEADER = struct.Struct("!B B Q H")
+# 部屋のユーザー全員: 種別, 部屋名のバイト数, ユーザー数, IPアドレスの数 + 部屋名,
+# 各トークン・IPアドレスのバイト数(!B), 各「ユーザー名: 」のバイト数(!H), 各IPアドレスの番号(!H),
+# 各ポート番号(!H), 各セッションID(!I), 各中継の受け取り方(!B),
+# 各トークン, 各「ユーザー名: 」(Member.prefix), 各IPアドレス
+MEMBERS_HEADER = struct.Struct("!B B H H")
+# 部屋の履歴: 種別, 部屋名のバイト数, メッセージの数 + 部屋名,
+# 各シーケンス番号(!Q), 各メッセージのバイト数(!H), 各メッセージ
+MESSAGES_HEADER = struct.Struct("!B B H")
+
+LOG_FILE_NAME = "rooms.log"
+SNAPSHOT_FILE_NAME = "rooms.snapshot"
+
+
+def encode_room_create(room_name):
+    encoded_room_name = room_name.encode("utf-8")
+    return ROOM_HEADER.pack(ROOM_CREATE, len(encoded_room_name)) + encoded_room_name
+
+
+def encode_room_close(room_name):
+    encoded_room_name = room_name.encode("utf-8")
+    return ROOM_HEADER.pack(ROOM_CLOSE, len(encoded_room_name)) + encoded_room_name
+
+
+def encode_member_join(
+    room_name, token, user_name, user_address, session_id=0, flags=0
+):
+    encoded_room_name = room_name.encode("utf-8")
+    encoded_user_name = user_name.encode("utf-8")
+    encoded_host = user_address[0].encode("utf-8")
+    header = JOIN_HEADER.pack(
+        MEMBER_JOIN,
+        len(encoded_room_name),
+        len(token),
+        len(encoded_user_name),
+        len(encoded_host),
+        user_address[1],
+        session_id,
+        flags,
+    )
+    return header + encoded_room_name + token + encoded_user_name + encoded_host
+
+
+def _encode_token_record(kind, room_name, token):
+    encoded_room_name = room_name.encode("utf-8")
+    header = TOKEN_HEADER.pack(kind, len(encoded_room_name), len(token))
+    return header + encoded_room_name + token
+
+
+def encode_member_leave(room_name, token):
+    return _encode_token_record(MEMBER_LEAVE, room_name, token)
+
+
+def encode_host_change(room_name, token):
+    return _encode_token_record(HOST_CHANGE, room_name, token)
+
+
+def encode_message(room_name, seq, data):
+    encoded_room_name = room_name.encode("utf-8")
+    header = MESSAGE_HEADER.pack(MESSAGE, len(encoded_room_name), seq, len(data))
+    return header + encoded_room_name + data
+
+
+def encode_room_members(room_name, members):
+    """部屋のユーザー全員を1つのレコードにする(スナップショット用)
+
+    Note:
+        ユーザーごとの値を種類ごとにまとめて並べ、復元時にユーザーごとのレコードを
+        解析せずに済むようにする。IPアドレスは部屋ごとの一覧にして番号で参照する。
+
+    Args:
+        room_name (str): 部屋名
+        members (list): member.Memberのリスト
+
+    Returns:
+        bytes: レコード
+    """
+    encoded_room_name = room_name.encode("utf-8")
+    count = len(members)
+    tokens = [member.token for member in members]
+    prefixes = [member.prefix for member in members]
+    hosts = {}
+    host_indexes = [hosts.setdefault(member.address[0], len(hosts)) for member in members]
+    encoded_hosts = [host.encode("utf-8") for host in hosts]
+    return b"".join(
+        [
+            MEMBERS_HEADER.pack(
+                ROOM_MEMBERS, len(encoded_room_name), count, len(encoded_hosts)
+            ),
+            encoded_room_name,
+            bytes(map(len, tokens)),
+            bytes(map(len, encoded_hosts)),
+            struct.pack(f"!{count}H", *map(len, prefixes)),
+            struct.pack(f"!{count}H", *host_indexes),
+            struct.pack(f"!{count}H", *[member.address[1] for member in members]),
+            struct.pack(f"!{count}I", *[member.session_id or 0 for member in members]),
+            bytes([member.flags for member in members]),
+            *tokens,
+            *prefixes,
+            *encoded_hosts,
+        ]
+    )
+
+
+def encode_room_messages(room_name, messages):
+    """部屋の履歴を1つのレコードにする(スナップショット用)
+
+    Args:
+        room_name (str): 部屋名
+        messages (list): (シーケンス番号, メッセージ) のリスト
+
+    Returns:
+        bytes: レコード
+    """
+    encoded_room_name = room_name.encode("utf-8")
+    count = len(messages)
+    return b"".join(
+        [
+            MESSAGES_HEADER.pack(ROOM_MESSAGES, len(encoded_room_name), count),
+            encoded_room_name,
+            struct.pack(f"!{count}Q", *[seq for seq, _ in messages]),
+            struct.pack(f"!{count}H", *[len(data) for _, data in messages]),
+            *[data for _, data in messages],
+        ]
+    )
+
+
+def encode_batch(records):
+    """レコードのリストをCRC付きのバッチにまとめる"""
+    body = b"".join(records)
+    return BATCH_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def encode_rooms(rooms):
+    """部屋の現在の状態を、スナップショットのレコードのリストに変換する
+
+    Args:
+        rooms (dict): 部屋名:ChatRoomの辞書
+
+    Returns:
+        list: レコードのリスト
+    """
+    records = []
+    # 書き込みスレッドから呼ぶ場合は他のスレッドが変更中なので、辞書は一度に複製してから辿る
+    for room_name, room in list(rooms.items()):
+        records.append(encode_room_create(room_name))
+        records.append(encode_room_members(room_name, list(room.members.values())))
+        if room.host_token:
+            records.append(encode_host_change(room_name, room.host_token))
+        records.append(encode_room_messages(room_name, room.messages.since(0)))
+    return records
+
+
+class _Snapshot:
+    """書き込みスレッドにスナップショットの作成を依頼するためのマーカー"""
+
+    def __init__(self, rooms):
+        self.rooms = rooms  # 部屋名:ChatRoomの辞書(書き込みスレッドが辿ってレコードにする)
+        self.done = threading.Event()
+
+
+class WriteAheadLog:
+    """部屋の状態の変更をログファイルに追記する
+
+    Note:
+        append()はメモリ上のリストに追加するだけで、ディスクへの書き込みとfsyncは
+        書き込みスレッドがflush_interval秒ごとにまとめて行う(グループコミット)。
+        そのため中継処理がディスクI/Oで止まることはない。
+    """
+
+    def __init__(
+        self, directory, log_messages=False, flush_interval=0.005, snapshot_every=100000
+    ):
+        """
+        Args:
+            directory (str): ログとスナップショットを置くディレクトリ
+            log_messages (bool): チャットメッセージもログに残すかどうか
+            flush_interval (float): まとめて書き込む間隔[秒]
+            snapshot_every (int): スナップショットを作成するまでのレコード数
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.log_messages = log_messages
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.log_path = os.path.join(directory, LOG_FILE_NAME)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE_NAME)
+        self.records_since_snapshot = 0
+        self.__pending = []
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__fd = None
+        self.__writer = None
+
+    def open(self):
+        """ログファイルを開き、書き込みスレッドを開始する"""
+        self.__fd = os.open(self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def append(self, record):
+        """レコードを書き込み待ちに追加する(ディスクへの書き込みは待たない)
+
+        Args:
+            record (bytes): レコード
+        """
+        with self.__condition:
+            self.__pending.append(record)
+            self.records_since_snapshot += 1
+            if len(self.__pending) == 1:
+                self.__condition.notify()
+
+    def log_room_create(self, room_name, host_token):
+        self.append(encode_room_create(room_name))
+        self.append(encode_host_change(room_name, host_token))
+
+    def log_room_close(self, room_name):
+        self.append(encode_room_close(room_name))
+
+    def log_member_join(
+        self, room_name, token, user_name, user_address, session_id=0, flags=0
+    ):
+        self.append(
+            encode_member_join(
+                room_name, token, user_name, user_address, session_id, flags
+            )
+        )
+
+    def log_member_leave(self, room_name, token):
+        self.append(encode_member_leave(room_name, token))
+
+    def log_message(self, room_name, seq, data):
+        if self.log_messages:
+            self.append(encode_message(room_name, seq, data))
+
+    def needs_snapshot(self):
+        """スナップショットを作成する時期かどうか"""
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def snapshot(self, rooms, wait=False):
+        """現在の部屋の状態をスナップショットとして保存し、ログを空にする
+
+        Note:
+            呼び出したスレッド(サーバーではイベントループ)はマーカーを追加するだけで、
+            レコードへの変換とファイルへの書き込みは、書き込みスレッドがそれまでのレコードを
+            書き終えた後に行う。変換するのはマーカーの追加より後の部屋の状態なので、
+            マーカーより前のレコードの変更は必ずスナップショットに含まれる。
+            その後の変更のレコードはマーカーの後に書かれ、スナップショットに含まれた変更と
+            重なるが、レコードは変更後の状態を表す(作成は部屋を空にし、参加は上書きし、
+            メッセージはシーケンス番号で読み飛ばす)ので、2回適用しても結果は変わらない。
+            部屋ごとのユーザーの辞書と履歴は、それぞれ一度に複製してから変換する。
+
+        Args:
+            rooms (dict): 部屋名:ChatRoomの辞書
+            wait (bool): 書き込みが終わるまで待つかどうか
+        """
+        with self.__condition:
+            marker = _Snapshot(rooms)
+            self.__pending.append(marker)
+            self.records_since_snapshot = 0
+            self.__condition.notify()
+        if wait:
+            marker.done.wait()
+
+    def close(self):
+        """書き込み待ちのレコードを書き込んでからログファイルを閉じる"""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        if self.__writer is not None:
+            self.__writer.join()
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __write_loop(self):
+        """書き込みスレッドの処理"""
+        while True:
+            with self.__condition:
+                while not self.__pending and not self.__closed:
+                    self.__condition.wait()
+                closed = self.__closed
+            # 少し待ってからまとめて書き込む(グループコミット)
+            if not closed:
+                time.sleep(self.flush_interval)
+            with self.__condition:
+                pending, self.__pending = self.__pending, []
+            self.__write(pending)
+            if closed and not pending:
+                return
+
+    def __write(self, pending):
+        """レコードとスナップショットのマーカーを順番に書き込む"""
+        records = []
+        for item in pending:
+            if isinstance(item, _Snapshot):
+                self.__flush(records)
+                records = []
+                self.__write_snapshot(encode_rooms(item.rooms))
+                item.done.set()
+            else:
+                records.append(item)
+        self.__flush(records)
+
+    def __flush(self, records):
+        if not records:
+            return
+        os.write(self.__fd, encode_batch(records))
+        os.fsync(self.__fd)
+
+    def __write_snapshot(self, records):
+        """スナップショットを一時ファイルに書き込んでから置き換え、ログを空にする"""
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(encode_batch(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        os.ftruncate(self.__fd, 0)
+        os.fsync(self.__fd)
+
+    def replay(self):
+        """スナップショットとログから部屋の状態を復元する
+
+        Note:
+            スナップショットからは直接ChatRoomを組み立てる。ログのレコードはまず軽量な辞書に適用し、
+            最後に残っている部屋とユーザーだけをChatRoomにする。スナップショットの部屋は、
+            ログのレコードが変更した部屋だけを辞書に移して適用し直す。
+            ログはsnapshot_everyレコードごとにスナップショットに置き換えるので、読み込むのは
+            現在の状態とその後のsnapshot_every件前後のレコードだけになる。
+
+        Returns:
+            dict: 部屋名:ChatRoomの辞書
+        """
+        snapshot = {}
+        states = {}
+        with _gc_paused():
+            _replay_file(
+                self.snapshot_path, functools.partial(_load_rooms, rooms=snapshot)
+            )
+            _replay_file(
+                self.log_path,
+                functools.partial(_apply_records, states=states, snapshot=snapshot),
+            )
+            return _build_rooms(states, snapshot)
+
+
+def decode_rooms(data):
+    """encode_batchでまとめた部屋の状態(encode_roomsのレコード)からChatRoomを組み立てる
+
+    Args:
+        data (bytes): 1つ以上のバッチ
+
+    Returns:
+        dict: 部屋名:ChatRoomの辞書
+
+    Raises:
+        ValueError: バッチが途切れているかCRCが一致しない場合
+    """
+    snapshot = {}
+    with _gc_paused():
+        load = functools.partial(_load_rooms, rooms=snapshot)
+        if _apply_batches(data, len(data), load) != len(data):
+            raise ValueError("Corrupted room state.")
+        return _build_rooms({}, snapshot)
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """復元の間、循環参照のGCを止め、復元したオブジェクトを以後のGCの対象から外す
+
+    Note:
+        復元で作るオブジェクトはほとんどが最後まで残るため、途中のGCは何も回収できないまま
+        増え続けるオブジェクトを何度も走査することになる。GCを再開した直後も、
+        復元したオブジェクトを世代ごとに走査し直すことになるので、gc.freeze()で対象から外す。
+        部屋を閉じるときは先にユーザーを削除して循環参照を切るため、外したオブジェクトも
+        参照カウントで解放される。
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.freeze()
+        if enabled:
+            gc.enable()
+
+
+def _build_rooms(states, snapshot):
+    """レコードを適用した軽量な辞書とスナップショットの部屋からChatRoomを組み立てる
+
+    Note:
+        部屋名・ユーザー名・IPアドレスはレコードのバイト列のまま持っているので、
+        最後まで残った部屋とユーザーの分だけここでデコードする。
+        スナップショットから辞書に移した部屋は、ChatRoomをそのまま使い、
+        いなくなったユーザーと、ログで参加し直したユーザーだけを入れ替える。
+
+    Args:
+        states (dict): _apply_recordsで変更のレコードを適用した辞書
+        snapshot (dict): ログのレコードが変更しなかったスナップショットの部屋
+            (部屋名(バイト列):ChatRoom)
+    """
+    rooms = {room.name: room for room in snapshot.values()}
+    for room_name, (host_token, members, messages, room) in states.items():
+        if room is None:
+            room = ChatRoom(room_name.decode("utf-8"))
+        else:
+            for token in [token for token in room.members if token not in members]:
+                room.remove_client(token)
+            room.messages.clear()
+        room.host_token = host_token
+        for token, entry in members.items():
+            # スナップショットのまま変わっていないユーザー
+            if not isinstance(entry, tuple):
+                continue
+            name_size, user, port, session_id, flags = entry
+            room.remove_client(token)
+            room.add_client(
+                token,
+                (user[name_size:].decode("utf-8"), port),
+                user[:name_size].decode("utf-8"),
+                session_id or None,
+                reliable=bool(flags & protocol.FLAG_RELIABLE),
+                compress=bool(flags & protocol.FLAG_COMPRESS),
+                tagged=bool(flags & protocol.FLAG_ROOM_TAG),
+                multicast=bool(flags & protocol.FLAG_MULTICAST),
+            )
+        for seq, data in messages:
+            room.messages.next_seq = seq
+            room.messages.append(data)
+        rooms[room.name] = room
+    return rooms
+
+
+def _apply_batches(data, size, apply):
+    """CRCを確かめながら、バッチのレコード部を先頭から順にapplyに渡す
+
+    Returns:
+        int: 読み込んだバイト数(書き込みが途切れたバッチ以降は読まない)
+    """
+    view = memoryview(data)
+    try:
+        offset = 0
+        while offset + BATCH_HEADER.size <= size:
+            length, crc = BATCH_HEADER.unpack_from(data, offset)
+            start = offset + BATCH_HEADER.size
+            end = start + length
+            if end > size or zlib.crc32(view[start:end]) != crc:
+                break
+            apply(data[start:end])
+            offset = end
+        return offset
+    finally:
+        view.release()
+
+
+def _replay_file(path, apply):
+    """ファイルをmmapで読み込み、バッチのレコード部をapplyに渡す"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return
+        with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mm:
+            _apply_batches(mm, size, apply)
+    finally:
+        os.close(fd)
+
+
+def _apply_records(data, states, snapshot):
+    """バッチ内のレコードを順番にstatesに適用する
+
+    Args:
+        data (bytes): バッチのレコード部
+        states (dict): 部屋名(バイト列):[ホストのトークン,
+            {トークン:(ユーザー名のバイト数, ユーザー名+IPアドレスのバイト列, ポート番号, セッションID,
+            受け取り方)またはスナップショットから変わっていないmember.Member},
+            メッセージのリスト, スナップショットのChatRoom(ログで作成した部屋はNone)]
+        snapshot (dict): まだレコードが変更していないスナップショットの部屋
+            (部屋名(バイト列):ChatRoom)
+    """
+    unpack_join = JOIN_HEADER.unpack_from
+    unpack_token = TOKEN_HEADER.unpack_from
+    unpack_message = MESSAGE_HEADER.unpack_from
+    get_state = states.get
+    join_size = JOIN_HEADER.size
+    offset = 0
+    size = len(data)
+    while offset < size:
+        kind = data[offset]
+        if kind == MEMBER_JOIN:
+            _, room_size, token_size, name_size, host_size, port, session_id, flags = (
+                unpack_join(data, offset)
+            )
+            start = offset + join_size
+            token_start = start + room_size
+            name_start = token_start + token_size
+            offset = name_start + name_size + host_size
+            room_name = data[start:token_start]
+            state = get_state(room_name) or _take_snapshot(room_name, states, snapshot)
+            if state is not None:
+                state[1][data[token_start:name_start]] = (
+                    name_size,
+                    data[name_start:offset],
+                    port,
+                    session_id,
+                    flags,
+                )
+        elif kind == MEMBER_LEAVE or kind == HOST_CHANGE:
+            _, room_size, token_size = unpack_token(data, offset)
+            start = offset + TOKEN_HEADER.size
+            token_start = start + room_size
+            offset = token_start + token_size
+            room_name = data[start:token_start]
+            state = get_state(room_name) or _take_snapshot(room_name, states, snapshot)
+            if state is None:
+                continue
+            token = data[token_start:offset]
+            if kind == MEMBER_LEAVE:
+                state[1].pop(token, None)
+            else:
+                state[0] = token
+        elif kind == MESSAGE:
+            _, room_size, seq, message_size = unpack_message(data, offset)
+            start = offset + MESSAGE_HEADER.size
+            message_start = start + room_size
+            offset = message_start + message_size
+            room_name = data[start:message_start]
+            state = get_state(room_name) or _take_snapshot(room_name, states, snapshot)
+            # スナップショットに含まれたメッセージのレコードが後に残っている場合は読み飛ばす
+            if state is not None and (not state[2] or state[2][-1][0] < seq):
+                state[2].append((seq, data[message_start:offset]))
+        elif kind == ROOM_CREATE or kind == ROOM_CLOSE:
+            room_size = data[offset + 1]
+            start = offset + ROOM_HEADER.size
+            offset = start + room_size
+            room_name = data[start:offset]
+            snapshot.pop(room_name, None)
+            if kind == ROOM_CREATE:
+                states[room_name] = [b"", {}, [], None]
+            else:
+                states.pop(room_name, None)
+        else:
+            raise ValueError(f"Unknown record type {kind}.")
+
+
+def _take_snapshot(room_name, states, snapshot):
+    """スナップショットの部屋を、ログのレコードを適用できるようにstatesに移す
+
+    Returns:
+        list: 移した部屋の状態(スナップショットにない場合はNone)
+    """
+    room = snapshot.pop(room_name, None)
+    if room is None:
+        return None
+    state = [room.host_token, dict(room.members), room.messages.since(0), room]
+    states[room_name] = state
+    return state
+
+
+def _load_rooms(data, rooms):
+    """スナップショットのバッチのレコード部から、直接ChatRoomを組み立てる
+
+    Args:
+        data (bytes): バッチのレコード部(encode_roomsのレコード)
+        rooms (dict): 部屋名(バイト列):ChatRoom
+    """
+    offset = 0
+    size = len(data)
+    while offset < size:
+        kind = data[offset]
+        if kind == ROOM_MEMBERS:
+            _, room_size, count, host_count = MEMBERS_HEADER.unpack_from(data, offset)
+            start = offset + MEMBERS_HEADER.size
+            offset = start + room_size
+            room = rooms[data[start:offset]]
+            offset = _load_members(room, data, offset, count, host_count)
+        elif kind == ROOM_MESSAGES:
+            _, room_size, count = MESSAGES_HEADER.unpack_from(data, offset)
+            start = offset + MESSAGES_HEADER.size
+            offset = start + room_size
+            room = rooms[data[start:offset]]
+            seqs = struct.unpack_from(f"!{count}Q", data, offset)
+            offset += 8 * count
+            sizes = struct.unpack_from(f"!{count}H", data, offset)
+            messages, offset = _split(data, offset + 2 * count, sizes)
+            room.messages.extend(zip(seqs, messages))
+        elif kind == HOST_CHANGE:
+            _, room_size, token_size = TOKEN_HEADER.unpack_from(data, offset)
+            start = offset + TOKEN_HEADER.size
+            token_start = start + room_size
+            offset = token_start + token_size
+            rooms[data[start:token_start]].host_token = data[token_start:offset]
+        elif kind == ROOM_CREATE:
+            room_size = data[offset + 1]
+            start = offset + ROOM_HEADER.size
+            offset = start + room_size
+            room_name = data[start:offset]
+            rooms[room_name] = ChatRoom(room_name.decode("utf-8"))
+        else:
+            raise ValueError(f"Unknown snapshot record type {kind}.")
+
+
+def _load_members(room, data, offset, count, host_count):
+    """ROOM_MEMBERSのレコードのユーザーを部屋に追加する
+
+    Note:
+        値の種類ごとにまとめて取り出し、受け取り方の指定がないユーザーは
+        add_clientを経由せずにまとめて部屋に追加する。ユーザー名はデコードせず、
+        レコードの「ユーザー名: 」をそのままMember.prefixにする。
+
+    Returns:
+        int: レコードの終わりの位置
+    """
+    token_sizes = data[offset : offset + count]
+    host_sizes = data[offset + count : offset + count + host_count]
+    offset += count + host_count
+    shorts = struct.Struct(f"!{count}H")
+    prefix_sizes = shorts.unpack_from(data, offset)
+    host_indexes = shorts.unpack_from(data, offset + 2 * count)
+    ports = shorts.unpack_from(data, offset + 4 * count)
+    session_ids = struct.unpack_from(f"!{count}I", data, offset + 6 * count)
+    offset += 10 * count
+    flags = data[offset : offset + count]
+    tokens, offset = _split(data, offset + count, token_sizes)
+    prefixes, offset = _split(data, offset, prefix_sizes)
+    hosts, offset = _split(data, offset, host_sizes)
+    hosts = [host.decode("utf-8") for host in hosts]
+    addresses = list(zip(map(hosts.__getitem__, host_indexes), ports))
+    if any(session_ids):
+        session_ids = [session_id or None for session_id in session_ids]
+    else:
+        session_ids = repeat(None, count)
+    if flags.count(0) == count:
+        room.add_members(
+            list(
+                map(
+                    Member,
+                    tokens,
+                    repeat(None),
+                    addresses,
+                    repeat(room),
+                    session_ids,
+                    prefixes,
+                )
+            )
+        )
+        return offset
+    members = []
+    for token, prefix, address, session_id, member_flags in zip(
+        tokens, prefixes, addresses, session_ids, flags
+    ):
+        if member_flags:
+            room.add_client(
+                token,
+                address,
+                prefix[:-2].decode("utf-8"),
+                session_id,
+                reliable=bool(member_flags & protocol.FLAG_RELIABLE),
+                compress=bool(member_flags & protocol.FLAG_COMPRESS),
+                tagged=bool(member_flags & protocol.FLAG_ROOM_TAG),
+                multicast=bool(member_flags & protocol.FLAG_MULTICAST),
+            )
+        else:
+            members.append(Member(token, None, address, room, session_id, prefix))
+    room.add_members(members)
+    return offset
+
+
+def _split(data, offset, sizes):
+    """offsetから、sizesのバイト数ずつ続くバイト列を切り出す
+
+    Returns:
+        tuple: (バイト列のリスト, 続きの位置)
+    """
+    if not sizes:
+        return [], offset
+    size = sizes[0]
+    end = offset + size * len(sizes)
+    # トークンのように全て同じバイト数の場合は、位置を計算せずに切り出す
+    if sizes.count(size) == len(sizes):
+        return [data[start : start + size] for start in range(offset, end, size)], end
+    ends = list(accumulate(sizes, initial=offset))
+    return [data[start:end] for start, end in zip(ends, ends[1:])], ends[-1]
@@ -0,0 +1,486 @@
+"""複数のワーカープロセスでサーバーを起動するランチャー
+
+python3 workers.py --workers 4
+
+各ワーカーはSO_REUSEPORTで9002/9003を共有し、部屋名のハッシュで決まる担当ワーカーだけが
+その部屋(ChatRoom)を持つ。担当でないワーカーが受け取ったデータグラムやハンドシェイクは、
+Unixドメインソケットで担当ワーカーへ転送する。部屋の一覧は全ワーカーに問い合わせてまとめる。
+"""
+
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import socket
+import struct
+import tempfile
+import zlib
+
+import multicast
+import protocol
+import signed_token
+from compression import RoomCompressor
+from log import configure_logging
+from server import Server
+from wal import WriteAheadLog
+
+# ワーカー間チャネルのメッセージ種別
+FORWARD_DATAGRAM = 1
+HANDSHAKE_REQUEST = 2
+HANDSHAKE_RESPONSE = 3
+
+
+def owner_of(room_name, num_workers):
+    """部屋を担当するワーカー番号を返す
+
+    Args:
+        room_name (bytes): UTF-8エンコード済みの部屋名
+        num_workers (int): ワーカー数
+
+    Returns:
+        int: ワーカー番号
+    """
+    return zlib.crc32(room_name) % num_workers
+
+
+def owner_of_session(session, num_workers, signed=False):
+    """短い形式のチャットメッセージのトークン・セッションIDから担当ワーカー番号を返す
+
+    Note:
+        各ワーカーはトークンの先頭バイトを自分の番号にし、セッションIDはワーカー数で
+        割った余りが自分の番号になるように発行する。
+        署名したトークン(signed_token.py)は部屋IDを含むため、部屋名と同じく部屋IDで決める。
+
+    Args:
+        session (bytes): バイナリのトークンまたはセッションID
+        num_workers (int): ワーカー数
+        signed (bool): トークンが署名したものかどうか
+
+    Returns:
+        int: ワーカー番号
+    """
+    if len(session) == protocol.SESSION_ID_SIZE:
+        return int.from_bytes(session, byteorder="big") % num_workers
+    if signed:
+        return signed_token.token_room_id(session) % num_workers
+    return session[0] % num_workers
+
+
+class WorkerRouter:
+    """担当外の部屋宛てのリクエストを担当ワーカーへ転送する"""
+
+    HANDSHAKE_TIMEOUT = 5
+
+    def __init__(self, server, index, num_workers, channel_dir):
+        """
+        Args:
+            server (server.Server): このワーカーのサーバー
+            index (int): このワーカーの番号
+            num_workers (int): ワーカー数
+            channel_dir (str): ワーカー間チャネルのソケットを置くディレクトリ
+        """
+        self.server = server
+        self.index = index
+        self.num_workers = num_workers
+        self.channel_dir = channel_dir
+        self.__transport = None
+        self.__request_ids = itertools.count()
+        self.__pending = {}  # リクエストID:レスポンス待ちのFuture
+        # 短い形式のチャットメッセージを担当ワーカーへ転送できるように、
+        # 発行するトークンとセッションIDにワーカー番号を埋め込む
+        server.token_prefix = bytes([index])
+        server.next_session_id = num_workers + index
+        server.session_id_step = num_workers
+
+    def channel_path(self, index):
+        """ワーカーのチャネル用ソケットのパス"""
+        return os.path.join(self.channel_dir, f"worker-{index}.sock")
+
+    async def start(self):
+        """ワーカー間チャネルのソケットをイベントループに登録する"""
+        path = self.channel_path(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        loop = asyncio.get_running_loop()
+        self.__transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ChannelProtocol(self), sock=sock
+        )
+
+    def owns(self, room_name):
+        """このワーカーが部屋を担当しているかどうか"""
+        return owner_of(room_name, self.num_workers) == self.index
+
+    def owner_of_datagram(self, data):
+        """UDPで受け取ったデータグラムの部屋を担当するワーカー番号"""
+        room_name_size, token_size = data[0], data[1]
+        if room_name_size == 0:
+            return owner_of_session(
+                data[2 : 2 + token_size],
+                self.num_workers,
+                self.server.tokens is not None,
+            )
+        return owner_of(data[2 : 2 + room_name_size], self.num_workers)
+
+    def owns_datagram(self, data):
+        """このワーカーがデータグラムの部屋を担当しているかどうか"""
+        return self.owner_of_datagram(data) == self.index
+
+    def __send(self, owner, message):
+        """担当ワーカーへメッセージを送る"""
+        try:
+            self.__transport.sendto(message, self.channel_path(owner))
+        except OSError as e:
+            print(f"Worker {self.index} Error:{e}")
+
+    def forward_datagram(self, data, addr):
+        """UDPで受け取ったデータグラムを担当ワーカーへ転送する
+
+        Args:
+            data (bytes): 受信データ
+            addr (tuple): 送信元アドレス
+        """
+        host = addr[0].encode("utf-8")
+        message = (
+            struct.pack("!B B", FORWARD_DATAGRAM, len(host))
+            + host
+            + struct.pack("!H", addr[1])
+            + data
+        )
+        self.__send(self.owner_of_datagram(data), message)
+
+    async def forward_handshake(self, room_name, request):
+        """ハンドシェイクを担当ワーカーで処理し、そのレスポンスを返す
+
+        Args:
+            room_name (bytes): 部屋名
+            request (bytes): リクエスト(ヘッダー + ボディ)
+
+        Returns:
+            bytes: レスポンス(ヘッダー + ペイロード)
+        """
+        return await self.__request(owner_of(room_name, self.num_workers), request)
+
+    async def __request(self, worker, request):
+        """ハンドシェイクをworker番のワーカーで処理し、そのレスポンスを返す"""
+        request_id = next(self.__request_ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[request_id] = future
+        message = struct.pack("!B B I", HANDSHAKE_REQUEST, self.index, request_id)
+        self.__send(worker, message + request)
+        try:
+            return await asyncio.wait_for(future, self.HANDSHAKE_TIMEOUT)
+        finally:
+            self.__pending.pop(request_id, None)
+
+    async def list_rooms(self, header, body):
+        """部屋の一覧リクエストを全ワーカーで処理し、1つのレスポンスにまとめる
+
+        Note:
+            各ワーカーは担当する部屋から辞書順で最大の部屋数を返すため、まとめて並べた先頭から
+            同じ数だけ返せば、全ワーカーの部屋を1つの索引で引いた場合と同じ結果になる。
+
+        Args:
+            header (bytes): リクエストヘッダー
+            body (bytes): 検索する部屋名の先頭とペイロード
+
+        Returns:
+            bytes: レスポンス(ヘッダー + ペイロード)
+        """
+        local = self.server.process_handshake(header, body)
+        if local[2] != self.server.REQUEST_COMPLETION:
+            return local
+        responses = await asyncio.gather(
+            *(
+                self.__request(worker, header + body)
+                for worker in range(self.num_workers)
+                if worker != self.index
+            )
+        )
+        request = protocol.decode_list_request(body[header[0] :])
+        limit = request["limit"]
+        if limit <= 0 or limit > self.server.directory.MAX_PAGE:
+            limit = self.server.directory.MAX_PAGE
+        rooms = []
+        more = False
+        for response in (local, *responses):
+            page = protocol.decode_list_response(response[self.server.HEADER_BYTE_SIZE :])
+            rooms += page["rooms"]
+            more = more or page["cursor"] != ""
+        rooms.sort()
+        if len(rooms) > limit:
+            rooms, more = rooms[:limit], True
+        payload = protocol.encode_list_response(
+            protocol.STATUS_COMPLETED,
+            rooms,
+            rooms[-1][0] if more else "",
+            request["binary"],
+        )
+        return local[:3] + len(payload).to_bytes(29, byteorder="big") + payload
+
+    def handle_channel_message(self, message):
+        """他のワーカーから届いたメッセージを処理する
+
+        Args:
+            message (bytes): チャネルで受信したメッセージ
+        """
+        kind = message[0]
+        if kind == FORWARD_DATAGRAM:
+            host_size = message[1]
+            host = message[2 : 2 + host_size].decode("utf-8")
+            (port,) = struct.unpack_from("!H", message, 2 + host_size)
+            self.server.handle_datagram(message[4 + host_size :], (host, port))
+        elif kind == HANDSHAKE_REQUEST:
+            _, origin, request_id = struct.unpack_from("!B B I", message)
+            request = message[6:]
+            header = request[: self.server.HEADER_BYTE_SIZE]
+            body = request[self.server.HEADER_BYTE_SIZE :]
+            response = self.server.process_handshake(header, body)
+            try:
+                self.__transport.sendto(
+                    struct.pack("!B I", HANDSHAKE_RESPONSE, request_id) + response,
+                    self.channel_path(origin),
+                )
+            except OSError as e:
+                print(f"Worker {self.index} Error:{e}")
+        elif kind == HANDSHAKE_RESPONSE:
+            (request_id,) = struct.unpack_from("!I", message, 1)
+            future = self.__pending.get(request_id)
+            if future is not None and not future.done():
+                future.set_result(message[5:])
+
+
+class _ChannelProtocol(asyncio.DatagramProtocol):
+    """ワーカー間チャネル(Unixドメインソケット)のプロトコル"""
+
+    def __init__(self, router):
+        self.router = router
+
+    def datagram_received(self, data, addr):
+        try:
+            self.router.handle_channel_message(data)
+        except Exception as e:
+            print(f"Worker {self.router.index} Error:{e}")
+
+
+def run_worker(
+    index,
+    num_workers,
+    channel_dir,
+    wal_dir=None,
+    wal_messages=False,
+    metrics_port=None,
+    coalesce_ms=0,
+    rate_limit=0,
+    rate_burst=10,
+    room_bytes_per_second=0,
+    rate_policy="drop",
+    max_queued_relays=10000,
+    log_level="INFO",
+    log_rate=100,
+    compress_min_bytes=RoomCompressor.MIN_SIZE,
+    token_key_file=None,
+    token_ttl=signed_token.TokenSigner.TTL,
+    multicast_network=None,
+    multicast_port=multicast.MulticastGroups.PORT,
+    multicast_ttl=multicast.MulticastGroups.TTL,
+):
+    """ワーカープロセスの処理
+
+    Args:
+        index (int): ワーカー番号
+        num_workers (int): ワーカー数
+        channel_dir (str): ワーカー間チャネルのソケットを置くディレクトリ
+        wal_dir (str): 追記型ログを置くディレクトリ(ワーカーごとにサブディレクトリを作る)
+        wal_messages (bool): チャットメッセージもログに記録するかどうか
+        metrics_port (int): 計測値を返すTCPポートの先頭(ワーカーごとに番号を足したポートを使う)
+        coalesce_ms (float): 中継をまとめて送る時間(ミリ秒、0でまとめない)
+        rate_limit (float): ユーザーごとの1秒あたりのメッセージ数の上限(0で制限しない)
+        rate_burst (int): ユーザーごとに連続して送信できるメッセージ数
+        room_bytes_per_second (int): 部屋ごとの1秒あたりの中継バイト数の上限(0で制限しない)
+        rate_policy (str): 上限を超えたメッセージの扱い(drop, delay, notify)
+        max_queued_relays (int): 遅らせている中継の合計の上限
+        log_level (str): ログのレベル
+        log_rate (int): 1秒あたりのログの最大件数
+        compress_min_bytes (int): 圧縮して受け取るユーザーに圧縮して送る中継の最小バイト数
+        token_key_file (str): 署名したトークンの鍵ファイル(全ワーカーで同じ鍵を使う)
+        token_ttl (int): 署名したトークンの有効期限の秒数
+        multicast_network (str): 部屋ごとのマルチキャストグループを選ぶネットワーク(Noneなら使わない)
+        multicast_port (int): マルチキャストグループの宛先ポート
+        multicast_ttl (int): マルチキャストのTTL
+    """
+    configure_logging(log_level, log_rate)
+    wal = None
+    if wal_dir is not None:
+        # 担当する部屋はワーカー数で決まるので、同じワーカー数で再起動すれば復元できる
+        wal = WriteAheadLog(
+            os.path.join(wal_dir, f"worker-{index}"), log_messages=wal_messages
+        )
+    server = Server(reuse_port=True, wal=wal)
+    server.router = WorkerRouter(server, index, num_workers, channel_dir)
+    server.COALESCE_WINDOW = coalesce_ms / 1000
+    server.RATE_LIMIT = rate_limit
+    server.RATE_BURST = rate_burst
+    server.ROOM_BYTES_PER_SECOND = room_bytes_per_second
+    server.RATE_POLICY = rate_policy
+    server.MAX_QUEUED_RELAYS = max_queued_relays
+    server.COMPRESS_MIN_BYTES = compress_min_bytes
+    if token_key_file is not None:
+        server.tokens = signed_token.TokenSigner(key_file=token_key_file, ttl=token_ttl)
+    if multicast_network is not None:
+        # 部屋のグループは部屋名で決まるので、どのワーカーが送っても同じグループになる
+        server.multicast = multicast.MulticastGroups(
+            multicast_network, multicast_port, server.udp_address[0], multicast_ttl
+        )
+    if metrics_port is not None:
+        server.metrics_address = ("127.0.0.1", metrics_port + index)
+    server.start_async()
+
+
+def launch_workers(num_workers, wal_dir=None, wal_messages=False, **options):
+    """ワーカープロセスを起動し、終了するまで待つ
+
+    Args:
+        num_workers (int): ワーカー数
+        wal_dir (str): 追記型ログを置くディレクトリ
+        wal_messages (bool): チャットメッセージもログに記録するかどうか
+        **options: run_workerに渡すその他の設定(metrics_port, coalesce_ms, rate_limitなど)
+    """
+    with tempfile.TemporaryDirectory(prefix="chat-workers-") as channel_dir:
+        processes = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(index, num_workers, channel_dir, wal_dir, wal_messages),
+                kwargs=options,
+            )
+            for index in range(num_workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online Chat Messenger Workers")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="ワーカープロセス数"
+    )
+    parser.add_argument(
+        "--wal",
+        metavar="DIR",
+        help="部屋の状態を追記型ログとしてDIR/worker-<番号>に記録し、起動時に復元する",
+    )
+    parser.add_argument(
+        "--wal-messages",
+        action="store_true",
+        help="チャットメッセージ(履歴)もログに記録する",
+    )
+    parser.add_argument(
+        "--coalesce-ms",
+        type=float,
+        default=0,
+        help="メッセージの多い部屋で、この時間(ミリ秒)内に届いた中継をまとめて送る(0でまとめない)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="ユーザーごとの1秒あたりのメッセージ数の上限(0で制限しない)",
+    )
+    parser.add_argument(
+        "--rate-burst", type=int, default=10, help="ユーザーごとに連続して送信できるメッセージ数"
+    )
+    parser.add_argument(
+        "--room-bytes-per-second",
+        type=int,
+        default=0,
+        help="部屋ごとの1秒あたりの中継バイト数(メッセージ x 送信先数)の上限(0で制限しない)",
+    )
+    parser.add_argument(
+        "--rate-policy",
+        default="drop",
+        choices=["drop", "delay", "notify"],
+        help="上限を超えたメッセージを破棄する・遅らせて中継する・破棄して送信者に通知する",
+    )
+    parser.add_argument(
+        "--max-queued-relays",
+        type=int,
+        default=10000,
+        help="中継待ちの処理の合計の上限(超えた場合は処理待ちの多い部屋のメッセージから破棄する)",
+    )
+    parser.add_argument(
+        "--compress-min-bytes",
+        type=int,
+        default=RoomCompressor.MIN_SIZE,
+        help="圧縮して受け取るユーザーに、このバイト数以上の中継を圧縮して送る",
+    )
+    parser.add_argument(
+        "--token-key-file",
+        metavar="FILE",
+        help="署名したトークンを使う場合の鍵ファイル(どのワーカーでもトークンを検証できる)",
+    )
+    parser.add_argument(
+        "--token-ttl",
+        type=int,
+        default=signed_token.TokenSigner.TTL,
+        help="署名したトークンの有効期限の秒数",
+    )
+    parser.add_argument(
+        "--multicast",
+        metavar="NETWORK",
+        help="部屋ごとのマルチキャストグループを選ぶネットワーク(例: 239.255.0.0/16)",
+    )
+    parser.add_argument(
+        "--multicast-port",
+        type=int,
+        default=multicast.MulticastGroups.PORT,
+        help="マルチキャストグループの宛先ポート",
+    )
+    parser.add_argument(
+        "--multicast-ttl",
+        type=int,
+        default=multicast.MulticastGroups.TTL,
+        help="マルチキャストのTTL(1ならローカルのネットワークから出さない)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="計測値を返すTCPポートの先頭(ワーカーNはこのポート+Nを使う)",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"],
+        help="ログのレベル(DEBUGでメッセージごとのログも出力する)",
+    )
+    parser.add_argument(
+        "--log-rate", type=int, default=100, help="1秒あたりのログの最大件数(0で無制限)"
+    )
+    args = parser.parse_args()
+    launch_workers(
+        args.workers,
+        args.wal,
+        args.wal_messages,
+        metrics_port=args.metrics_port,
+        coalesce_ms=args.coalesce_ms,
+        rate_limit=args.rate_limit,
+        rate_burst=args.rate_burst,
+        room_bytes_per_second=args.room_bytes_per_second,
+        rate_policy=args.rate_policy,
+        max_queued_relays=args.max_queued_relays,
+        log_level=args.log_level,
+        log_rate=args.log_rate,
+        compress_min_bytes=args.compress_min_bytes,
+        token_key_file=args.token_key_file,
+        token_ttl=args.token_ttl,
+        multicast_network=args.multicast,
+        multicast_port=args.multicast_port,
+        multicast_ttl=args.multicast_ttl,
+    )